@@ -1,18 +1,48 @@
 import datetime
+import math
+import os
+import time
 from pathlib import Path
 
 import markdown
+import metrics
 from database import (
+    STATE_ACTIVE,
     DatabaseException,
+    ScheduledItemNotFound,
     add_schedule_item,
     add_station,
+    delete_recurrence,
     delete_scheduled_event,
     delete_station,
     get_all_stations,
+    get_schedule_item,
+    get_schedule_item_by_filepath,
     get_scheduled_events,
+    has_pending_postprocess_jobs,
 )
-from flask import Flask, flash, redirect, render_template, request, send_file
-from settings import RECORDING_PATH
+from flask import (
+    Flask,
+    Response,
+    abort,
+    flash,
+    g,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
+from peaks import PEAKS_SUFFIX
+from segmented_recorder import list_segments, segment_directory
+from settings import (
+    ARCHIVE_FOLLOW_CHUNK_SIZE,
+    ARCHIVE_FOLLOW_POLL_SEC,
+    ARCHIVE_MAX_AGE_SEC,
+    RECORDING_PATH,
+)
+from time_index import clip_byte_range
+from werkzeug.security import safe_join
 
 app = Flask(__name__)
 
@@ -22,6 +52,35 @@ app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
 
 app.secret_key = "your_secret_key"  # Set your secret key here
 
+REQUEST_SECONDS = metrics.histogram(
+    "pywrr_http_request_seconds",
+    "Time until the response of a web app request (streams excluded)",
+)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    # per route pattern, not per url, e.g. "/archive/<path:filepath>"
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_start,
+        route=route,
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # this process: web app requests and its database calls
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
 
 @app.route("/")
 def index_endpoint():  # put application's code here
@@ -143,16 +202,214 @@ def delete_schedule(schedule_id):
         return render_template("error.html", error=str(e))
 
 
+@app.route("/delete-recurrence/<int:recurrence_id>", methods=["POST"])
+def delete_recurrence_endpoint(recurrence_id):
+    try:
+        delete_recurrence(recurrence_id)
+        return redirect("/future-events", code=303)
+    except DatabaseException as e:
+        return render_template("error.html", error=str(e))
+
+
+ARCHIVE_MIMETYPES = {
+    ".ts": "audio/mp2t",
+    ".mp3": "audio/mpeg",
+    ".aac": "audio/aac",
+    ".m4a": "audio/mp4",
+}
+
+
+def is_recording_active(schedule_id):
+    try:
+        return get_schedule_item(schedule_id)["state"] == STATE_ACTIVE
+    except ScheduledItemNotFound:
+        return False
+
+
+def send_byte_range(abs_filepath, start, end):
+    with open(abs_filepath, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0 and (
+            chunk := file.read(min(remaining, ARCHIVE_FOLLOW_CHUNK_SIZE))
+        ):
+            remaining -= len(chunk)
+            yield chunk
+
+
+def follow_recording(abs_filepath, schedule_id, start=0):
+    # stream a growing file: send what's there, then wait for new bytes
+    # until the recording is no longer active
+    with open(abs_filepath, "rb") as file:
+        file.seek(start)
+        while True:
+            chunk = file.read(ARCHIVE_FOLLOW_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+
+            if not is_recording_active(schedule_id):
+                # send the last bytes written before the recording ended
+                while chunk := file.read(ARCHIVE_FOLLOW_CHUNK_SIZE):
+                    yield chunk
+                return
+
+            time.sleep(ARCHIVE_FOLLOW_POLL_SEC)
+
+
+def stream_segments(segment_dir, joined_path, schedule_id, follow=False):
+    # a segmented recording before it is joined: send the segments in
+    # order, with follow wait for new ones until the recording has ended
+    index = 0
+    position = 0
+    sent = 0
+    last_pass = not follow
+    while True:
+        segments = list_segments(segment_dir)
+        if not segments and sent:
+            # joined in the meantime, MPEG-TS is joined by appending the
+            # segments so the rest can be sent from the joined file
+            if joined_path.suffix == ".ts" and joined_path.is_file():
+                with open(joined_path, "rb") as file:
+                    file.seek(sent)
+                    while chunk := file.read(ARCHIVE_FOLLOW_CHUNK_SIZE):
+                        yield chunk
+            return
+
+        if index < len(segments):
+            try:
+                with open(segments[index], "rb") as file:
+                    file.seek(position)
+                    while chunk := file.read(ARCHIVE_FOLLOW_CHUNK_SIZE):
+                        position += len(chunk)
+                        sent += len(chunk)
+                        yield chunk
+            except FileNotFoundError:
+                continue
+            if index + 1 < len(segments):
+                index += 1
+                position = 0
+                continue
+
+        if last_pass:
+            return
+        if not is_recording_active(schedule_id):
+            # send the last bytes written before the recording ended
+            last_pass = True
+            continue
+        time.sleep(ARCHIVE_FOLLOW_POLL_SEC)
+
+
 @app.route("/archive/<path:filepath>")
 def download_file(filepath):
-    # Get the absolute path to the file
+    mimetype = ARCHIVE_MIMETYPES.get(Path(filepath).suffix, "application/octet-stream")
+
+    try:
+        recording = get_schedule_item_by_filepath(filepath)
+        is_recording = recording["state"] == STATE_ACTIVE
+        # e.g. the trim job rewrites the file in place
+        is_final = not is_recording and not has_pending_postprocess_jobs(
+            recording["schedule_id"]
+        )
+    except ScheduledItemNotFound:
+        is_recording = False
+        is_final = True
+
+    # segmented recordings can be played before they are joined
+    segment_dir = segment_directory(filepath)
+    if (
+        is_recording
+        and safe_join(RECORDING_PATH, filepath) is not None
+        and segment_dir.is_dir()
+    ):
+        return Response(
+            stream_with_context(
+                stream_segments(
+                    segment_dir,
+                    Path(RECORDING_PATH, filepath),
+                    recording["schedule_id"],
+                    follow=bool(request.args.get("follow")),
+                )
+            ),
+            mimetype=ARCHIVE_MIMETYPES[".ts"],
+            headers={"Cache-Control": "no-store"},
+        )
+
+    # time based seeks ("?t=3600") and clips ("?t=3600&end=7200"), the byte
+    # offsets come from the time index written while recording
+    start_sec = request.args.get("t", type=float)
+    end_sec = request.args.get("end", type=float)
+    for seconds in (start_sec, end_sec):
+        if seconds is not None and not (math.isfinite(seconds) and seconds >= 0):
+            abort(400)
+    if end_sec is not None and end_sec < (start_sec or 0):
+        abort(400)
+    is_seek = start_sec is not None or end_sec is not None
+    follow = is_recording and request.args.get("follow")
+    start = 0
+    if is_seek:
+        abs_filepath = safe_join(RECORDING_PATH, filepath)
+        if abs_filepath is None or not Path(abs_filepath).is_file():
+            abort(404)
+        byte_range = clip_byte_range(abs_filepath, start_sec or 0, end_sec)
+        if byte_range is None:
+            abort(416)
+        start, end = byte_range
+
+    if is_seek and not follow:
+        headers = {"Cache-Control": "no-store" if is_recording else "private"}
+        if end is None:
+            end = os.path.getsize(abs_filepath)
+        else:
+            clip_name = f"{Path(filepath).stem}_{start_sec or 0:.0f}-{end_sec:.0f}"
+            disposition = f'attachment; filename="{clip_name}{Path(filepath).suffix}"'
+            headers["Content-Disposition"] = disposition
+        headers["Content-Length"] = str(end - start)
+        return Response(
+            stream_with_context(send_byte_range(abs_filepath, start, end)),
+            mimetype=mimetype,
+            headers=headers,
+        )
+
+    if follow:
+        abs_filepath = safe_join(RECORDING_PATH, filepath)
+        if abs_filepath is None or not Path(abs_filepath).is_file():
+            abort(404)
+        return Response(
+            stream_with_context(
+                follow_recording(abs_filepath, recording["schedule_id"], start)
+            ),
+            mimetype=mimetype,
+            headers={"Cache-Control": "no-store"},
+        )
+
+    # Serve the file with range requests (seeking) and ETag/Last-Modified
+    # revalidation. Completed recordings don't change once post-processing
+    # is done and can be cached, until then they are revalidated.
+    return send_from_directory(
+        RECORDING_PATH,
+        filepath,
+        as_attachment=False,  # true für download
+        mimetype=mimetype,
+        conditional=True,
+        etag=True,
+        max_age=ARCHIVE_MAX_AGE_SEC if is_final else 0,
+    )
 
-    abs_filepath = Path(RECORDING_PATH, filepath)
 
-    # Serve the file for download
-    return send_file(
-        abs_filepath, as_attachment=False, mimetype="audio/mp2t"
-    )  # true für download
+@app.route("/peaks/<path:filepath>")
+def download_peaks(filepath):
+    # waveform of a completed recording, written by the post-processing.
+    # Trimming or a new analysis rewrites it, so the browser revalidates
+    # with the ETag every time (a 304 while it is unchanged).
+    return send_from_directory(
+        RECORDING_PATH,
+        f"{filepath}{PEAKS_SUFFIX}",
+        mimetype="application/octet-stream",
+        conditional=True,
+        etag=True,
+        max_age=0,
+    )
 
 
 @app.route("/about")
@@ -0,0 +1,131 @@
+import asyncio
+from threading import Thread
+
+import clock
+from recorder import FFMPEGStreamRecording
+
+
+class AsyncRecorderLoop:
+    """a single asyncio event loop in a background thread that runs all async recordings"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+_recorder_loop = None
+
+
+def get_recorder_loop():
+    # created on first use, the thread backend never starts it
+    global _recorder_loop
+    if _recorder_loop is None:
+        _recorder_loop = AsyncRecorderLoop()
+    return _recorder_loop
+
+
+class AsyncFFMPEGStreamRecording(FFMPEGStreamRecording):
+    """FFMPEGStreamRecording without threads: the ffmpeg process, its output
+    and the end of the recording are handled on a shared asyncio loop"""
+
+    def __init__(
+        self,
+        schedule_id,
+        url,
+        duration_min=60,
+        filepath=None,
+        window_start=None,
+        window_end=None,
+        station_id=None,
+    ):
+        super().__init__(
+            schedule_id=schedule_id,
+            url=url,
+            duration_min=duration_min,
+            filepath=filepath,
+            window_start=window_start,
+            window_end=window_end,
+            station_id=station_id,
+        )
+        self.recording_thread = None
+        self._future = None
+
+    def __repr__(self):
+        return f"Async FFMPEG Recording #{self.schedule_id} - {self.starttime} - {self.url}"
+
+    def start(self):
+        self._future = get_recorder_loop().submit(self.do_recording())
+
+    @property
+    def is_running(self):
+        return self._future is not None and not self._future.done()
+
+    async def do_recording(self):
+        self.active = True
+        print(f"{self.url=} {self.duration_min=}")
+        self.starttime = clock.now()
+        self.start_index()
+
+        # resolving the stream url may block, keep it off the event loop
+        command = await asyncio.to_thread(lambda: self.get_ffmpeg_call)
+
+        try:
+            # start recording process
+            self.process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            print(f"[#{self.schedule_id}] {e}")
+            self.log.append(str(e))
+            self.active = False
+            self.is_aborted = True
+        else:
+            readers = asyncio.gather(
+                self.output_handler(self.process, "progress"),
+                self.output_handler(self.process, "stderr"),
+            )
+
+            # timer based termination instead of polling, returns early if ffmpeg exits
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(self.process.wait()),
+                    timeout=self.duration_min * 60,
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            self.end_recording()
+            await self.process.wait()
+            await readers
+            self.runtime_sec = int(clock.now() - self.starttime)
+            print(f"[#{self.schedule_id}] done {self.runtime_sec=} - {self.progress}")
+
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def end_recording(self):
+        self.active = False
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.terminate()
+            elif self.process.returncode != 0:
+                # ffmpeg failed before the end, e.g. a bad url or a 404
+                self.is_aborted = True
+                return
+        self.is_completed = True
+
+    async def output_handler(self, process, handler_type):
+        if handler_type == "progress":
+            async for line in process.stdout:
+                self.progress.feed_line(line.decode(errors="replace"))
+        else:
+            async for line in process.stderr:
+                self.log.append(line.decode(errors="replace").strip())
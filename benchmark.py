@@ -0,0 +1,456 @@
+"""benchmark and load test of scheduler, recorders, database and web app
+
+Runs against a temporary database and recordings directory, with
+fake_ffmpeg.py instead of ffmpeg and a local looping stream server, so
+nothing is downloaded and no real ffmpeg is needed:
+
+    python benchmark.py
+    python benchmark.py --rows 10000 --compare benchmark_results/previous.json
+
+The results are written as JSON to benchmark_results/, one file per run.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import settings
+
+try:
+    import resource
+except ImportError:
+    # Windows, no cpu and memory figures
+    resource = None
+
+RESULTS_PATH = Path(__file__).parent / "benchmark_results"
+# MPEG-1 Layer III frame, 128 kbit/s 44.1 kHz, silent payload
+MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+# ADTS AAC-LC frame, 44.1 kHz stereo, 256 bytes
+AAC_FRAME = b"\xff\xf1\x50\x80\x20\x1f\xfc" + bytes(249)
+
+
+def configure(workdir):
+    """point PyWRR at a scratch directory and the fake ffmpeg
+
+    Has to run before the PyWRR modules are imported, they read the
+    settings on import.
+    """
+    recordings = Path(workdir, "recordings")
+    recordings.mkdir()
+    settings.DATABASE_NAME = str(Path(workdir, "benchmark.db"))
+    settings.RECORDING_PATH = str(recordings)
+    settings.METRICS_SCHEDULER_PORT = None
+    settings.POSTPROCESS_JOBS = ()
+    settings.RETENTION_MAX_AGE_DAYS = None
+    settings.RETENTION_MAX_TOTAL_GB = None
+    settings.RETENTION_MAX_COUNT = None
+    settings.STORAGE_MIN_FREE_MB = 0
+    settings.SCHEDULER_PROGRESS_INTERVAL_SEC = 1
+    # one connection and process per recording, the worst case
+    settings.SHARED_CAPTURE = False
+
+    fake_ffmpeg = Path(__file__).with_name("fake_ffmpeg.py").resolve()
+    if os.name == "nt":
+        launcher = Path(workdir, "ffmpeg.cmd")
+        launcher.write_text(f'@"{sys.executable}" "{fake_ffmpeg}" %*\r\n')
+    else:
+        launcher = Path(workdir, "ffmpeg")
+        launcher.write_text(
+            f'#!/bin/sh\nexec "{sys.executable}" "{fake_ffmpeg}" "$@"\n'
+        )
+        launcher.chmod(0o755)
+    settings.FFMPEG_BINARY = str(launcher)
+
+
+def start_stream_server():
+    """local icecast stand-in, /stream.mp3 and /stream.aac loop silent frames"""
+    from prototyping import LoopingStreamHandler
+
+    class StreamHandler(LoopingStreamHandler):
+        bytes_per_sec = 16000
+
+        def do_GET(self):
+            if self.path.endswith(".aac"):
+                self.source, self.content_type = AAC_FRAME * 64, "audio/aac"
+            else:
+                self.source, self.content_type = MP3_FRAME * 64, "audio/mpeg"
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def summarize(values):
+    # seconds, reported in milliseconds
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values) * 1000, 3),
+        "p95_ms": round(values[int(len(values) * 0.95) - 1] * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def measure(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+class ResourceUsage:
+    """cpu time and peak memory of this process and its finished children"""
+
+    def __enter__(self):
+        self.start = self.snapshot()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = self.snapshot()
+        self.result = {"wall_sec": round(time.perf_counter() - self.wall_start, 3)}
+        if resource is not None:
+            for key in ("cpu_sec", "children_cpu_sec"):
+                self.result[key] = round(end[key] - self.start[key], 3)
+            # ru_maxrss is kB on Linux, bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.result["max_rss_mb"] = round(end["max_rss"] * scale / 1e6, 1)
+
+    @staticmethod
+    def snapshot():
+        if resource is None:
+            return {}
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "cpu_sec": own.ru_utime + own.ru_stime,
+            "children_cpu_sec": children.ru_utime + children.ru_stime,
+            "max_rss": own.ru_maxrss,
+        }
+
+
+def seed_database(rows, stream_url):
+    """stations plus rows schedule items, 90% finished, 10% in the future"""
+    import database
+
+    now = int(time.time())
+    for number in range(20):
+        database.add_station(f"S{number}", f"Station {number}", f"{stream_url}/s.mp3")
+
+    items = []
+    for number in range(rows):
+        future = number % 10 == 0
+        start_epoch = now + 3600 + number * 60 if future else now - number * 60
+        state = database.STATE_SCHEDULED if future else database.STATE_COMPLETED
+        filepath = f"S{number % 20} {number}.ts"
+        items.append(
+            (f"S{number % 20}", start_epoch, 60, filepath, 0 if future else 1000, state)
+        )
+
+    with database.get_cursor() as cursor:
+        cursor.executemany(
+            """INSERT INTO schedule (station_id, start_epoch, runtime, filepath,
+                          filesize, state) VALUES (?, ?, ?, ?, ?, ?)""",
+            items,
+        )
+
+
+def scenario_database(rows, stream_url):
+    import database
+
+    with ResourceUsage() as usage:
+        seed_start = time.perf_counter()
+        seed_database(rows, stream_url)
+        seed_sec = time.perf_counter() - seed_start
+
+        now = time.time()
+        queries = {
+            "get_upcoming_events": measure(
+                lambda: database.get_upcoming_events(now + 24 * 3600), 20
+            ),
+            "get_scheduled_events_future": measure(
+                lambda: database.get_scheduled_events(True, False, False), 5
+            ),
+            "get_scheduled_events_completed": measure(
+                lambda: database.get_scheduled_events(False, False, True), 5
+            ),
+            "claim_due_schedule_items": measure(
+                lambda: database.claim_due_schedule_items(now), 50
+            ),
+            "get_stored_recordings": measure(database.get_stored_recordings, 5),
+            "get_schedule_files": measure(database.get_schedule_files, 5),
+        }
+    return {
+        "rows": rows,
+        "seed_sec": round(seed_sec, 3),
+        "queries": queries,
+        **usage.result,
+    }
+
+
+def scenario_web(repeat=20):
+    import app as webapp
+
+    client = webapp.app.test_client()
+    routes = ["/", "/stations", "/future-events", "/running-events"]
+    routes += ["/completed-events", "/metrics"]
+    with ResourceUsage() as usage:
+        responses = {
+            route: measure(lambda route=route: client.get(route).close(), repeat)
+            for route in routes
+        }
+    return {"routes": responses, **usage.result}
+
+
+@contextlib.contextmanager
+def shortened_recordings(loop, duration_sec):
+    """recordings started by the loop end after duration_sec instead of their runtime"""
+    create = loop.create_recording
+
+    def create_recording(schedule_details, now, resume=False):
+        f = create(schedule_details, now, resume)
+        f.duration_min = duration_sec / 60
+        return f
+
+    loop.create_recording = create_recording
+    try:
+        yield
+    finally:
+        loop.create_recording = create
+
+
+def run_recordings(loop, schedule_ids, timeout_sec, web_requests=False):
+    """drive the scheduler until the recordings are finished
+
+    Start latency is the time from the planned start (start time minus
+    pre roll) until the recording has written data.
+    """
+    import app as webapp
+    import database
+
+    planned = {
+        schedule_id: database.get_schedule_item(schedule_id)["start_epoch"]
+        - settings.PRE_ROLL_SEC
+        for schedule_id in schedule_ids
+    }
+    first_data = {}
+    seen = set()
+    web_durations = []
+    client = webapp.app.test_client()
+    deadline = time.time() + timeout_sec
+
+    while time.time() < deadline:
+        loop.run_once()
+        now = time.time()
+        for f in loop._current_treads:
+            seen.add(f.schedule_id)
+            if f.schedule_id not in first_data and f.get_approx_size() > 0:
+                first_data[f.schedule_id] = now - planned[f.schedule_id]
+        if web_requests:
+            start = time.perf_counter()
+            client.get("/running-events").close()
+            web_durations.append(time.perf_counter() - start)
+
+        if len(seen) == len(schedule_ids) and not loop._current_treads:
+            break
+        time.sleep(0.05)
+
+    loop.update_recordings(time.time())
+    finished = database.get_scheduled_events(False, False, True)
+    finished_ids = {event["schedule_id"] for event in finished}
+    return {
+        "recordings": len(schedule_ids),
+        "completed": len(finished_ids & set(schedule_ids)),
+        "with_data": len(first_data),
+        "start_latency": summarize(list(first_data.values())),
+        "web_running_events": summarize(web_durations),
+    }
+
+
+def add_due_recordings(filepaths):
+    """schedule items starting together in two seconds, returns their ids
+
+    Inserted directly, add_schedule_item allows one item per station and
+    start time.
+    """
+    import database
+
+    start_epoch = int(time.time()) + settings.PRE_ROLL_SEC + 2
+    with database.get_cursor() as cursor:
+        return [
+            cursor.execute(
+                """INSERT INTO schedule (station_id, start_epoch, runtime, filepath)
+                              VALUES (?, ?, 1, ?) RETURNING schedule_id""",
+                (f"S{number % 20}", start_epoch, filepath),
+            ).fetchone()[0]
+            for number, filepath in enumerate(filepaths)
+        ]
+
+
+def scenario_simultaneous_starts(loop, count, duration_sec):
+    """count recordings of the same start time, half native mp3, half fake ffmpeg"""
+    schedule_ids = add_due_recordings(
+        [f"simultaneous {n}{'.mp3' if n % 2 else '.ts'}" for n in range(count)]
+    )
+    loop.reload_schedule()
+    with shortened_recordings(loop, duration_sec), ResourceUsage() as usage:
+        result = run_recordings(loop, schedule_ids, duration_sec + 60, True)
+    return {**result, **usage.result}
+
+
+def scenario_compressed_day(loop, duration_sec, hours=24):
+    """one recording reporting hours of media in duration_sec"""
+    import database
+
+    speed = hours * 3600 / duration_sec
+    os.environ["FAKE_FFMPEG_SPEED"] = str(speed)
+    [schedule_id] = add_due_recordings(["compressed day.ts"])
+
+    loop.reload_schedule()
+    try:
+        with shortened_recordings(loop, duration_sec), ResourceUsage() as usage:
+            result = run_recordings(loop, [schedule_id], duration_sec + 60)
+    finally:
+        del os.environ["FAKE_FFMPEG_SPEED"]
+
+    item = database.get_schedule_item(schedule_id)
+    index_file = Path(settings.RECORDING_PATH, f"{item['filepath']}.idx")
+    return {
+        **result,
+        "media_hours": hours,
+        "speed": round(speed),
+        "filesize": item["filesize"],
+        "index_bytes": index_file.stat().st_size if index_file.exists() else 0,
+        **usage.result,
+    }
+
+
+def get_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, previous_path):
+    """print the change of every number against an earlier run"""
+    previous = json.loads(Path(previous_path).read_text(encoding="utf-8"))
+
+    def walk(current, earlier, path):
+        if isinstance(current, dict) and isinstance(earlier, dict):
+            for key, value in current.items():
+                if key in earlier:
+                    walk(value, earlier[key], f"{path}.{key}" if path else key)
+        elif isinstance(current, (int, float)) and isinstance(earlier, (int, float)):
+            if earlier and current != earlier:
+                change = (current - earlier) / earlier * 100
+                print(f"{path}: {earlier} -> {current} ({change:+.1f}%)")
+
+    print(f"Compared to {previous.get('version')} ({previous.get('timestamp')}):")
+    walk(results["scenarios"], previous.get("scenarios", {}), "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--starts", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--compressed-duration", type=float, default=60)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pywrr-benchmark-")
+    try:
+        configure(workdir)
+        stream_url = start_stream_server()
+
+        # imported after configure(), with the benchmark settings
+        import database
+        import scheduler
+
+        results = {
+            "version": get_version(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "workdir": workdir,
+            "scenarios": {},
+        }
+        scenarios = results["scenarios"]
+
+        print(f"Seeding {args.rows} schedule items")
+        scenarios["database"] = scenario_database(args.rows, stream_url)
+        # the seeded future items are not part of the recording scenarios
+        with database.get_cursor() as cursor:
+            cursor.execute(
+                "UPDATE schedule SET state = ? WHERE state = ?",
+                (database.STATE_ABORTED, database.STATE_SCHEDULED),
+            )
+        print("Web app")
+        scenarios["web"] = scenario_web()
+
+        loop = scheduler.SchedulingLoop()
+        loop.startup()
+        print(f"{args.starts} simultaneous starts")
+        scenarios["simultaneous_starts"] = scenario_simultaneous_starts(
+            loop, args.starts, args.duration
+        )
+        print("24 h recording, compressed")
+        scenarios["compressed_day"] = scenario_compressed_day(
+            loop, args.compressed_duration
+        )
+        # every database call of the run, from the /metrics histogram
+        scenarios["database_calls"] = {
+            dict(labels)["call"]: {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 3),
+            }
+            for labels, (
+                count,
+                total,
+            ) in database.DATABASE_CALL_SECONDS.totals().items()
+        }
+
+        output = args.output
+        if output is None:
+            RESULTS_PATH.mkdir(exist_ok=True)
+            output = RESULTS_PATH / f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+        output.write_text(json.dumps(results, indent=1), encoding="utf-8")
+        print(json.dumps(scenarios, indent=1))
+        print(f"Results written to {output}")
+        if args.compare:
+            compare(results, args.compare)
+    finally:
+        # the open database connection keeps the file locked on Windows
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
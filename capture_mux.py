@@ -0,0 +1,278 @@
+import http.client
+import subprocess
+import threading
+import urllib.request
+from collections import deque
+from pathlib import Path
+from threading import Thread
+
+import clock
+from http_recorder import HTTPStreamRecording, IcyMetadataStripper
+from recorder import ScheduledRecordingException
+from settings import (
+    FFMPEG_BINARY,
+    HTTP_RECORDER_CHUNK_SIZE,
+    HTTP_RECORDER_RECONNECT_SEC,
+    HTTP_RECORDER_TIMEOUT_SEC,
+    NATIVE_CAPTURE_EXTENSIONS,
+    RECORDER_LOG_LINES,
+    RECORDING_PATH,
+    SHARED_CAPTURE_FFMPEG_EXTENSIONS,
+)
+from stream_resolver import stream_url_cache
+from time_index import start_time_index
+
+# MPEG-TS packets, a recording joining a running capture starts at a packet
+TS_PACKET_SIZE = 188
+
+# running captures, key: (station, "native" or "ts")
+_captures = {}
+_captures_lock = threading.Lock()
+
+
+def get_capture_kind(filepath):
+    """capture kind ("native" or "ts") of a recording, None if it can not share one"""
+    if filepath is None:
+        return None
+    suffix = Path(filepath).suffix
+    if suffix in NATIVE_CAPTURE_EXTENSIONS:
+        return "native"
+    if suffix in SHARED_CAPTURE_FFMPEG_EXTENSIONS:
+        return "ts"
+    return None
+
+
+class StationCapture:
+    """one upstream connection of a station, fanned out to all its recordings
+
+    "native" captures read the http stream (ICY metadata stripped), "ts"
+    captures run one ffmpeg process that remuxes the stream to MPEG-TS on
+    stdout. Every chunk is written to all attached recordings, each of
+    them attaches at its own start and detaches at its own end. The
+    capture stops when the last recording has detached.
+    """
+
+    def __init__(self, key, url, station_id, kind):
+        self.key = key
+        self.url = url
+        self.station_id = station_id
+        self.kind = kind
+        self.recordings = []
+        self.process = None
+        self.log = deque(maxlen=RECORDER_LOG_LINES)
+        self._closed = False
+        self._lock = threading.Lock()
+        self.capture_thread = Thread(target=self.run)
+        self.capture_thread.daemon = True
+
+    def __repr__(self):
+        return f"Capture {self.key} - {len(self.recordings)} recordings"
+
+    def attach(self, recording):
+        """False if the capture is already shutting down"""
+        with self._lock:
+            if self._closed:
+                return False
+            self.recordings.append(recording)
+            return True
+
+    def detach(self, recording):
+        # after this no more data is written to the recording
+        with self._lock:
+            self.recordings.remove(recording)
+            if self.recordings:
+                return
+            self._closed = True
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+
+    def stop_recordings(self):
+        """end all attached recordings now, no new ones can attach"""
+        with self._lock:
+            self._closed = True
+            recordings = list(self.recordings)
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+        for recording in recordings:
+            # they detach themselves and finish with what they have written
+            recording._stop.set()
+
+    def dispatch(self, view):
+        with self._lock:
+            for recording in self.recordings:
+                recording.write(view)
+
+    def log_message(self, message):
+        print(f"[{self.key}] {message}")
+        self.log.append(message)
+        with self._lock:
+            for recording in self.recordings:
+                recording.log.append(message)
+
+    def run(self):
+        try:
+            while not self._closed:
+                try:
+                    if self.kind == "ts":
+                        self.capture_ffmpeg()
+                    else:
+                        self.capture_http()
+                except (OSError, http.client.HTTPException) as e:
+                    self.log_message(str(e))
+                    # the stream may have moved, resolve it again
+                    stream_url_cache.forget(self.url, self.station_id)
+                except Exception as e:
+                    # e.g. a malformed url, a reconnect would fail the same way
+                    self.log_message(f"Capture failed: {e!r}")
+                    self.stop_recordings()
+                    break
+                if not self._closed:
+                    # reconnect
+                    clock.sleep(HTTP_RECORDER_RECONNECT_SEC)
+        finally:
+            with _captures_lock:
+                if _captures.get(self.key) is self:
+                    del _captures[self.key]
+
+    def capture_http(self):
+        url = stream_url_cache.resolve(self.url, self.station_id)
+        request = urllib.request.Request(url, headers={"Icy-MetaData": "1"})
+        with urllib.request.urlopen(
+            request, timeout=HTTP_RECORDER_TIMEOUT_SEC
+        ) as response:
+            stripper = IcyMetadataStripper(
+                int(response.headers.get("icy-metaint") or 0),
+                on_metadata=self.log.append,
+            )
+            buffer = bytearray(HTTP_RECORDER_CHUNK_SIZE)
+            view = memoryview(buffer)
+
+            while not self._closed:
+                size = response.readinto1(buffer)
+                if not size:
+                    raise ConnectionError("Stream closed by server")
+                stripper.feed(view[:size], self.dispatch)
+
+    def capture_ffmpeg(self):
+        command = [
+            FFMPEG_BINARY,
+            "-loglevel",
+            "error",
+            "-i",
+            stream_url_cache.resolve(self.url, self.station_id),
+            "-codec",
+            "copy",
+            "-f",
+            "mpegts",
+            "pipe:1",
+        ]
+        with self._lock:
+            if self._closed:
+                return
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,
+            )
+        stderr_thread = Thread(target=self.stderr_handler, args=(self.process,))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+        # only whole packets are passed on, the rest stays in the buffer
+        chunk_size = (
+            HTTP_RECORDER_CHUNK_SIZE - HTTP_RECORDER_CHUNK_SIZE % TS_PACKET_SIZE
+        )
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        filled = 0
+        while size := self.process.stdout.readinto(view[filled:]):
+            filled += size
+            usable = filled - filled % TS_PACKET_SIZE
+            if usable:
+                self.dispatch(view[:usable])
+                buffer[: filled - usable] = buffer[usable:filled]
+                filled -= usable
+
+        self.process.wait()
+        stderr_thread.join()
+        if not self._closed:
+            raise ConnectionError(f"ffmpeg exited with {self.process.returncode}")
+
+    def stderr_handler(self, process):
+        for line in iter(process.stderr.readline, b""):
+            self.log_message(line.decode(errors="replace").strip())
+
+
+def attach_recording(recording, kind):
+    """attach to the running capture of the station, start one if needed"""
+    key = (recording.station_id or recording.url, kind)
+    with _captures_lock:
+        capture = _captures.get(key)
+        if capture is not None and capture.attach(recording):
+            return capture
+
+        capture = StationCapture(key, recording.url, recording.station_id, kind)
+        capture.attach(recording)
+        _captures[key] = capture
+    capture.capture_thread.start()
+    return capture
+
+
+def get_running_captures():
+    with _captures_lock:
+        return [capture for capture in _captures.values() if not capture._closed]
+
+
+class SharedStreamRecording(HTTPStreamRecording):
+    """recording that is written from the shared capture of its station
+
+    Overlapping recordings of the same station use a single connection
+    (and a single ffmpeg process for MPEG-TS) instead of one each.
+    Same API as FFMPEGStreamRecording.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kind = get_capture_kind(self.filename)
+        self.capture = None
+        self._file = None
+
+        if self.kind is None:
+            raise ScheduledRecordingException(
+                f"{self.filename} can not be recorded from a shared capture"
+            )
+
+    def __repr__(self):
+        return f"Shared Recording #{self.schedule_id} - {self.starttime} - {self.url}"
+
+    def do_recording(self):
+        self.active = True
+        print(f"{self.url=} {self.duration_min=}")
+        self.starttime = clock.now()
+        self._recording_path = Path(RECORDING_PATH, self.filename)
+        self.progress.index = start_time_index(self.filename)
+
+        with open(self._recording_path, "wb") as self._file:
+            self.capture = attach_recording(self, self.kind)
+            clock.wait(self._stop, self.duration_min * 60)
+            self.capture.detach(self)
+
+        self.end_recording()
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def write(self, data):
+        # called from the capture thread, errors must not stop the other recordings
+        if self._stop.is_set():
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            print(f"[#{self.schedule_id}] {e}")
+            self.log.append(str(e))
+            self._stop.set()
+            return
+        self.progress.total_size = self._file.tell()
+        self.update_progress()
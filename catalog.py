@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from threading import Thread
+
+from settings import CATALOG_SWEEP_SEC, RECORDING_PATH
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# writes of running recordings (IN_MODIFY) are not watched, their sizes
+# are known to the scheduler
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def open_inotify(path):
+    """inotify file descriptor watching path, None if not available"""
+    if not hasattr(os, "O_CLOEXEC"):
+        return None
+    library = ctypes.util.find_library("c")
+    if library is None:
+        return None
+
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK) < 0:
+        print(f"Cannot watch {path}: {os.strerror(ctypes.get_errno())}")
+        os.close(fd)
+        return None
+    return fd
+
+
+def iter_inotify_events(data):
+    # (mask, name) of the events in one read() from the inotify descriptor
+    position = 0
+    while position + INOTIFY_EVENT.size <= len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, position)
+        position += INOTIFY_EVENT.size
+        name = data[position : position + length].rstrip(b"\0")
+        position += length
+        yield mask, os.fsdecode(name)
+
+
+class RecordingCatalog:
+    """in-memory index of the files in RECORDING_PATH: name -> size
+
+    The directory is scanned once, then kept up to date with inotify
+    (Linux) or with sweeps every CATALOG_SWEEP_SEC that only rescan when
+    the directory has changed. Name collisions, sizes and orphaned files
+    are answered from memory.
+    """
+
+    def __init__(self, path=RECORDING_PATH):
+        self.path = path
+        self.uses_inotify = False
+        self._files = {}  # name: (size, mtime_ns)
+        self._reserved = set()  # names of recordings that are about to start
+        self._directory_mtime_ns = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Catalog {self.path}: {len(self._files)} files"
+
+    def __len__(self):
+        return len(self._files)
+
+    def scan(self):
+        files = {}
+        directory_mtime_ns = os.stat(self.path).st_mtime_ns
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # deleted during the scan
+                    continue
+
+        with self._lock:
+            self._files = files
+            self._directory_mtime_ns = directory_mtime_ns
+
+    def sweep(self):
+        """rescan if files were added, removed or renamed since the last scan
+
+        Changed sizes of existing files don't touch the directory mtime,
+        they are picked up with refresh_file.
+        """
+        try:
+            if os.stat(self.path).st_mtime_ns != self._directory_mtime_ns:
+                self.scan()
+        except OSError as e:
+            print(f"Catalog sweep failed: {e}")
+
+    def refresh_file(self, name):
+        """stat a single file, returns its size (0 if it doesn't exist)"""
+        try:
+            stat = os.stat(Path(self.path, name))
+        except (OSError, TypeError):
+            with self._lock:
+                self._files.pop(name, None)
+            return 0
+
+        with self._lock:
+            self._files[name] = (stat.st_size, stat.st_mtime_ns)
+        return stat.st_size
+
+    def exists(self, name):
+        with self._lock:
+            return name in self._files or name in self._reserved
+
+    def unique_filename(self, name):
+        """name, or name_1, name_2... if a file with the name already exists"""
+        path = Path(name)
+        counter = 1
+        with self._lock:
+            while name in self._files or name in self._reserved:
+                name = str(path.with_name(f"{path.stem}_{counter}{path.suffix}"))
+                counter += 1
+        return name
+
+    def reserve(self, name):
+        # keeps two recordings starting together from choosing the same name
+        with self._lock:
+            self._reserved.add(name)
+
+    def release(self, name):
+        with self._lock:
+            self._reserved.discard(name)
+
+    def get_orphans(self, known_filepaths):
+        """files that no schedule item refers to"""
+        known_filepaths = set(known_filepaths)
+        with self._lock:
+            return sorted(name for name in self._files if name not in known_filepaths)
+
+    def reconcile(self, schedule_files):
+        """{schedule_id: (filepath, filesize)} for rows that disagree with the disk
+
+        schedule_files are rows of finished recordings with schedule_id,
+        filepath and filesize. Missing files get size 0.
+        """
+        repairs = {}
+        with self._lock:
+            for row in schedule_files:
+                entry = self._files.get(row["filepath"])
+                filesize = 0 if entry is None else entry[0]
+                if filesize != row["filesize"]:
+                    repairs[row["schedule_id"]] = (row["filepath"], filesize)
+        return repairs
+
+    def handle_event(self, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost
+            self.scan()
+        elif mask & IN_ISDIR:
+            return
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            with self._lock:
+                self._files.pop(name, None)
+        elif mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.refresh_file(name)
+
+    def watch(self, fd):
+        try:
+            while True:
+                data = os.read(fd, 64 * 1024)
+                for mask, name in iter_inotify_events(data):
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        raise OSError(f"{self.path} was removed or moved")
+                    self.handle_event(mask, name)
+        except OSError as e:
+            print(f"Catalog watch stopped: {e}")
+        finally:
+            os.close(fd)
+
+        # fall back to sweeps
+        self.uses_inotify = False
+        self.run_sweeps()
+
+    def run_sweeps(self):
+        while True:
+            time.sleep(CATALOG_SWEEP_SEC)
+            self.sweep()
+
+    def start(self):
+        """scan the directory, then follow the changes in a background thread"""
+        # watch first, so no change between the scan and the watch is missed
+        fd = open_inotify(self.path)
+        self.scan()
+        self.uses_inotify = fd is not None
+        if fd is not None:
+            watch_thread = Thread(target=self.watch, args=(fd,))
+        else:
+            watch_thread = Thread(target=self.run_sweeps)
+        watch_thread.daemon = True
+        watch_thread.start()
+        return watch_thread
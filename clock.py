@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import time
+
+
+class SystemClock:
+    """wall clock time, sleeps and waits block"""
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+
+class VirtualClock:
+    """simulated time, sleeping and waiting advance it without blocking
+
+    Callbacks registered with call_at run when the time passes them, e.g.
+    the end of a simulated recording. Meant to be driven from one thread.
+    """
+
+    def __init__(self, start):
+        self._now = float(start)
+        self._timers = []  # (when, sequence, callback)
+        self._sequence = itertools.count()
+
+    def now(self):
+        return self._now
+
+    def call_at(self, when, callback):
+        heapq.heappush(self._timers, (when, next(self._sequence), callback))
+
+    def next_timer(self):
+        return self._timers[0][0] if self._timers else None
+
+    def sleep(self, seconds):
+        self._advance(self._now + max(0, seconds))
+
+    def wait(self, event, timeout):
+        """like event.wait, returns as soon as a callback has set the event"""
+        self._advance(self._now + max(0, timeout), event)
+        return event.is_set()
+
+    def _advance(self, deadline, event=None):
+        while self._timers and self._timers[0][0] <= deadline:
+            if event is not None and event.is_set():
+                return
+            when, _, callback = heapq.heappop(self._timers)
+            self._now = max(self._now, when)
+            callback()
+        if event is None or not event.is_set():
+            self._now = max(self._now, deadline)
+
+
+_clock = SystemClock()
+
+
+def set_clock(clock):
+    """use clock for all time lookups, returns the previous clock"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def get_clock():
+    return _clock
+
+
+def now():
+    """unix epoch of the current clock, time.time() unless simulated"""
+    return _clock.now()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def wait(event, timeout):
+    return _clock.wait(event, timeout)
@@ -1,11 +1,27 @@
 import datetime
+import itertools
 import os
 import re
 import sqlite3
+import threading
 from contextlib import contextmanager
 from pathlib import Path
 
-from settings import DATABASE_NAME, RECORDING_PATH
+import clock
+import metrics
+from recurrence import RecurrenceRule, RecurrenceRuleException
+from settings import (
+    DATABASE_BUSY_TIMEOUT_MS,
+    DATABASE_CACHE_SIZE_KB,
+    DATABASE_NAME,
+    DATABASE_POOL_SIZE,
+    DATABASE_SYNCHRONOUS,
+    FILESIZE_FLUSH_INTERVAL_SEC,
+    RECORDING_PATH,
+    POSTPROCESS_JOBS,
+    RECURRENCE_MATERIALIZE_COUNT,
+    TRIM_TO_WINDOW,
+)
 
 # Global variable for the database name
 
@@ -14,56 +30,390 @@ class DatabaseException(Exception):
     pass
 
 
-class NothingScheduled(Exception):
+class ScheduledItemNotFound(Exception):
     pass
 
 
-class ScheduledItemNotFound(Exception):
-    pass
+# schedule.state values
+STATE_SCHEDULED = 0
+STATE_ACTIVE = 1
+STATE_COMPLETED = 2
+STATE_ABORTED = 3
+STATE_PRUNED = 4  # completed or aborted, file removed by the retention rules
+
+# postprocess_jobs.state values
+JOB_QUEUED = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_FAILED = 3
+
+# jobs queued for every completed recording, trimming comes first
+POSTPROCESS_JOB_TYPES = ("trim",) * bool(TRIM_TO_WINDOW) + tuple(POSTPROCESS_JOBS)
+
+# schedule rows expose the epoch start time as local time text for display
+SCHEDULE_STARTTIME = (
+    "datetime(schedule.start_epoch, 'unixepoch', 'localtime') AS starttime"
+)
+
+
+# Latency of the database calls (per process), exported on /metrics
+DATABASE_CALL_SECONDS = metrics.histogram(
+    "pywrr_database_call_seconds", "Duration of database.py calls"
+)
+
+
+def _timed_call(function):
+    """observes the duration of a function that queries the database"""
+    return DATABASE_CALL_SECONDS.time(call=function.__name__)(function)
+
+
+# Idle connections, shared by all threads of the process
+_pool = {}  # readonly -> [connections]
+_pool_pid = None
+_pool_lock = threading.Lock()
+# connections in use by the thread, nested get_cursor calls share them
+_held = threading.local()
+
+
+def _connect(readonly):
+    # pooled connections move between threads, one thread uses them at a time
+    if readonly:
+        # read-only path for the web views, can never block the scheduler's writes
+        conn = sqlite3.connect(
+            f"{Path(DATABASE_NAME).resolve().as_uri()}?mode=ro",
+            uri=True,
+            timeout=DATABASE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+        )
+    else:
+        # Connect to the database (create if it doesn't exist)
+        conn = sqlite3.connect(
+            DATABASE_NAME,
+            timeout=DATABASE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+        )
+        # WAL lets the web app read while the scheduler writes (persistent setting)
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    conn.execute(f"PRAGMA synchronous = {DATABASE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {int(DATABASE_BUSY_TIMEOUT_MS)}")
+    # negative value: cache size in KiB instead of pages
+    conn.execute(f"PRAGMA cache_size = -{int(DATABASE_CACHE_SIZE_KB)}")
+    return conn
+
+
+def _acquire_connection(readonly):
+    global _pool_pid
+    with _pool_lock:
+        # connections must not be shared with a forked child process
+        if _pool_pid != os.getpid():
+            _pool_pid = os.getpid()
+            _pool.clear()
+        idle = _pool.setdefault(readonly, [])
+        if idle:
+            return idle.pop()
+    return _connect(readonly)
+
+
+def _release_connection(readonly, conn):
+    with _pool_lock:
+        idle = _pool.setdefault(readonly, [])
+        if _pool_pid == os.getpid() and len(idle) < DATABASE_POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+@contextmanager
+def get_connection(readonly=False):
+    """a connection from the pool, returned to it afterwards"""
+    held = _held.__dict__.setdefault("by_mode", {})
+    if readonly in held:
+        yield held[readonly]
+        return
+
+    conn = _acquire_connection(readonly)
+    held[readonly] = conn
+    try:
+        yield conn
+    finally:
+        del held[readonly]
+        _release_connection(readonly, conn)
 
 
 # Reusable cursor function
 @contextmanager
-def get_cursor(commit=True):
-    # Connect to the database (create if it doesn't exist)
-    conn = sqlite3.connect(DATABASE_NAME)
-    # Create a cursor object to interact with the database
-    cursor = conn.cursor()
-    yield cursor
-    if commit:
-        conn.commit()
-    conn.close()
+def get_cursor(commit=True, readonly=False):
+    with get_connection(readonly=readonly) as conn:
+        # Create a cursor object to interact with the database
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            if commit and not readonly:
+                conn.commit()
+            else:
+                # end the read transaction, the connection stays open
+                conn.rollback()
+        finally:
+            cursor.close()
+
+
+def get_database_change_token():
+    # cheap change detection for writes from other processes (e.g. the web app):
+    # stat the database files instead of running a query. In WAL mode
+    # commits go to the -wal file, the main file only changes on checkpoints.
+    token = []
+    for path in (DATABASE_NAME, f"{DATABASE_NAME}-wal"):
+        try:
+            stat = os.stat(path)
+            token.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            token.append(None)
+    return tuple(token)
+
+
+def starttime_to_epoch(starttime):
+    """datetime, iso string ("2023-06-18 20:00[:00[.123]]") or number -> unix epoch"""
+    if isinstance(starttime, (int, float)):
+        return int(starttime)
+    if isinstance(starttime, str):
+        starttime = datetime.datetime.fromisoformat(starttime.strip())
+    if isinstance(starttime, datetime.datetime):
+        return int(starttime.timestamp())
+    raise ValueError(f"Invalid starttime {starttime!r}")
+
+
+def _migration_create_tables(cursor):
+    # Create the "stations" table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS stations (
+                        station_id TEXT(10) PRIMARY KEY,
+                        station_name TEXT,
+                        station_url TEXT,
+                        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+    )
+
+    # Create the "schedule" table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS schedule (
+                        schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        station_id TEXT(10),
+                        starttime DATETIME,
+                        runtime INTEGER,
+                        repeat_rule TEXT,
+                        active INTEGER DEFAULT 0,
+                        completed INTEGER DEFAULT 0,
+                        aborted INTEGER DEFAULT 0,
+                        filepath TEXT,
+                        filesize INTEGER DEFAULT 0,
+                        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (station_id) REFERENCES stations(station_id))"""
+    )
+
+
+def _migration_schedule_epoch_and_state(cursor):
+    # Rebuild "schedule" with an integer start_epoch instead of the free-form
+    # starttime text and a single state column instead of three flags
+    cursor.execute(
+        """CREATE TABLE schedule_new (
+                        schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        station_id TEXT(10),
+                        start_epoch INTEGER NOT NULL,
+                        runtime INTEGER,
+                        repeat_rule TEXT,
+                        state INTEGER NOT NULL DEFAULT 0,
+                        filepath TEXT,
+                        filesize INTEGER DEFAULT 0,
+                        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (station_id) REFERENCES stations(station_id))"""
+    )
+
+    cursor.execute(
+        """SELECT schedule_id, station_id, starttime, runtime, repeat_rule,
+                  active, completed, aborted, filepath, filesize, created
+           FROM schedule"""
+    )
+    rows = []
+    for row in cursor.fetchall():
+        schedule_id, station_id, starttime, runtime, repeat_rule = row[:5]
+        active, completed, aborted, filepath, filesize, created = row[5:]
 
+        if completed == 1:
+            state = STATE_COMPLETED
+        elif aborted == 1:
+            state = STATE_ABORTED
+        elif active == 1:
+            state = STATE_ACTIVE
+        else:
+            state = STATE_SCHEDULED
+
+        try:
+            start_epoch = starttime_to_epoch(starttime)
+        except (TypeError, ValueError):
+            # unreadable start time - keep the row, but never start it
+            start_epoch = 0
+            if state == STATE_SCHEDULED:
+                state = STATE_ABORTED
+
+        rows.append(
+            (
+                schedule_id,
+                station_id,
+                start_epoch,
+                runtime,
+                repeat_rule,
+                state,
+                filepath,
+                filesize,
+                created,
+            )
+        )
 
+    cursor.executemany(
+        """INSERT INTO schedule_new (schedule_id, station_id, start_epoch, runtime,
+                  repeat_rule, state, filepath, filesize, created)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows,
+    )
+    cursor.execute("DROP TABLE schedule")
+    cursor.execute("ALTER TABLE schedule_new RENAME TO schedule")
+
+
+def _migration_schedule_indexes(cursor):
+    # scheduler queue, claiming due items and the event lists
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS schedule_state_start ON schedule (state, start_epoch)"
+    )
+    # duplicate check in add_schedule_item and future items of a station
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS schedule_station_start ON schedule (station_id, start_epoch)"
+    )
+
+
+def _migration_schedule_filepath_index(cursor):
+    # archive downloads look up the recording by its file
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS schedule_filepath ON schedule (filepath)"
+    )
+
+
+def _migration_recurrences(cursor):
+    # Recurring recordings, expanded into schedule items by materialize_recurrences
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS recurrences (
+                        recurrence_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        station_id TEXT(10),
+                        dtstart_epoch INTEGER NOT NULL,
+                        runtime INTEGER,
+                        repeat_rule TEXT NOT NULL,
+                        last_epoch INTEGER,
+                        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (station_id) REFERENCES stations(station_id))"""
+    )
+    cursor.execute(
+        "ALTER TABLE schedule ADD COLUMN recurrence_id INTEGER REFERENCES recurrences(recurrence_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS schedule_recurrence_state ON schedule (recurrence_id, state)"
+    )
+
+
+def _migration_schedule_window_offsets(cursor):
+    # Where the nominal start/end lie in a recording with pre/post roll
+    for column in [
+        "window_start_byte",
+        "window_start_us",
+        "window_end_byte",
+        "window_end_us",
+    ]:
+        cursor.execute(f"ALTER TABLE schedule ADD COLUMN {column} INTEGER")
+
+
+def _migration_station_bitrate(cursor):
+    # Measured bitrate of the station, used to project recording sizes
+    cursor.execute("ALTER TABLE stations ADD COLUMN bitrate_kbps REAL")
+
+
+def _migration_postprocess_jobs(cursor):
+    # Post-processing of completed recordings, worked through by postprocess.py
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS postprocess_jobs (
+                        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        schedule_id INTEGER NOT NULL,
+                        job_type TEXT NOT NULL,
+                        state INTEGER NOT NULL DEFAULT 0,
+                        output_filepath TEXT,
+                        message TEXT,
+                        created_epoch INTEGER,
+                        started_epoch INTEGER,
+                        finished_epoch INTEGER,
+                        FOREIGN KEY (schedule_id) REFERENCES schedule(schedule_id))"""
+    )
+    # claiming the next jobs, and the jobs of a recording in order
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS postprocess_jobs_state ON postprocess_jobs (state, job_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS postprocess_jobs_schedule ON postprocess_jobs (schedule_id, job_id)"
+    )
+
+
+def _migration_quality_reports(cursor):
+    # Stalls seen by the recorder and the silence analysis of the "quality" job
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS quality_reports (
+                        schedule_id INTEGER PRIMARY KEY,
+                        stall_count INTEGER,
+                        longest_stall_sec REAL,
+                        duration_sec REAL,
+                        average_kbps REAL,
+                        rms_dbfs REAL,
+                        gap_count INTEGER,
+                        longest_gap_sec REAL,
+                        silence_sec REAL,
+                        analyzed_epoch INTEGER,
+                        FOREIGN KEY (schedule_id) REFERENCES schedule(schedule_id))"""
+    )
+
+
+# Schema migrations, applied in order. The number of applied migrations is
+# stored in "PRAGMA user_version". Only ever append to this list.
+MIGRATIONS = [
+    _migration_create_tables,
+    _migration_schedule_epoch_and_state,
+    _migration_schedule_indexes,
+    _migration_schedule_filepath_index,
+    _migration_recurrences,
+    _migration_schedule_window_offsets,
+    _migration_station_bitrate,
+    _migration_postprocess_jobs,
+    _migration_quality_reports,
+]
+
+
+@_timed_call
 def setup_database_tables():
     with get_cursor() as cursor:
-        # Create the "stations" table
-        cursor.execute(
-            """CREATE TABLE IF NOT EXISTS stations (
-                            station_id TEXT(10) PRIMARY KEY,
-                            station_name TEXT,
-                            station_url TEXT,
-                            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
-        )
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] >= len(MIGRATIONS):
+            return
 
-        # Create the "schedule" table
-        cursor.execute(
-            """CREATE TABLE IF NOT EXISTS schedule (
-                            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            station_id TEXT(10),
-                            starttime DATETIME,
-                            runtime INTEGER,
-                            repeat_rule TEXT,
-                            active INTEGER DEFAULT 0,
-                            completed INTEGER DEFAULT 0,
-                            aborted INTEGER DEFAULT 0,
-                            filepath TEXT,
-                            filesize INTEGER DEFAULT 0,
-                            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            FOREIGN KEY (station_id) REFERENCES stations(station_id))"""
-        )
+        # Lock the database, so the web app and the scheduler don't both migrate
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Database migration {number}: {migration.__name__}")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
 
 
+@_timed_call
 def add_station(station_id, station_name, station_url):
     with get_cursor(commit=True) as cursor:
         # Check if the station already exists
@@ -86,16 +436,22 @@ def add_station(station_id, station_name, station_url):
             )
 
 
+@_timed_call
 def delete_station(station_id):
     with get_cursor(commit=True) as cursor:
         # Check if there are any future scheduled recordings for the station
-        current_datetime = datetime.datetime.utcnow()
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE station_id = ? AND starttime > ?",
-            (station_id, current_datetime),
+            "SELECT COUNT(*) FROM schedule WHERE station_id = ? AND start_epoch > ?",
+            (station_id, int(clock.now())),
         )
         count = cursor.fetchone()[0]
 
+        # recurring recordings of the station count as future recordings
+        cursor.execute(
+            "SELECT COUNT(*) FROM recurrences WHERE station_id = ?", (station_id,)
+        )
+        count += cursor.fetchone()[0]
+
         if count > 0:
             raise ValueError(
                 "Cannot delete the station. There are still future scheduled recordings."
@@ -105,8 +461,9 @@ def delete_station(station_id):
         cursor.execute("DELETE FROM stations WHERE station_id = ?", (station_id,))
 
 
+@_timed_call
 def get_all_stations():
-    with get_cursor() as cursor:
+    with get_cursor(readonly=True) as cursor:
         # Retrieve all stations from the table
         cursor.execute("SELECT * FROM stations")
         stations = cursor.fetchall()
@@ -126,30 +483,49 @@ def get_all_stations():
         return station_list
 
 
-def add_schedule_item(station_id, starttime, runtime, filepath=None, repeat_rule=None):
+@_timed_call
+def update_station_bitrate(station_id, bitrate_kbps):
+    with get_cursor() as cursor:
+        cursor.execute(
+            "UPDATE stations SET bitrate_kbps = ? WHERE station_id = ?",
+            (bitrate_kbps, station_id),
+        )
 
-    if isinstance(starttime, datetime.datetime):
-        if starttime < datetime.datetime.now():
-            starttime = datetime.datetime.now()
-    else:
-        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if starttime < now_str:
-            starttime = now_str
+
+def default_filepath(station_id, start_epoch):
+    starttime = datetime.datetime.fromtimestamp(start_epoch)
+    filepath = f"{station_id} {starttime:%Y-%m-%d %H-%M-%S}.ts"
 
     # filter forbidden chars from filepath
-    def filter_filename(filename):
-        forbidden_chars = r'[<>:"/\\|?*]'
-        return re.sub(forbidden_chars, "_", filename)
+    forbidden_chars = r'[<>:"/\\|?*]'
+    return re.sub(forbidden_chars, "_", filepath)
+
+
+@_timed_call
+def add_schedule_item(station_id, starttime, runtime, filepath=None, repeat_rule=None):
+    try:
+        requested_epoch = starttime_to_epoch(starttime)
+        start_epoch = max(requested_epoch, int(clock.now()))
+    except (TypeError, ValueError):
+        raise DatabaseException(f"Invalid start time '{starttime}'.")
+
+    try:
+        runtime = int(runtime)
+    except (TypeError, ValueError):
+        raise DatabaseException(f"Invalid runtime '{runtime}'.")
+
+    if repeat_rule:
+        try:
+            RecurrenceRule(repeat_rule)
+        except RecurrenceRuleException as e:
+            raise DatabaseException(str(e))
 
     if filepath is None:
-        if isinstance(starttime, datetime.datetime):
-            filepath = f"{station_id} {starttime:%Y-%m-%d %H-%M-%S}.ts"
-        else:
-            filepath = f"{station_id} {starttime}.ts"
-        filepath = filter_filename(filepath)
+        filepath = default_filepath(station_id, start_epoch)
 
-    with get_cursor() as cursor:
+    recurrence_id = None
 
+    with get_cursor() as cursor:
         # Check if the station exists
         cursor.execute(
             "SELECT COUNT(*) FROM stations WHERE station_id = ?", (station_id,)
@@ -159,88 +535,240 @@ def add_schedule_item(station_id, starttime, runtime, filepath=None, repeat_rule
         if count == 0:
             raise DatabaseException(f"Station '{station_id}' does not exist.")
 
-        # Check if an entry already exists for the station and starttime
-        cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE station_id = ? AND starttime = ?",
-            (station_id, starttime),
-        )
-        count = cursor.fetchone()[0]
-
-        if count == 0:
-            # Entry doesn't exist, insert a new record
+        if repeat_rule:
+            # Recurring recording: only the rule is stored here, the schedule
+            # items are created by materialize_recurrences
             cursor.execute(
-                "INSERT INTO schedule (station_id, starttime, runtime, repeat_rule, filepath) VALUES (?, ?, ?, ?, ?)",
-                (station_id, starttime, runtime, repeat_rule, filepath),
+                """INSERT INTO recurrences (station_id, dtstart_epoch, runtime, repeat_rule)
+                              VALUES (?, ?, ?, ?) RETURNING recurrence_id""",
+                (station_id, requested_epoch, runtime, repeat_rule),
             )
+            recurrence_id = cursor.fetchone()[0]
         else:
-            # Entry exists, update the record
+            # Check if an entry already exists for the station and starttime
             cursor.execute(
-                "UPDATE schedule SET runtime = ?, repeat_rule = ?, filepath = ? WHERE station_id = ? AND starttime = ?",
-                (runtime, repeat_rule, filepath, station_id, starttime),
+                "SELECT COUNT(*) FROM schedule WHERE station_id = ? AND start_epoch = ?",
+                (station_id, start_epoch),
             )
+            count = cursor.fetchone()[0]
+
+            if count == 0:
+                # Entry doesn't exist, insert a new record
+                cursor.execute(
+                    "INSERT INTO schedule (station_id, start_epoch, runtime, repeat_rule, filepath) VALUES (?, ?, ?, ?, ?)",
+                    (station_id, start_epoch, runtime, repeat_rule, filepath),
+                )
+            else:
+                # Entry exists, update the record
+                cursor.execute(
+                    "UPDATE schedule SET runtime = ?, repeat_rule = ?, filepath = ? WHERE station_id = ? AND start_epoch = ?",
+                    (runtime, repeat_rule, filepath, station_id, start_epoch),
+                )
+
+    if recurrence_id is not None:
+        materialize_recurrences([recurrence_id])
+
+
+@_timed_call
+def materialize_recurrences(recurrence_ids=None, now=None):
+    """create the next RECURRENCE_MATERIALIZE_COUNT schedule items of recurring recordings
+
+    Only recurrences with fewer scheduled items than that are expanded, starting
+    after the last materialized occurrence. Occurrences missed while the
+    scheduler wasn't running are skipped.
+    """
+    now = int(clock.now() if now is None else now)
 
+    with get_cursor() as cursor:
+        query = """SELECT recurrence_id, station_id, dtstart_epoch, runtime, repeat_rule, last_epoch,
+                   (SELECT COUNT(*) FROM schedule
+                    WHERE schedule.recurrence_id = recurrences.recurrence_id AND state = ?)
+                   FROM recurrences"""
+        parameters = [STATE_SCHEDULED]
+        if recurrence_ids is not None:
+            if not recurrence_ids:
+                return
+            placeholders = ", ".join("?" * len(recurrence_ids))
+            query += f" WHERE recurrence_id IN ({placeholders})"
+            parameters += list(recurrence_ids)
+        cursor.execute(query, parameters)
+
+        for row in cursor.fetchall():
+            recurrence_id, station_id, dtstart_epoch, runtime, repeat_rule = row[:5]
+            last_epoch, pending = row[5:]
+
+            missing = RECURRENCE_MATERIALIZE_COUNT - pending
+            if missing <= 0:
+                continue
+
+            after = max(last_epoch or dtstart_epoch - 1, now - 1)
+            occurrences = RecurrenceRule(repeat_rule).iter_occurrences(
+                datetime.datetime.fromtimestamp(dtstart_epoch),
+                after=datetime.datetime.fromtimestamp(after),
+            )
+            for occurrence in itertools.islice(occurrences, missing):
+                start_epoch = int(occurrence.timestamp())
+                # Insert unless there already is a recording of the station at that time
+                cursor.execute(
+                    """INSERT INTO schedule (station_id, start_epoch, runtime, repeat_rule, filepath, recurrence_id)
+                              SELECT ?, ?, ?, ?, ?, ?
+                              WHERE NOT EXISTS (SELECT 1 FROM schedule WHERE station_id = ? AND start_epoch = ?)""",
+                    (
+                        station_id,
+                        start_epoch,
+                        runtime,
+                        repeat_rule,
+                        default_filepath(station_id, start_epoch),
+                        recurrence_id,
+                        station_id,
+                        start_epoch,
+                    ),
+                )
+                last_epoch = start_epoch
 
-def delete_scheduled_event(schedule_id):
+            cursor.execute(
+                "UPDATE recurrences SET last_epoch = ? WHERE recurrence_id = ?",
+                (last_epoch, recurrence_id),
+            )
+
+
+@_timed_call
+def roll_recurrences_forward(schedule_ids):
+    """materialize the next occurrences of the recurrences of finished schedule items"""
+    with get_cursor(readonly=True) as cursor:
+        placeholders = ", ".join("?" * len(schedule_ids))
+        cursor.execute(
+            f"""SELECT DISTINCT recurrence_id FROM schedule
+                          WHERE schedule_id IN ({placeholders}) AND recurrence_id IS NOT NULL""",
+            list(schedule_ids),
+        )
+        recurrence_ids = [row[0] for row in cursor.fetchall()]
+
+    materialize_recurrences(recurrence_ids)
+
+
+@_timed_call
+def delete_recurrence(recurrence_id):
     with get_cursor() as cursor:
-        # Check if the schedule item exists
+        # Delete the recurrence and its items that haven't started yet
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "DELETE FROM recurrences WHERE recurrence_id = ?", (recurrence_id,)
         )
-        count = cursor.fetchone()[0]
 
-        if count == 0:
-            raise DatabaseException("Schedule item does not exist.")
+        if cursor.rowcount == 0:
+            raise DatabaseException("Recurrence does not exist.")
 
-        # Check if the schedule item is active
         cursor.execute(
-            "SELECT active FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "DELETE FROM schedule WHERE recurrence_id = ? AND state = ?",
+            (recurrence_id, STATE_SCHEDULED),
         )
-        active = cursor.fetchone()[0]
 
-        if active == 1:
-            raise DatabaseException("Cannot delete active schedule item.")
 
-        # Check if the schedule item is completed
+@_timed_call
+def delete_scheduled_event(schedule_id):
+    with get_cursor() as cursor:
+        # Delete the schedule item unless it is active or completed
         cursor.execute(
-            "SELECT completed FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "DELETE FROM schedule WHERE schedule_id = ? AND state IN (?, ?)",
+            (schedule_id, STATE_SCHEDULED, STATE_ABORTED),
         )
-        completed = cursor.fetchone()[0]
 
-        if completed == 1:
+        if cursor.rowcount == 0:
+            if _get_schedule_item_state(cursor, schedule_id) == STATE_ACTIVE:
+                raise DatabaseException("Cannot delete active schedule item.")
             raise DatabaseException(
                 "Cannot delete schedule item. It is already completed."
             )
 
-        # Delete the specified schedule item from the table
-        cursor.execute("DELETE FROM schedule WHERE schedule_id = ?", (schedule_id,))
 
+@_timed_call
+def claim_due_schedule_items(now=None):
+    if now is None:
+        now = clock.now()
 
-def get_next_schedule_item():
     with get_cursor() as cursor:
-        # Retrieve the next schedule item that is not active, not completed, and not aborted
+        # Due items of deleted stations can never start, abort them in the same
+        # transaction instead of loading them into the scheduler again and again
         cursor.execute(
-            "SELECT * FROM schedule WHERE active = 0 AND completed = 0 AND aborted = 0 ORDER BY starttime LIMIT 1"
+            """UPDATE schedule SET state = ?
+                          WHERE state = ? AND start_epoch <= ?
+                          AND station_id NOT IN (SELECT station_id FROM stations)""",
+            (STATE_ABORTED, STATE_SCHEDULED, starttime_to_epoch(now)),
         )
-        schedule_item = cursor.fetchone()
+        if cursor.rowcount:
+            print(f"Aborted {cursor.rowcount} due schedule items of deleted stations")
 
-        if schedule_item is None:
-            raise NothingScheduled("No schedule item found.")
+        # Activate every overdue schedule item in a single statement, so
+        # simultaneous starts are claimed in one transaction
+        cursor.execute(
+            """UPDATE schedule SET state = ?
+                          WHERE state = ? AND start_epoch <= ?
+                          RETURNING schedule_id""",
+            (STATE_ACTIVE, STATE_SCHEDULED, starttime_to_epoch(now)),
+        )
+        schedule_ids = [row[0] for row in cursor.fetchall()]
+
+        if not schedule_ids:
+            return []
+
+        # Retrieve the claimed schedule items with their station information
+        placeholders = ", ".join("?" * len(schedule_ids))
+        cursor.execute(
+            f"""SELECT schedule.*, {SCHEDULE_STARTTIME},
+                          stations.station_name, stations.station_url
+                          FROM schedule
+                          INNER JOIN stations ON schedule.station_id = stations.station_id
+                          WHERE schedule.schedule_id IN ({placeholders})
+                          ORDER BY schedule.start_epoch""",
+            schedule_ids,
+        )
+        schedule_items = cursor.fetchall()
 
         # Get the column names from the cursor description
         column_names = [column[0] for column in cursor.description]
 
-        # Create a dictionary using column names as keys and schedule item values as values
-        schedule_dict = {
-            column_names[i]: value for i, value in enumerate(schedule_item)
-        }
-        return schedule_dict
+        # Create a list of dictionaries, where each dictionary represents a schedule item
+        schedule_list = []
+        for schedule_item in schedule_items:
+            schedule_dict = {
+                column_names[i]: value for i, value in enumerate(schedule_item)
+            }
+            schedule_list.append(schedule_dict)
+
+        return schedule_list
+
 
+@_timed_call
+def get_interrupted_schedule_items():
+    """items left active by a scheduler that was stopped or crashed"""
+    with get_cursor(readonly=True) as cursor:
+        cursor.execute(
+            f"""SELECT schedule.*, {SCHEDULE_STARTTIME},
+                          stations.station_name, stations.station_url
+                          FROM schedule
+                          LEFT JOIN stations ON schedule.station_id = stations.station_id
+                          WHERE schedule.state = ?
+                          ORDER BY schedule.start_epoch""",
+            (STATE_ACTIVE,),
+        )
+        schedule_items = cursor.fetchall()
+
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
 
+        return [
+            {column_names[i]: value for i, value in enumerate(schedule_item)}
+            for schedule_item in schedule_items
+        ]
+
+
+@_timed_call
 def get_schedule_item(schedule_id):
-    with get_cursor() as cursor:
+    with get_cursor(readonly=True) as cursor:
         # Retrieve the schedule item with its station information
         cursor.execute(
-            """SELECT schedule.*, stations.station_name, stations.station_url
+            f"""SELECT schedule.*, {SCHEDULE_STARTTIME},
+                          stations.station_name, stations.station_url
                           FROM schedule
                           INNER JOIN stations ON schedule.station_id = stations.station_id
                           WHERE schedule.schedule_id = ?""",
@@ -262,178 +790,524 @@ def get_schedule_item(schedule_id):
         return schedule_dict
 
 
-def activate_schedule_item(schedule_id):
-    with get_cursor() as cursor:
-        # Check if the schedule item exists
+@_timed_call
+def get_schedule_item_by_filepath(filepath):
+    with get_cursor(readonly=True) as cursor:
+        # Retrieve the newest schedule item recorded to the file
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            f"""SELECT schedule.*, {SCHEDULE_STARTTIME} FROM schedule
+                          WHERE filepath = ? ORDER BY schedule_id DESC LIMIT 1""",
+            (filepath,),
         )
-        count = cursor.fetchone()[0]
+        schedule_item = cursor.fetchone()
+
+        if schedule_item is None:
+            raise ScheduledItemNotFound(f"No schedule item for file {filepath}.")
+
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
+
+        # Create a dictionary using column names as keys and schedule item values as values
+        schedule_dict = {
+            column_names[i]: value for i, value in enumerate(schedule_item)
+        }
+
+        return schedule_dict
+
+
+def _get_schedule_item_state(cursor, schedule_id):
+    # Only used to explain why a conditional update did not match
+    cursor.execute("SELECT state FROM schedule WHERE schedule_id = ?", (schedule_id,))
+    result = cursor.fetchone()
+
+    if result is None:
+        raise DatabaseException("Schedule item does not exist.")
+
+    return result[0]
 
-        if count == 0:
-            raise DatabaseException("Schedule item does not exist.")
 
-        # Check if the schedule item is already active, completed, or aborted
+@_timed_call
+def activate_schedule_item(schedule_id):
+    with get_cursor() as cursor:
+        # Activate the schedule item if it is not active, completed, or aborted
         cursor.execute(
-            "SELECT active, completed, aborted FROM schedule WHERE schedule_id = ?",
-            (schedule_id,),
+            "UPDATE schedule SET state = ? WHERE schedule_id = ? AND state = ?",
+            (STATE_ACTIVE, schedule_id, STATE_SCHEDULED),
         )
-        result = cursor.fetchone()
-        active, completed, aborted = result
 
-        if active == 1 or completed == 1 or aborted == 1:
+        if cursor.rowcount == 0:
+            _get_schedule_item_state(cursor, schedule_id)
             raise DatabaseException(
                 "Cannot activate schedule item. It is already active, completed, or aborted."
             )
 
-        # Update the active field of the specified schedule item
+
+@_timed_call
+def complete_schedule_item(schedule_id):
+    with get_cursor() as cursor:
+        # Complete the schedule item if it is active
         cursor.execute(
-            "UPDATE schedule SET active = 1 WHERE schedule_id = ?", (schedule_id,)
+            "UPDATE schedule SET state = ? WHERE schedule_id = ? AND state = ?",
+            (STATE_COMPLETED, schedule_id, STATE_ACTIVE),
         )
 
+        if cursor.rowcount == 0:
+            _get_schedule_item_state(cursor, schedule_id)
+            raise DatabaseException("Cannot complete schedule item. It is not active.")
+
+        _add_postprocess_jobs(cursor, [schedule_id])
 
-def complete_schedule_item(schedule_id):
+
+@_timed_call
+def complete_schedule_items(schedule_ids):
+    """complete many active schedule items in one transaction, returns the completed ids"""
     with get_cursor() as cursor:
-        # Check if the schedule item exists
+        placeholders = ", ".join("?" * len(schedule_ids))
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            f"""UPDATE schedule SET state = ?
+                          WHERE state = ? AND schedule_id IN ({placeholders})
+                          RETURNING schedule_id""",
+            [STATE_COMPLETED, STATE_ACTIVE, *schedule_ids],
         )
-        count = cursor.fetchone()[0]
+        completed = [row[0] for row in cursor.fetchall()]
+        _add_postprocess_jobs(cursor, completed)
+        return completed
 
-        if count == 0:
-            raise DatabaseException("Schedule item does not exist.")
 
-        # Check if the schedule item is active
+@_timed_call
+def abort_schedule_item(schedule_id):
+    with get_cursor() as cursor:
+        # Abort the schedule item if it is scheduled or active
         cursor.execute(
-            "SELECT active FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "UPDATE schedule SET state = ? WHERE schedule_id = ? AND state IN (?, ?)",
+            (STATE_ABORTED, schedule_id, STATE_SCHEDULED, STATE_ACTIVE),
         )
-        active = cursor.fetchone()[0]
 
-        if active != 1:
-            raise DatabaseException("Cannot complete schedule item. It is not active.")
+        if cursor.rowcount == 0:
+            _get_schedule_item_state(cursor, schedule_id)
+            raise DatabaseException(
+                "Cannot abort schedule item. It is already finished."
+            )
+
 
-        # Update the completed and active fields of the specified schedule item
+@_timed_call
+def abort_schedule_items(schedule_ids):
+    """abort many schedule items in one transaction, returns the aborted ids"""
+    with get_cursor() as cursor:
+        placeholders = ", ".join("?" * len(schedule_ids))
         cursor.execute(
-            "UPDATE schedule SET completed = 1, active = 0 WHERE schedule_id = ?",
-            (schedule_id,),
+            f"""UPDATE schedule SET state = ?
+                          WHERE state IN (?, ?) AND schedule_id IN ({placeholders})
+                          RETURNING schedule_id""",
+            [STATE_ABORTED, STATE_SCHEDULED, STATE_ACTIVE, *schedule_ids],
         )
+        return [row[0] for row in cursor.fetchall()]
 
 
-def abort_schedule_item(schedule_id):
+@_timed_call
+def update_schedule_filepath(schedule_id, filepath):
     with get_cursor() as cursor:
-        # Check if the schedule item exists
+        # Update the filepath unless the schedule item is active, completed, or aborted
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "UPDATE schedule SET filepath = ? WHERE schedule_id = ? AND state = ?",
+            (filepath, schedule_id, STATE_SCHEDULED),
         )
-        count = cursor.fetchone()[0]
 
-        if count == 0:
+        if cursor.rowcount == 0:
+            _get_schedule_item_state(cursor, schedule_id)
+            raise DatabaseException(
+                "Cannot update filepath. Schedule item is active, completed, or aborted."
+            )
+
+
+@_timed_call
+def update_schedule_item_filesize(schedule_id, force_filesize=None):
+    with get_cursor() as cursor:
+        # force size during reording
+        if force_filesize:
+            filesize = force_filesize
+        else:
+            # Retrieve the filepath for the schedule item
+            cursor.execute(
+                "SELECT filepath FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            )
+            result = cursor.fetchone()
+
+            if result is None:
+                raise DatabaseException("Schedule item does not exist.")
+
+            # Retrieve the file size, 0 if the file doesn't exist
+            try:
+                filesize = os.path.getsize(Path(RECORDING_PATH, result[0]))
+            except (OSError, TypeError):
+                filesize = 0
+
+        # Update the filesize field of the specified schedule item
+        cursor.execute(
+            "UPDATE schedule SET filesize = ? WHERE schedule_id = ?",
+            (filesize, schedule_id),
+        )
+
+        if cursor.rowcount == 0:
             raise DatabaseException("Schedule item does not exist.")
 
-        # Check if the schedule item is completed
+        return filesize
+
+
+@_timed_call
+def update_schedule_item_filesizes(filesizes):
+    """write many live filesizes {schedule_id: filesize} in one transaction"""
+    with get_cursor() as cursor:
+        cursor.executemany(
+            "UPDATE schedule SET filesize = ? WHERE schedule_id = ?",
+            [(filesize, schedule_id) for schedule_id, filesize in filesizes.items()],
+        )
+
+
+@_timed_call
+def update_schedule_item_windows(windows):
+    """write the window offsets {schedule_id: (start_byte, start_us, end_byte, end_us)}"""
+    with get_cursor() as cursor:
+        cursor.executemany(
+            """UPDATE schedule SET window_start_byte = ?, window_start_us = ?,
+                          window_end_byte = ?, window_end_us = ?
+                          WHERE schedule_id = ?""",
+            [(*offsets, schedule_id) for schedule_id, offsets in windows.items()],
+        )
+
+
+class FilesizeWriteBuffer:
+    """write-behind buffer for the filesizes of running recordings
+
+    Sizes are collected in memory and written with a single executemany
+    every flush_interval_sec, instead of one transaction per recording
+    and progress update.
+    """
+
+    def __init__(self, flush_interval_sec=FILESIZE_FLUSH_INTERVAL_SEC):
+        self.flush_interval_sec = flush_interval_sec
+        self._pending = {}
+        self._last_flush = clock.now()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, schedule_id, filesize):
+        self._pending[schedule_id] = filesize
+
+    def is_flush_due(self, now):
+        return bool(self._pending) and (
+            now - self._last_flush >= self.flush_interval_sec
+        )
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        self._last_flush = clock.now()
+        if pending:
+            update_schedule_item_filesizes(pending)
+
+
+@_timed_call
+def get_stored_recordings():
+    """finished recordings with a file, oldest first"""
+    with get_cursor(readonly=True) as cursor:
         cursor.execute(
-            "SELECT completed FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            """SELECT schedule_id, station_id, start_epoch, filepath, filesize
+                          FROM schedule WHERE state IN (?, ?) AND filesize > 0
+                          ORDER BY start_epoch""",
+            (STATE_COMPLETED, STATE_ABORTED),
         )
-        completed = cursor.fetchone()[0]
+        recordings = cursor.fetchall()
 
-        if completed == 1:
-            raise DatabaseException(
-                "Cannot abort schedule item. It is already completed."
-            )
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
+
+        return [
+            {column_names[i]: value for i, value in enumerate(recording)}
+            for recording in recordings
+        ]
 
-        # Update the aborted field of the specified schedule item
+
+@_timed_call
+def prune_schedule_items(schedule_ids):
+    """mark finished recordings as pruned after their files were removed"""
+    with get_cursor() as cursor:
+        placeholders = ", ".join("?" * len(schedule_ids))
         cursor.execute(
-            "UPDATE schedule SET aborted = 1 WHERE schedule_id = ?", (schedule_id,)
+            f"""UPDATE schedule SET state = ?, filesize = 0
+                          WHERE schedule_id IN ({placeholders}) AND state IN (?, ?)""",
+            (STATE_PRUNED, *schedule_ids, STATE_COMPLETED, STATE_ABORTED),
         )
 
 
-def update_schedule_filepath(schedule_id, filepath):
+@_timed_call
+def get_schedule_files():
+    """schedule_id, state, filepath and filesize of all items with a file name"""
+    with get_cursor(readonly=True) as cursor:
+        cursor.execute(
+            """SELECT schedule_id, state, filepath, filesize FROM schedule
+                          WHERE filepath IS NOT NULL"""
+        )
+        rows = cursor.fetchall()
+
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
+
+        return [{column_names[i]: value for i, value in enumerate(row)} for row in rows]
+
+
+@_timed_call
+def update_schedule_files(files):
+    """bulk repair {schedule_id: (filepath, filesize)}, in any state"""
+    with get_cursor() as cursor:
+        cursor.executemany(
+            "UPDATE schedule SET filepath = ?, filesize = ? WHERE schedule_id = ?",
+            [
+                (filepath, filesize, schedule_id)
+                for schedule_id, (filepath, filesize) in files.items()
+            ],
+        )
+
+
+def _add_postprocess_jobs(cursor, schedule_ids, job_types=None):
+    # queued in the transaction that completes the recordings
+    if job_types is None:
+        job_types = POSTPROCESS_JOB_TYPES
+    cursor.executemany(
+        """INSERT INTO postprocess_jobs (schedule_id, job_type, state, created_epoch)
+                      VALUES (?, ?, ?, ?)""",
+        [
+            (schedule_id, job_type, JOB_QUEUED, int(clock.now()))
+            for schedule_id in schedule_ids
+            for job_type in job_types
+        ],
+    )
+
+
+@_timed_call
+def add_postprocess_jobs(schedule_ids, job_types):
+    """queue jobs for recordings by hand, e.g. to redo a remux"""
+    with get_cursor() as cursor:
+        _add_postprocess_jobs(cursor, schedule_ids, job_types)
+
+
+@_timed_call
+def claim_postprocess_jobs(limit, now=None):
+    """mark up to limit queued jobs as running and return them with their recording
+
+    The jobs of a recording run one after the other, in the order they
+    were queued.
+    """
+    if limit <= 0:
+        return []
+    if now is None:
+        now = clock.now()
+
     with get_cursor() as cursor:
-        # Check if the schedule item exists
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            """UPDATE postprocess_jobs SET state = ?, started_epoch = ?
+                          WHERE job_id IN (
+                              SELECT job_id FROM postprocess_jobs AS job
+                              WHERE state = ? AND NOT EXISTS (
+                                  SELECT 1 FROM postprocess_jobs AS earlier
+                                  WHERE earlier.schedule_id = job.schedule_id
+                                  AND earlier.job_id < job.job_id
+                                  AND earlier.state IN (?, ?))
+                              ORDER BY job_id LIMIT ?)
+                          RETURNING job_id""",
+            (JOB_RUNNING, int(now), JOB_QUEUED, JOB_QUEUED, JOB_RUNNING, limit),
         )
-        count = cursor.fetchone()[0]
+        job_ids = [row[0] for row in cursor.fetchall()]
+        if not job_ids:
+            return []
 
-        if count == 0:
-            raise DatabaseException("Schedule item does not exist.")
+        placeholders = ", ".join("?" * len(job_ids))
+        cursor.execute(
+            f"""SELECT postprocess_jobs.job_id, postprocess_jobs.job_type,
+                          schedule.*, {SCHEDULE_STARTTIME}, stations.station_name
+                          FROM postprocess_jobs
+                          JOIN schedule ON postprocess_jobs.schedule_id = schedule.schedule_id
+                          LEFT JOIN stations ON schedule.station_id = stations.station_id
+                          WHERE postprocess_jobs.job_id IN ({placeholders})
+                          ORDER BY postprocess_jobs.job_id""",
+            job_ids,
+        )
+        jobs = cursor.fetchall()
+
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
+
+        return [{column_names[i]: value for i, value in enumerate(job)} for job in jobs]
 
-        # Check if the schedule item is active, completed, or aborted
+
+@_timed_call
+def finish_postprocess_job(job_id, state, output_filepath=None, message=None):
+    with get_cursor() as cursor:
         cursor.execute(
-            "SELECT active, completed, aborted FROM schedule WHERE schedule_id = ?",
+            """UPDATE postprocess_jobs SET state = ?, output_filepath = ?,
+                          message = ?, finished_epoch = ? WHERE job_id = ?""",
+            (state, output_filepath, message, int(clock.now()), job_id),
+        )
+
+
+@_timed_call
+def requeue_running_postprocess_jobs():
+    """jobs left running by a scheduler that was stopped or crashed start again"""
+    with get_cursor() as cursor:
+        cursor.execute(
+            "UPDATE postprocess_jobs SET state = ?, started_epoch = NULL WHERE state = ?",
+            (JOB_QUEUED, JOB_RUNNING),
+        )
+        return cursor.rowcount
+
+
+@_timed_call
+def get_postprocess_jobs(schedule_id):
+    with get_cursor(readonly=True) as cursor:
+        cursor.execute(
+            """SELECT * FROM postprocess_jobs WHERE schedule_id = ?
+                          ORDER BY job_id""",
             (schedule_id,),
         )
-        result = cursor.fetchone()
-        active, completed, aborted = result
+        jobs = cursor.fetchall()
 
-        if active == 1 or completed == 1 or aborted == 1:
-            raise DatabaseException(
-                "Cannot update filepath. Schedule item is active, completed, or aborted."
-            )
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
+
+        return [{column_names[i]: value for i, value in enumerate(job)} for job in jobs]
 
-        # Update the filepath field of the specified schedule item
+
+@_timed_call
+def has_pending_postprocess_jobs(schedule_id):
+    """True while jobs of the recording are queued or running"""
+    with get_cursor(readonly=True) as cursor:
         cursor.execute(
-            "UPDATE schedule SET filepath = ? WHERE schedule_id = ?",
-            (filepath, schedule_id),
+            """SELECT 1 FROM postprocess_jobs
+                          WHERE schedule_id = ? AND state IN (?, ?) LIMIT 1""",
+            (schedule_id, JOB_QUEUED, JOB_RUNNING),
+        )
+        return cursor.fetchone() is not None
+
+
+@_timed_call
+def get_postprocess_outputs(schedule_ids=None):
+    """{schedule_id: [output files]} of the finished jobs, of all recordings if None"""
+    with get_cursor(readonly=True) as cursor:
+        query = """SELECT schedule_id, output_filepath FROM postprocess_jobs
+                          WHERE state = ? AND output_filepath IS NOT NULL"""
+        parameters = [JOB_DONE]
+        if schedule_ids is not None:
+            query += f" AND schedule_id IN ({', '.join('?' * len(schedule_ids))})"
+            parameters += list(schedule_ids)
+        cursor.execute(query, parameters)
+
+        outputs = {}
+        for schedule_id, output_filepath in cursor.fetchall():
+            outputs.setdefault(schedule_id, []).append(output_filepath)
+        return outputs
+
+
+@_timed_call
+def update_quality_stalls(stalls):
+    """write the stalls {schedule_id: (stall_count, longest_stall_sec)} of finished recordings"""
+    with get_cursor() as cursor:
+        cursor.executemany(
+            """INSERT INTO quality_reports (schedule_id, stall_count, longest_stall_sec)
+                          VALUES (?, ?, ?) ON CONFLICT (schedule_id) DO UPDATE
+                          SET stall_count = excluded.stall_count,
+                          longest_stall_sec = excluded.longest_stall_sec""",
+            [(schedule_id, *stall) for schedule_id, stall in stalls.items()],
         )
 
 
-def update_schedule_item_filesize(schedule_id, force_filesize=None):
+@_timed_call
+def save_quality_report(schedule_id, report):
+    """store the analysis of a recording, the stalls are kept"""
+    columns = [
+        "duration_sec",
+        "average_kbps",
+        "rms_dbfs",
+        "gap_count",
+        "longest_gap_sec",
+        "silence_sec",
+    ]
     with get_cursor() as cursor:
-        # Check if the schedule item exists
         cursor.execute(
-            "SELECT COUNT(*) FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            f"""INSERT INTO quality_reports (schedule_id, {", ".join(columns)}, analyzed_epoch)
+                          VALUES (?, {", ".join("?" * len(columns))}, ?)
+                          ON CONFLICT (schedule_id) DO UPDATE SET
+                          {", ".join(f"{c} = excluded.{c}" for c in columns)},
+                          analyzed_epoch = excluded.analyzed_epoch""",
+            [schedule_id, *(report[c] for c in columns), int(clock.now())],
         )
-        count = cursor.fetchone()[0]
 
-        if count == 0:
-            raise DatabaseException("Schedule item does not exist.")
 
-        # Retrieve the filepath for the schedule item
+@_timed_call
+def get_quality_report(schedule_id):
+    with get_cursor(readonly=True) as cursor:
         cursor.execute(
-            "SELECT filepath FROM schedule WHERE schedule_id = ?", (schedule_id,)
+            "SELECT * FROM quality_reports WHERE schedule_id = ?", (schedule_id,)
         )
-        filepath = cursor.fetchone()[0]
+        report = cursor.fetchone()
+        if report is None:
+            raise ScheduledItemNotFound("No quality report for the schedule item.")
 
-        filepath = Path(RECORDING_PATH, filepath)
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
 
-        # Retrieve the file size
-        # Check if the file exists
-        if os.path.exists(filepath):
-            filesize = os.path.getsize(filepath)
-        else:
-            filesize = 0
+        return {column_names[i]: value for i, value in enumerate(report)}
 
-        # force size during reording
-        if force_filesize:
-            filesize = force_filesize
 
-        # Update the filesize field of the specified schedule item
+@_timed_call
+def get_upcoming_events(until_epoch):
+    with get_cursor(readonly=True) as cursor:
+        # Range scan on the (state, start_epoch) index, independent of the table size
         cursor.execute(
-            "UPDATE schedule SET filesize = ? WHERE schedule_id = ?",
-            (filesize, schedule_id),
+            f"""SELECT schedule.*, {SCHEDULE_STARTTIME}, stations.station_url
+                          FROM schedule
+                          LEFT JOIN stations ON schedule.station_id = stations.station_id
+                          WHERE state = ? AND start_epoch < ? ORDER BY start_epoch""",
+            (STATE_SCHEDULED, until_epoch),
         )
+        events = cursor.fetchall()
 
-        return filesize
+        if not events:
+            return []
 
+        # Get the column names from the cursor description
+        column_names = [column[0] for column in cursor.description]
 
+        # Create a list of dictionaries, where each dictionary represents an event
+        event_list = []
+        for event in events:
+            event_dict = {column_names[i]: value for i, value in enumerate(event)}
+            event_list.append(event_dict)
+
+        return event_list
+
+
+@_timed_call
 def get_scheduled_events(future_events=True, active_events=True, completed_events=True):
-    with get_cursor() as cursor:
+    with get_cursor(readonly=True) as cursor:
         # Build the SQL query based on the provided filters
-        filters = []
+        states = []
         if future_events:
-            filters.append("(completed = 0 AND active = 0 AND aborted = 0)")
+            states.append(STATE_SCHEDULED)
         if completed_events:
-            filters.append("completed = 1")
+            states.append(STATE_COMPLETED)
         if active_events:
-            filters.append("active = 1")
-
-        # Join the filters with "OR" conditions
-        filters_query = " OR ".join(filters)
+            states.append(STATE_ACTIVE)
 
         # Retrieve the scheduled events based on the filters
-        query = f"SELECT * FROM schedule WHERE {filters_query} ORDER BY starttime"
-        cursor.execute(query)
+        placeholders = ", ".join("?" * len(states))
+        query = f"""SELECT schedule.*, {SCHEDULE_STARTTIME},
+                    quality_reports.stall_count, quality_reports.gap_count,
+                    quality_reports.longest_gap_sec
+                    FROM schedule
+                    LEFT JOIN quality_reports
+                    ON schedule.schedule_id = quality_reports.schedule_id
+                    WHERE state IN ({placeholders}) ORDER BY start_epoch"""
+        cursor.execute(query, states)
         events = cursor.fetchall()
 
         if not events:
@@ -451,5 +1325,5 @@ def get_scheduled_events(future_events=True, active_events=True, completed_event
         return event_list
 
 
-if not Path(DATABASE_NAME).exists():
-    setup_database_tables()
+# Create or migrate the database
+setup_database_tables()
@@ -0,0 +1,126 @@
+"""stand-in for ffmpeg used by benchmark.py, no decoding or encoding at all
+
+Understands the command lines PyWRR builds:
+- recording: copies the input url to the output file and writes "-progress"
+  blocks twice a second, like ffmpeg does
+- shared capture ("-f mpegts pipe:1"): copies the input url to stdout
+- decoding ("-f s16le pipe:1"): a tone, one second per 16 kB of input
+- loudness ("ebur128"): prints a summary
+- everything else (remux, trim, concat): copies the first input file
+
+FAKE_FFMPEG_SPEED=N reports N seconds of media per second. The output
+file is then extended sparsely to the reported size, so a day long
+recording can be simulated in minutes without writing the data.
+"""
+import math
+import os
+import signal
+import struct
+import sys
+import time
+import urllib.request
+
+PROGRESS_INTERVAL_SEC = 0.5
+NOMINAL_BITRATE_KBPS = 128
+stopped = False
+
+
+def stop(*args):
+    global stopped
+    stopped = True
+
+
+def get_argument(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+def open_input(source):
+    if "://" in source:
+        return urllib.request.urlopen(source, timeout=15)
+    return open(source, "rb")
+
+
+def record(args, output, write_progress):
+    speed = float(os.environ.get("FAKE_FFMPEG_SPEED", "1"))
+    started = time.monotonic()
+    last_report = started
+    total_size = 0
+    with open_input(get_argument(args, "-i")) as source:
+        with open(output, "wb") if output != "pipe:1" else os.fdopen(1, "wb") as f:
+            while not stopped:
+                chunk = source.read(4096)
+                if not chunk:
+                    break
+                if speed == 1:
+                    f.write(chunk)
+                    total_size += len(chunk)
+                else:
+                    # media time runs faster than the clock
+                    elapsed = time.monotonic() - started
+                    total_size = int(elapsed * speed * NOMINAL_BITRATE_KBPS * 125)
+                    f.truncate(total_size)
+                f.flush()
+
+                now = time.monotonic()
+                if write_progress and now - last_report >= PROGRESS_INTERVAL_SEC:
+                    last_report = now
+                    print_progress(total_size, (now - started) * speed, speed)
+
+    if write_progress:
+        elapsed = time.monotonic() - started
+        print_progress(total_size, elapsed * speed, speed, end=True)
+
+
+def print_progress(total_size, out_time_sec, speed, end=False):
+    bitrate = total_size * 8 / out_time_sec / 1000 if out_time_sec else 0
+    print(
+        f"bitrate={bitrate:.1f}kbits/s\n"
+        f"total_size={total_size}\n"
+        f"out_time_us={int(out_time_sec * 1e6)}\n"
+        f"dup_frames=0\n"
+        f"drop_frames=0\n"
+        f"speed={speed:.3g}x\n"
+        f"progress={'end' if end else 'continue'}",
+        flush=True,
+    )
+
+
+def decode(args):
+    sample_rate = int(get_argument(args, "-ar", "8000"))
+    seconds = os.path.getsize(get_argument(args, "-i")) / 16000
+    out = os.fdopen(1, "wb")
+    block = [
+        int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))
+        for i in range(sample_rate)
+    ]
+    data = struct.pack(f"<{len(block)}h", *block)
+    for _ in range(int(seconds)):
+        out.write(data)
+    out.write(data[: int(seconds % 1 * sample_rate) * 2])
+    out.flush()
+
+
+def main(args):
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    output = args[-1]
+
+    if any("ebur128" in arg for arg in args):
+        print(
+            "Summary:\n  I:         -18.0 LUFS\n  LRA:         6.0 LU", file=sys.stderr
+        )
+    elif "s16le" in args:
+        decode(args)
+    elif "-progress" in args:
+        record(args, output, write_progress=True)
+    elif output == "pipe:1":
+        record(args, output, write_progress=False)
+    else:
+        with open_input(get_argument(args, "-i")) as source, open(output, "wb") as f:
+            f.write(source.read())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
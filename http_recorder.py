@@ -0,0 +1,228 @@
+import http.client
+import threading
+import urllib.request
+from collections import deque
+from pathlib import Path
+from threading import Thread
+
+import clock
+from recorder import RecordingProgress, ScheduledRecordingException
+from settings import (
+    HTTP_RECORDER_CHUNK_SIZE,
+    HTTP_RECORDER_RECONNECT_SEC,
+    HTTP_RECORDER_TIMEOUT_SEC,
+    NATIVE_CAPTURE_EXTENSIONS,
+    RECORDER_LOG_LINES,
+    RECORDING_PATH,
+)
+from stream_resolver import stream_url_cache
+from time_index import start_time_index
+
+# file extensions a plain stream can be written to as is
+CONTENT_TYPE_EXTENSIONS = {
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/aac": ".aac",
+    "audio/aacp": ".aac",
+    "audio/x-aac": ".aac",
+}
+
+
+def is_native_capture(filepath):
+    """True if the recording can be written without ffmpeg (no remuxing needed)"""
+    return filepath is not None and Path(filepath).suffix in NATIVE_CAPTURE_EXTENSIONS
+
+
+class IcyMetadataStripper:
+    """removes the Shoutcast/Icecast metadata blocks from a stream
+
+    With "icy-metaint: N" the server sends N audio bytes, then one length
+    byte (x16) followed by the metadata, e.g. "StreamTitle='...';".
+    """
+
+    def __init__(self, metaint, on_metadata=None):
+        self.metaint = metaint
+        self.on_metadata = on_metadata
+        self._audio_left = metaint
+        self._metadata_left = None
+        self._metadata = bytearray()
+
+    def feed(self, view, write):
+        """write the audio parts of the memoryview, without copying them"""
+        if not self.metaint:
+            write(view)
+            return
+
+        position = 0
+        while position < len(view):
+            if self._audio_left:
+                end = min(position + self._audio_left, len(view))
+                write(view[position:end])
+                self._audio_left -= end - position
+                position = end
+            elif self._metadata_left is None:
+                self._metadata_left = view[position] * 16
+                position += 1
+            else:
+                end = min(position + self._metadata_left, len(view))
+                self._metadata += view[position:end]
+                self._metadata_left -= end - position
+                position = end
+
+            if self._metadata_left == 0:
+                if self._metadata and self.on_metadata is not None:
+                    self.on_metadata(
+                        self._metadata.rstrip(b"\0").decode(errors="replace")
+                    )
+                self._metadata.clear()
+                self._metadata_left = None
+                self._audio_left = self.metaint
+
+
+class HTTPStreamRecording:
+    """records a plain MP3/AAC (Icecast/Shoutcast) http stream without ffmpeg
+
+    The response body is read as it arrives into one preallocated buffer
+    and written straight to disk, ICY metadata is stripped on the way.
+    Same API as FFMPEGStreamRecording.
+    """
+
+    def __init__(
+        self,
+        schedule_id,
+        url,
+        duration_min=60,
+        filepath=None,
+        window_start=None,
+        window_end=None,
+        station_id=None,
+    ):
+        self.schedule_id = schedule_id
+        self.url = url
+        self.station_id = station_id  # key for the resolved stream url
+        self.duration_min = duration_min
+        self.starttime = None
+        self.runtime_sec = None
+        self.active = False
+        self.filename = filepath
+        self.recording_thread = Thread(target=self.do_recording)
+        self.recording_thread.daemon = True
+        self.is_aborted = False
+        self.is_completed = False
+        self.is_ready_to_be_discarded = False  # when finalized in the database
+        self.on_finished = None  # optional callback, e.g. to wake up the scheduler
+        self.log = deque(maxlen=RECORDER_LOG_LINES)
+        self.progress = RecordingProgress()
+        self.progress.window_start = window_start
+        self.progress.window_end = window_end
+        self._recording_path = None
+        self._stop = threading.Event()
+
+        if not self.url.startswith("http"):
+            raise ScheduledRecordingException(f"Url {self.url} not correct")
+        if self.duration_min < 0 or self.duration_min >= 24 * 60:
+            raise ScheduledRecordingException(
+                f"Recording duration {self.duration_min} out of limits."
+            )
+        if self.filename is None:
+            raise ScheduledRecordingException("Filename for recording not given.")
+
+    def __repr__(self):
+        return f"HTTP Recording #{self.schedule_id} - {self.starttime} - {self.url}"
+
+    def start(self):
+        self.recording_thread.start()
+
+    @property
+    def is_running(self):
+        return self.recording_thread.is_alive()
+
+    def do_recording(self):
+        self.active = True
+        print(f"{self.url=} {self.duration_min=}")
+        self.starttime = clock.now()
+        end_time = self.starttime + self.duration_min * 60
+        self._recording_path = Path(RECORDING_PATH, self.filename)
+        self.progress.index = start_time_index(self.filename)
+        buffer = bytearray(HTTP_RECORDER_CHUNK_SIZE)
+
+        try:
+            with open(self._recording_path, "wb") as file:
+                while not self._stop.is_set() and clock.now() < end_time:
+                    try:
+                        self.capture(file, buffer, end_time)
+                    except (OSError, http.client.HTTPException) as e:
+                        print(f"[#{self.schedule_id}] {e}")
+                        self.log.append(str(e))
+                        # the stream may have moved, resolve it again
+                        stream_url_cache.forget(self.url, self.station_id)
+                        # reconnect, unless the recording is over
+                        remaining = max(0, end_time - clock.now())
+                        clock.wait(
+                            self._stop, min(HTTP_RECORDER_RECONNECT_SEC, remaining)
+                        )
+                    except Exception as e:
+                        # e.g. a malformed url, a reconnect would fail the same way
+                        print(f"[#{self.schedule_id}] Recording failed: {e!r}")
+                        self.log.append(f"Recording failed: {e!r}")
+                        break
+        finally:
+            # always finalized, or the schedule item stays active
+            self.end_recording()
+            if self.on_finished is not None:
+                self.on_finished()
+
+    def capture(self, file, buffer, end_time):
+        url = stream_url_cache.resolve(self.url, self.station_id)
+        request = urllib.request.Request(url, headers={"Icy-MetaData": "1"})
+        with urllib.request.urlopen(
+            request, timeout=HTTP_RECORDER_TIMEOUT_SEC
+        ) as response:
+            self.check_content_type(response.headers.get("Content-Type", ""))
+            stripper = IcyMetadataStripper(
+                int(response.headers.get("icy-metaint") or 0),
+                on_metadata=self.log.append,
+            )
+            view = memoryview(buffer)
+
+            def write(data):
+                file.write(data)
+                self.progress.total_size = file.tell()
+
+            while not self._stop.is_set() and clock.now() < end_time:
+                size = response.readinto1(buffer)
+                if not size:
+                    raise ConnectionError("Stream closed by server")
+                stripper.feed(view[:size], write)
+                self.update_progress()
+
+    def check_content_type(self, content_type):
+        extension = CONTENT_TYPE_EXTENSIONS.get(content_type.split(";")[0].strip())
+        if extension != Path(self.filename).suffix:
+            message = (
+                f"Stream content type '{content_type}' does not match {self.filename}"
+            )
+            print(f"[#{self.schedule_id}] {message}")
+            self.log.append(message)
+
+    def update_progress(self):
+        now = clock.now()
+        elapsed = now - self.starttime
+        self.runtime_sec = int(elapsed)
+        self.progress.out_time_us = int(elapsed * 1_000_000)
+        if elapsed > 0:
+            self.progress.bitrate_kbps = self.progress.total_size * 8 / elapsed / 1000
+        self.progress.updated = now
+        self.progress.sample(now)
+
+    def end_recording(self):
+        self._stop.set()
+        self.active = False
+        if self.progress.total_size > 0:
+            self.is_completed = True
+        else:
+            self.is_aborted = True
+
+    def get_approx_size(self):
+        """bytes written so far, -1 if nothing was received yet"""
+        return self.progress.total_size
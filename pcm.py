@@ -0,0 +1,43 @@
+import subprocess
+import tempfile
+
+from settings import FFMPEG_BINARY
+
+
+def decode_pcm(recording_path, sample_rate, block_size):
+    """decode a recording with ffmpeg, yields 16 bit little endian mono samples
+
+    Blocks are block_size bytes (the last one may be shorter), so memory
+    use does not depend on the length of the recording. Raises OSError
+    if ffmpeg fails.
+    """
+    command = [FFMPEG_BINARY, "-nostdin", "-loglevel", "error", "-i", recording_path]
+    command += ["-vn", "-ac", "1", "-ar", str(sample_rate)]
+    command += ["-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"]
+    # errors go to a file, a full stderr pipe would block the decoder
+    error_file = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=error_file, bufsize=0
+    )
+
+    try:
+        block = bytearray()
+        while chunk := process.stdout.read(block_size - len(block)):
+            block += chunk
+            if len(block) == block_size:
+                yield bytes(block)
+                block.clear()
+        if len(block) >= 2:
+            yield bytes(block[: len(block) - len(block) % 2])
+
+        if process.wait() != 0:
+            error_file.seek(0)
+            error = error_file.read().decode(errors="replace").strip()
+            raise OSError(f"ffmpeg failed: {error[-500:]}")
+    finally:
+        # also when the caller stops early
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        error_file.close()
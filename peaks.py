@@ -0,0 +1,83 @@
+import os
+import struct
+from pathlib import Path
+
+import numpy
+from pcm import decode_pcm
+from settings import PEAKS_PER_SEC, PEAKS_SAMPLE_RATE
+
+PEAKS_SUFFIX = ".peaks"
+# audiowaveform .dat version 1: version, flags (1 = 8 bit), sample rate,
+# samples per peak, number of peaks; followed by one (min, max) int8 pair
+# per peak. Can be used by peaks.js and other waveform viewers as is.
+PEAKS_HEADER = struct.Struct("<iIiiI")
+PEAKS_VERSION = 1
+PEAKS_FLAG_8BIT = 1
+# peaks reduced per read from the decoder
+PEAKS_PER_READ = 4096
+
+
+def peaks_path(recording_path):
+    """sidecar peaks of a recording, "show.ts" -> "show.ts.peaks\" """
+    return Path(f"{recording_path}{PEAKS_SUFFIX}")
+
+
+def reduce_peaks(data, samples_per_peak):
+    """(min, max) int8 pairs of 16 bit mono samples, one per samples_per_peak
+
+    A shorter last block gives a peak of its own.
+    """
+    samples = numpy.frombuffer(data, dtype="<i2")
+    complete = len(samples) - len(samples) % samples_per_peak
+    blocks = [samples[:complete].reshape(-1, samples_per_peak)]
+    if complete < len(samples):
+        blocks.append(samples[complete:].reshape(1, -1))
+
+    peaks = []
+    for block in blocks:
+        pairs = numpy.empty((len(block), 2), dtype=numpy.int8)
+        # the high byte of a 16 bit sample is its 8 bit value
+        pairs[:, 0] = block.min(axis=1) >> 8
+        pairs[:, 1] = block.max(axis=1) >> 8
+        peaks.append(pairs.tobytes())
+    return b"".join(peaks)
+
+
+def generate_peaks(recording_path, sample_rate=PEAKS_SAMPLE_RATE):
+    """decode a recording once and write its peaks file, returns (path, peaks)
+
+    ffmpeg decodes to 16 bit mono at sample_rate into a pipe, the samples
+    are reduced to PEAKS_PER_SEC (min, max) pairs per second as they arrive.
+    """
+    samples_per_peak = sample_rate // PEAKS_PER_SEC
+    path = peaks_path(recording_path)
+    temporary_path = path.with_name(f"{path.name}.part")
+
+    count = 0
+    try:
+        with open(temporary_path, "wb") as f:
+            f.write(bytes(PEAKS_HEADER.size))
+            # whole peaks per block, only the last peak can be shorter
+            for data in decode_pcm(
+                recording_path, sample_rate, samples_per_peak * 2 * PEAKS_PER_READ
+            ):
+                peaks = reduce_peaks(data, samples_per_peak)
+                f.write(peaks)
+                count += len(peaks) // 2
+
+            f.seek(0)
+            f.write(
+                PEAKS_HEADER.pack(
+                    PEAKS_VERSION,
+                    PEAKS_FLAG_8BIT,
+                    sample_rate,
+                    samples_per_peak,
+                    count,
+                )
+            )
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(temporary_path, path)
+    return path, count
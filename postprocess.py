@@ -0,0 +1,267 @@
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import clock
+import database
+from peaks import generate_peaks
+from quality import analyze_recording
+from recorder import trim_recording
+from settings import (
+    FFMPEG_BINARY,
+    POSTPROCESS_NICE,
+    POSTPROCESS_WORKERS,
+    POSTPROCESS_WORKERS_WHILE_RECORDING,
+    RECORDING_PATH,
+)
+
+# the queue is checked after completions and finished jobs, and in this
+# interval for jobs added by hand
+QUEUE_CHECK_SEC = 60
+# ffmpeg muxer per remux target
+REMUX_FORMATS = {".m4a": "ipod", ".mp3": "mp3"}
+
+
+class PostProcessException(Exception):
+    pass
+
+
+def lower_priority(nice=POSTPROCESS_NICE):
+    """runs in each worker process, ffmpeg inherits the priorities"""
+    if hasattr(os, "nice"):
+        os.nice(nice)
+    # idle io class, the disk is left to the recordings
+    if shutil.which("ionice"):
+        subprocess.run(
+            ["ionice", "-c", "3", "-p", str(os.getpid())], capture_output=True
+        )
+
+
+def trim_job(job, path):
+    if job["window_start_byte"] is None:
+        start_offset = None
+    else:
+        start_offset = (job["window_start_byte"], job["window_start_us"])
+    if job["window_end_byte"] is None:
+        end_offset = None
+    else:
+        end_offset = (job["window_end_byte"], job["window_end_us"])
+    if start_offset in (None, (0, 0)) and end_offset is None:
+        return None, "nothing to trim"
+
+    filesize = trim_recording(path, start_offset, end_offset)
+    start_us = start_offset[1] if start_offset else 0
+    end_us = end_offset[1] if end_offset else None
+    database.update_schedule_item_filesize(job["schedule_id"], force_filesize=filesize)
+    database.update_schedule_item_windows(
+        {
+            job["schedule_id"]: (
+                0,
+                0,
+                filesize,
+                None if end_us is None else end_us - start_us,
+            )
+        }
+    )
+    return None, f"trimmed to {filesize} bytes"
+
+
+def remux_job(job, path, extension):
+    """copy the audio into another container, tagged with station and time"""
+    if path.suffix == extension:
+        return None, f"already {extension}"
+    output_filepath = str(Path(job["filepath"]).with_suffix(extension))
+    output_path = Path(RECORDING_PATH, output_filepath)
+    temporary_path = output_path.with_name(f"{output_path.name}.part")
+
+    command = [FFMPEG_BINARY, "-y", "-loglevel", "error", "-i", path, "-vn"]
+    command += ["-codec:a", "copy", "-map_metadata", "-1"]
+    command += ["-metadata", f"title={job['station_name']} {job['starttime']}"]
+    command += ["-metadata", f"artist={job['station_name']}"]
+    command += ["-metadata", f"date={job['starttime'][:10]}"]
+    if extension == ".m4a":
+        command += ["-movflags", "+faststart"]
+    command += ["-f", REMUX_FORMATS[extension], temporary_path]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        temporary_path.unlink(missing_ok=True)
+        raise PostProcessException(e.stderr.strip() or str(e)) from None
+
+    os.replace(temporary_path, output_path)
+    return output_filepath, f"{output_path.stat().st_size} bytes"
+
+
+def loudness_job(job, path):
+    """EBU R128 integrated loudness and loudness range"""
+    command = [FFMPEG_BINARY, "-nostats", "-hide_banner", "-i", path, "-vn"]
+    command += ["-af", "ebur128=framelog=quiet", "-f", "null", "-"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    # the summary is printed last
+    summary = result.stderr.rpartition("Summary:")[2]
+    integrated = re.search(r"I:\s+(-?[\d.]+|-inf) LUFS", summary)
+    loudness_range = re.search(r"LRA:\s+([\d.]+) LU", summary)
+    if result.returncode or integrated is None:
+        raise PostProcessException(
+            result.stderr.strip()[-500:] or "no loudness summary"
+        )
+
+    message = f"integrated {integrated[1]} LUFS"
+    if loudness_range is not None:
+        message += f", range {loudness_range[1]} LU"
+    return None, message
+
+
+def peaks_job(job, path):
+    peaks_file, count = generate_peaks(path)
+    output_filepath = str(Path(job["filepath"]).with_name(peaks_file.name))
+    return output_filepath, f"{count} peaks"
+
+
+def quality_job(job, path):
+    report = analyze_recording(path)
+    database.save_quality_report(job["schedule_id"], report)
+    return None, (
+        f"{report['gap_count']} gaps, longest {report['longest_gap_sec']} s, "
+        f"{report['average_kbps']} kbit/s"
+    )
+
+
+JOB_HANDLERS = {
+    "trim": trim_job,
+    "remux_m4a": lambda job, path: remux_job(job, path, ".m4a"),
+    "remux_mp3": lambda job, path: remux_job(job, path, ".mp3"),
+    "loudness": loudness_job,
+    "peaks": peaks_job,
+    "quality": quality_job,
+}
+
+
+def run_job(job):
+    """runs in a worker process, returns (output_filepath, message)"""
+    handler = JOB_HANDLERS.get(job["job_type"])
+    if handler is None:
+        raise PostProcessException(f"Unknown job type {job['job_type']}")
+    if job["filepath"] is None:
+        raise PostProcessException("Recording has no file")
+    path = Path(RECORDING_PATH, job["filepath"])
+    if not path.is_file():
+        raise PostProcessException(f"{path} does not exist")
+    return handler(job, path)
+
+
+class PostProcessor:
+    """works through the postprocess_jobs queue on a bounded process pool
+
+    The workers run with a lower cpu and io priority. While recordings
+    are running, at most POSTPROCESS_WORKERS_WHILE_RECORDING jobs are
+    started (0 pauses the queue), jobs already running finish at their
+    low priority.
+    """
+
+    def __init__(self, workers=POSTPROCESS_WORKERS):
+        self.workers = workers
+        self.on_job_done = None  # called with the job and its new state
+        self._pool = None
+        self._running = {}  # job_id: job
+        self._check_queue = True
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PostProcessor: {len(self._running)}/{self.workers} jobs running"
+
+    def running_count(self):
+        with self._lock:
+            return len(self._running)
+
+    def start(self):
+        requeued = database.requeue_running_postprocess_jobs()
+        if requeued:
+            print(f"Requeued {requeued} interrupted post-processing jobs")
+        self._check_queue = True
+
+    def notify(self):
+        """new jobs may have been queued"""
+        self._check_queue = True
+
+    def get_pool(self):
+        if self._pool is None:
+            # spawn instead of fork, the scheduler process has threads running
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=lower_priority,
+            )
+        return self._pool
+
+    def poll(self, recordings_active, now=None):
+        """start queued jobs if there are free workers, returns the started jobs"""
+        if now is None:
+            now = clock.now()
+        if not self._check_queue and now - self._last_check < QUEUE_CHECK_SEC:
+            return []
+
+        limit = self.workers
+        if recordings_active:
+            limit = min(limit, POSTPROCESS_WORKERS_WHILE_RECORDING)
+        with self._lock:
+            free = limit - len(self._running)
+        if free <= 0:
+            return []
+
+        self._check_queue = False
+        self._last_check = now
+        jobs = database.claim_postprocess_jobs(free, now)
+        for job in jobs:
+            print(f"[#{job['schedule_id']}] Post-processing: {job['job_type']}")
+            with self._lock:
+                self._running[job["job_id"]] = job
+            try:
+                future = self.get_pool().submit(run_job, job)
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for memory), start a new pool
+                self._pool = None
+                future = self.get_pool().submit(run_job, job)
+            future.add_done_callback(
+                lambda future, job=job: self.job_finished(job, future)
+            )
+        # more may be waiting
+        if len(jobs) == free:
+            self._check_queue = True
+        return jobs
+
+    def job_finished(self, job, future):
+        try:
+            output_filepath, message = future.result()
+            state = database.JOB_DONE
+        except Exception as e:
+            output_filepath, message = None, str(e) or repr(e)
+            state = database.JOB_FAILED
+            if isinstance(e, BrokenProcessPool):
+                self._pool = None
+
+        try:
+            database.finish_postprocess_job(
+                job["job_id"], state, output_filepath, message
+            )
+        finally:
+            with self._lock:
+                self._running.pop(job["job_id"], None)
+            self._check_queue = True
+
+        status = "done" if state == database.JOB_DONE else "failed"
+        print(f"[#{job['schedule_id']}] {job['job_type']} {status}: {message}")
+        if self.on_job_done is not None:
+            self.on_job_done(job, state)
+
+    def shutdown(self):
+        """stop the worker processes, queued jobs are not started anymore"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,25 +1,14 @@
-import ctypes
-import os
 import shutil
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
+from http_recorder import HTTPStreamRecording
 from recorder import FFMPEGStreamRecording
 from settings import RECORDING_PATH
-
-
-def get_free_space(folder):
-    # TODO - check if this actually works
-    if os.name == "posix":  # Linux
-        stat = os.statvfs(folder)
-        return stat.f_bavail * stat.f_frsize
-    elif os.name == "nt":  # Windows
-        free_bytes = ctypes.c_ulonglong(0)
-        ctypes.windll.kernel32.GetDiskFreeSpaceExW(
-            folder, None, None, ctypes.pointer(free_bytes)
-        )
-        return free_bytes.value
-    else:
-        raise OSError("Unsupported operating system")
+from storage import get_free_space
 
 
 def prototype_show_free_space(folder_path):
@@ -70,5 +59,78 @@ def prototype_2_recordings():
     print("Done")
 
 
+class LoopingStreamHandler(BaseHTTPRequestHandler):
+    """local stand-in for an icecast server: streams a file in a loop"""
+
+    source = b""
+    content_type = "audio/mpeg"
+    metaint = 8192
+    bytes_per_sec = 16000
+
+    def do_GET(self):
+        metaint = self.metaint if self.headers.get("Icy-MetaData") == "1" else 0
+        self.send_response(200)
+        self.send_header("Content-Type", self.content_type)
+        if metaint:
+            self.send_header("icy-metaint", str(metaint))
+        self.end_headers()
+
+        chunk = metaint or 4096
+        looped = self.source * (chunk // len(self.source) + 2)
+        position = 0
+        counter = 0
+        try:
+            while True:
+                data = looped[position : position + chunk]
+                position = (position + chunk) % len(self.source)
+                self.wfile.write(data)
+                if metaint:
+                    counter += 1
+                    title = f"StreamTitle='Block {counter}';".encode()
+                    title += b"\0" * (-len(title) % 16)
+                    self.wfile.write(bytes([len(title) // 16]) + title)
+                time.sleep(chunk / self.bytes_per_sec)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def prototype_native_capture(source_file=None, duration_min=0.1):
+    """record the local looping stream, fails if icy metadata ends up in the file"""
+    if source_file is None:
+        # not a valid mp3, the capture only passes the bytes through
+        LoopingStreamHandler.source = bytes(range(256)) * 37
+    else:
+        LoopingStreamHandler.source = Path(source_file).read_bytes()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LoopingStreamHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    f = HTTPStreamRecording(
+        schedule_id=0,
+        url=f"http://127.0.0.1:{server.server_port}/stream.mp3",
+        duration_min=duration_min,
+        filepath="native.mp3",
+    )
+    f.start()
+    f.recording_thread.join()
+    server.shutdown()
+
+    print(f.progress, list(f.log)[-3:])
+
+    # with the metadata stripped the recording is the looped source file
+    source = LoopingStreamHandler.source
+    recording_path = Path(RECORDING_PATH, "native.mp3")
+    recorded = recording_path.read_bytes()
+    looped = source * (len(recorded) // len(source) + 1)
+    assert f.is_completed, "recording did not complete"
+    assert any("StreamTitle=" in line for line in f.log), "server sent no metadata"
+    assert b"StreamTitle=" not in recorded, "icy metadata in the recording"
+    assert recorded == looped[: len(recorded)], "recording differs from the source"
+    assert f.progress.total_size == len(recorded) == recording_path.stat().st_size
+    print("Native capture ok")
+
+
 if __name__ == "__main__":
-    prototype_2_recordings()
+    if sys.argv[1:2] == ["--native-capture"]:
+        prototype_native_capture(*sys.argv[2:3])
+    else:
+        prototype_2_recordings()
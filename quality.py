@@ -0,0 +1,89 @@
+import math
+import os
+
+import numpy
+from pcm import decode_pcm
+from settings import (
+    QUALITY_MIN_GAP_SEC,
+    QUALITY_SAMPLE_RATE,
+    QUALITY_SILENCE_DB,
+    QUALITY_WINDOW_SEC,
+)
+
+# windows analysed per block read from the decoder
+QUALITY_WINDOWS_PER_READ = 4096
+
+
+def window_powers(data, window):
+    """mean square of every window of 16 bit mono samples, the last may be shorter"""
+    samples = numpy.frombuffer(data, dtype="<i2").astype(numpy.float64)
+    complete = len(samples) - len(samples) % window
+    powers = numpy.square(samples[:complete]).reshape(-1, window).mean(axis=1)
+    if complete < len(samples):
+        powers = numpy.append(powers, numpy.square(samples[complete:]).mean())
+    return powers
+
+
+def to_dbfs(power):
+    if power <= 0:
+        return None
+    return round(10 * math.log10(power / 32768**2), 1)
+
+
+def analyze_recording(recording_path, sample_rate=QUALITY_SAMPLE_RATE):
+    """silence gaps and loudness of a recording, decoded once in fixed size blocks
+
+    The RMS is computed per QUALITY_WINDOW_SEC window, runs of windows
+    below QUALITY_SILENCE_DB that last QUALITY_MIN_GAP_SEC count as gaps.
+    """
+    window = max(1, int(sample_rate * QUALITY_WINDOW_SEC))
+    threshold = 32768**2 * 10 ** (QUALITY_SILENCE_DB / 10)
+    min_gap = QUALITY_MIN_GAP_SEC * sample_rate
+
+    samples = 0
+    total_power = 0.0
+    gaps = []  # length in seconds
+    silence = 0  # samples of the current run of silent windows
+
+    for data in decode_pcm(
+        recording_path, sample_rate, window * 2 * QUALITY_WINDOWS_PER_READ
+    ):
+        block_samples = len(data) // 2
+        powers = window_powers(data, window)
+        # all windows are complete, except possibly the very last
+        lengths = numpy.full(len(powers), window)
+        lengths[-1] = block_samples - window * (len(powers) - 1)
+        total_power += float(numpy.dot(powers, lengths))
+        samples += block_samples
+
+        # runs of equal windows, from the positions where the state changes
+        silent = powers < threshold
+        starts = numpy.flatnonzero(numpy.diff(silent, prepend=not silent[0]))
+        run_lengths = numpy.add.reduceat(lengths, starts)
+        silent_runs = run_lengths[silent[starts]]
+
+        # a run can continue from the previous block and into the next one
+        if silent[0]:
+            silent_runs[0] += silence
+        elif silence >= min_gap:
+            gaps.append(silence / sample_rate)
+        silence = 0
+        if silent[-1]:
+            silence = int(silent_runs[-1])
+            silent_runs = silent_runs[:-1]
+        gaps += (silent_runs[silent_runs >= min_gap] / sample_rate).tolist()
+    if silence >= min_gap:
+        gaps.append(silence / sample_rate)
+
+    duration_sec = samples / sample_rate
+    filesize = os.path.getsize(recording_path)
+    return {
+        "duration_sec": round(duration_sec, 1),
+        "average_kbps": (
+            round(filesize * 8 / duration_sec / 1000, 1) if duration_sec else None
+        ),
+        "rms_dbfs": to_dbfs(total_power / samples) if samples else None,
+        "gap_count": len(gaps),
+        "longest_gap_sec": round(max(gaps, default=0), 1),
+        "silence_sec": round(sum(gaps), 1),
+    }
@@ -1,19 +1,172 @@
+import os
+import shutil
 import subprocess
-import time
+from collections import deque
 from pathlib import Path
 from threading import Thread
 
-from settings import RECORDING_PATH
+import clock
+from settings import (
+    FFMPEG_BINARY,
+    NATIVE_CAPTURE_EXTENSIONS,
+    QUALITY_STALL_SEC,
+    RECORDER_LOG_LINES,
+    RECORDING_PATH,
+)
+from stream_resolver import stream_url_cache
+from time_index import index_path, start_time_index
 
 
 class ScheduledRecordingException(Exception):
     pass
 
 
+class RecordingProgress:
+    """latest progress values of a recording, updated from ffmpeg's -progress output
+
+    ffmpeg writes blocks of "key=value" lines, each block ends with
+    "progress=continue" (or "progress=end" when ffmpeg exits).
+    """
+
+    def __init__(self):
+        self.total_size = -1
+        self.out_time_us = None
+        self.bitrate_kbps = None
+        self.speed = None
+        self.drop_frames = 0
+        self.dup_frames = 0
+        self.ended = False
+        self.updated = None
+        self._block = {}
+
+        # nominal window of a pre/post roll recording (epoch seconds) and
+        # the (bytes, media time in us) offsets where it starts and ends
+        self.window_start = None
+        self.window_end = None
+        self.window_start_offset = None
+        self.window_end_offset = None
+        self._last_sample = None
+
+        # optional time_index.TimeIndexWriter, fed with every update
+        self.index = None
+
+        # times without new data of at least QUALITY_STALL_SEC
+        self.stall_count = 0
+        self.longest_stall_sec = 0
+        self._last_growth = None  # (epoch, bytes)
+
+    def __repr__(self):
+        return (
+            f"size={self.total_size} time_us={self.out_time_us} "
+            f"bitrate={self.bitrate_kbps}kbit/s speed={self.speed}x"
+        )
+
+    def feed_line(self, line):
+        key, separator, value = line.strip().partition("=")
+        if not separator:
+            return
+
+        if key != "progress":
+            self._block[key] = value.strip()
+            return
+
+        self._update(self._block)
+        self._block = {}
+        self.ended = value == "end"
+        self.updated = clock.now()
+        self.sample(self.updated)
+
+    def sample(self, now):
+        """called after every progress update"""
+        self.mark_window(now)
+        self.track_stalls(now)
+        if self.index is not None:
+            self.index.add_sample(self.out_time_us, self.total_size)
+
+    def mark_window(self, now):
+        """record the offsets of the window boundaries passed since the last update"""
+        sample = (now, max(self.total_size, 0), self.out_time_us or 0)
+        # a recording that started late has its window start at 0
+        previous = self._last_sample or (now, 0, 0)
+        self._last_sample = sample
+
+        if self.window_start is not None and self.window_start_offset is None:
+            if now >= self.window_start:
+                self.window_start_offset = interpolate_offset(
+                    previous, sample, self.window_start
+                )
+        if self.window_end is not None and self.window_end_offset is None:
+            if now >= self.window_end:
+                self.window_end_offset = interpolate_offset(
+                    previous, sample, self.window_end
+                )
+
+    def track_stalls(self, now, finished=False):
+        """count the times the size did not grow, finished=True when the recording ended"""
+        size = max(self.total_size, 0)
+        if self._last_growth is None:
+            self._last_growth = (now, size)
+            return
+        last_time, last_size = self._last_growth
+        if size > last_size or finished:
+            stall_sec = now - last_time
+            if stall_sec >= QUALITY_STALL_SEC:
+                self.stall_count += 1
+                self.longest_stall_sec = max(self.longest_stall_sec, stall_sec)
+            self._last_growth = (now, size)
+
+    def _update(self, block):
+        # values are "N/A" until ffmpeg knows them
+        try:
+            self.total_size = int(block["total_size"])
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            self.out_time_us = int(block["out_time_us"])
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            self.bitrate_kbps = float(block["bitrate"].removesuffix("kbits/s"))
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            self.speed = float(block["speed"].removesuffix("x"))
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            self.drop_frames = int(block["drop_frames"])
+            self.dup_frames = int(block["dup_frames"])
+        except (KeyError, ValueError):
+            pass
+
+
+def interpolate_offset(previous, sample, moment):
+    # (bytes, us) at "moment" between two (epoch, bytes, us) progress samples
+    (t0, bytes0, us0), (t1, bytes1, us1) = previous, sample
+    if t1 <= t0 or moment <= t0:
+        return bytes0, us0
+    share = min(1.0, (moment - t0) / (t1 - t0))
+    return int(bytes0 + share * (bytes1 - bytes0)), int(us0 + share * (us1 - us0))
+
+
 class FFMPEGStreamRecording:
-    def __init__(self, schedule_id, url, duration_min=60, filepath=None):
+    def __init__(
+        self,
+        schedule_id,
+        url,
+        duration_min=60,
+        filepath=None,
+        window_start=None,
+        window_end=None,
+        station_id=None,
+    ):
         self.schedule_id = schedule_id
         self.url = url
+        self.station_id = station_id  # key for the resolved stream url
         self.duration_min = duration_min
         self.starttime = None
         self.runtime_sec = None
@@ -23,12 +176,17 @@ class FFMPEGStreamRecording:
         self.recording_thread = Thread(target=self.do_recording)
         self.recording_thread.daemon = True
         self.stderr_thread = None
+        self.progress_thread = None
         self.is_aborted = False
         self.is_completed = False
         self.is_ready_to_be_discarded = False  # when finalized in the database
-        self.log = []
+        self.on_finished = None  # optional callback, e.g. to wake up the scheduler
+        # only the last lines of the ffmpeg error output are kept
+        self.log = deque(maxlen=RECORDER_LOG_LINES)
+        self.progress = RecordingProgress()
+        self.progress.window_start = window_start
+        self.progress.window_end = window_end
         self._recording_path = None
-        self._filesize_approx = 0
 
         if not self.url.startswith("http"):
             raise ScheduledRecordingException(f"Url {self.url} not correct")
@@ -42,6 +200,13 @@ class FFMPEGStreamRecording:
     def __repr__(self):
         return f"FFMPEG Recording #{self.schedule_id} - {self.starttime} - {self.url}"
 
+    def start(self):
+        self.recording_thread.start()
+
+    @property
+    def is_running(self):
+        return self.recording_thread.is_alive()
+
     @property
     def get_ffmpeg_call(self):
         if self.filename is None:
@@ -50,12 +215,18 @@ class FFMPEGStreamRecording:
         self._recording_path = Path(RECORDING_PATH, self.filename)
 
         command = [
-            "ffmpeg",
+            FFMPEG_BINARY,
             # overwrite existing file
             "-y",
-            # input url
+            # machine readable progress on stdout, only errors on stderr
+            "-progress",
+            "pipe:1",
+            "-nostats",
+            "-loglevel",
+            "error",
+            # input url, redirects and playlists resolved in advance
             "-i",
-            self.url,
+            stream_url_cache.resolve(self.url, self.station_id),
             # do not re-encode
             "-codec",
             "copy",
@@ -69,10 +240,15 @@ class FFMPEGStreamRecording:
 
         return command
 
+    def start_index(self):
+        # sidecar index for seeking, written while recording
+        self.progress.index = start_time_index(self.filename)
+
     def do_recording(self):
         self.active = True
         print(f"{self.url=} {self.duration_min=}")
-        self.starttime = time.time()
+        self.starttime = clock.now()
+        self.start_index()
 
         # start recording process
         self.process = subprocess.Popen(
@@ -86,19 +262,27 @@ class FFMPEGStreamRecording:
         )
         self.stderr_thread.daemon = True
         self.stderr_thread.start()
+        self.progress_thread = Thread(
+            target=self.output_handler, args=(self.process, "progress")
+        )
+        self.progress_thread.daemon = True
+        self.progress_thread.start()
 
         while True:
-            self.runtime_sec = int(time.time() - self.starttime)
+            self.runtime_sec = int(clock.now() - self.starttime)
             remaining_sec = self.duration_min * 60 - self.runtime_sec
             print(
-                f"[#{self.schedule_id}:{remaining_sec}s] {self.runtime_sec=:02.1f} - {self.log[-1] if self.log else '-'}"
+                f"[#{self.schedule_id}:{remaining_sec}s] {self.runtime_sec=:02.1f} - {self.progress}"
             )
             if remaining_sec <= 0:
                 break
-            time.sleep(2)
+            clock.sleep(2)
 
         self.end_recording()
         self.stderr_thread.join()
+        self.progress_thread.join()
+        if self.on_finished is not None:
+            self.on_finished()
 
     def end_recording(self):
         if self.process is not None:
@@ -108,38 +292,56 @@ class FFMPEGStreamRecording:
         self.is_completed = True
 
     def output_handler(self, process, handler_type):
-        for line in iter(process.stderr.readline, ""):
-            self.log.append(line.strip())
+        if handler_type == "progress":
+            for line in iter(process.stdout.readline, ""):
+                self.progress.feed_line(line)
+        else:
+            for line in iter(process.stderr.readline, ""):
+                self.log.append(line.strip())
 
     def get_approx_size(self):
-        """read size from ffmpeg log"""
-        try:
-            size = [line for line in self.log if line.startswith("size=")][-1].split()[
-                1
-            ]
-            if size.endswith("kB"):
-                return int(size[:-2]) * 1024
-        except (IndexError, TypeError):
-            pass
-        return -1
+        """latest size reported by ffmpeg, -1 if unknown"""
+        return self.progress.total_size
 
 
-def validate_unique_filename(filepath):
-    path = Path(filepath)
+def trim_recording(recording_path, start_offset, end_offset):
+    """cut a pre/post roll recording to its nominal window, without re-encoding
 
-    if not path.exists():
-        return str(path)
+    The offsets are (bytes, media time us) tuples, None for the start or
+    end of the file. Plain streams are cut at the byte offsets, everything
+    else with "ffmpeg -c copy" at the media time offsets. Returns the new size.
+    """
+    path = Path(recording_path)
+    trimmed_path = path.with_name(f"{path.stem}.trimmed{path.suffix}")
+    start_bytes, start_us = start_offset or (0, 0)
+    end_bytes, end_us = end_offset or (None, None)
 
-    base_directory = path.parent
-    base_filename = path.stem
-    extension = path.suffix
-
-    counter = 1
-    new_filepath = path
-
-    while new_filepath.exists():
-        new_filename = f"{base_filename}_{counter}{extension}"
-        new_filepath = base_directory / new_filename
-        counter += 1
+    if path.suffix in NATIVE_CAPTURE_EXTENSIONS:
+        with open(path, "rb") as source, open(trimmed_path, "wb") as target:
+            source.seek(start_bytes)
+            if end_bytes is None:
+                shutil.copyfileobj(source, target)
+            else:
+                remaining = end_bytes - start_bytes
+                while remaining > 0 and (chunk := source.read(min(remaining, 1 << 20))):
+                    target.write(chunk)
+                    remaining -= len(chunk)
+    else:
+        command = [
+            FFMPEG_BINARY,
+            "-y",
+            "-loglevel",
+            "error",
+            "-ss",
+            f"{start_us / 1e6:.3f}",
+        ]
+        command += ["-i", path]
+        if end_us is not None:
+            command += ["-t", f"{(end_us - start_us) / 1e6:.3f}"]
+        command += ["-codec", "copy", trimmed_path]
+        subprocess.run(command, check=True, capture_output=True)
 
-    return str(new_filepath)
+    os.replace(trimmed_path, path)
+    # the offsets of the index don't match the trimmed file
+    index_path(path).unlink(missing_ok=True)
+    return path.stat().st_size
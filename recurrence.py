@@ -0,0 +1,135 @@
+import datetime
+
+# RRULE weekday names, index = datetime.weekday()
+WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+FREQUENCIES = ["HOURLY", "DAILY", "WEEKLY", "MONTHLY"]
+
+
+class RecurrenceRuleException(ValueError):
+    pass
+
+
+class RecurrenceRule:
+    """subset of RFC 5545 RRULE, e.g. "FREQ=WEEKLY;BYDAY=MO,WE;UNTIL=20241231"
+
+    Supported parts: FREQ (HOURLY, DAILY, WEEKLY, MONTHLY), INTERVAL,
+    BYDAY (weekly only), COUNT and UNTIL. Times are local wall-clock times,
+    so a daily show stays at 20:00 across daylight saving changes.
+    """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.freq = None
+        self.interval = 1
+        self.byday = None
+        self.count = None
+        self.until = None
+
+        parts = {}
+        for part in rule.upper().removeprefix("RRULE:").split(";"):
+            if not part.strip():
+                continue
+            name, separator, value = part.partition("=")
+            if not separator:
+                raise RecurrenceRuleException(f"Invalid rule part '{part}'.")
+            parts[name.strip()] = value.strip()
+
+        try:
+            self.freq = parts.pop("FREQ")
+            if self.freq not in FREQUENCIES:
+                raise RecurrenceRuleException(f"Unsupported FREQ '{self.freq}'.")
+            if "INTERVAL" in parts:
+                self.interval = int(parts.pop("INTERVAL"))
+            if "COUNT" in parts:
+                self.count = int(parts.pop("COUNT"))
+            if "UNTIL" in parts:
+                self.until = parse_until(parts.pop("UNTIL"))
+            if "BYDAY" in parts:
+                self.byday = sorted(
+                    WEEKDAYS.index(day.strip()) for day in parts.pop("BYDAY").split(",")
+                )
+        except KeyError:
+            raise RecurrenceRuleException(f"Rule '{rule}' has no FREQ.")
+        except ValueError as e:
+            raise RecurrenceRuleException(f"Invalid rule '{rule}': {e}")
+
+        if parts:
+            raise RecurrenceRuleException(f"Unsupported rule parts {sorted(parts)}.")
+        if self.interval < 1 or (self.count is not None and self.count < 1):
+            raise RecurrenceRuleException(f"Invalid rule '{rule}'.")
+        if self.byday and self.freq != "WEEKLY":
+            raise RecurrenceRuleException("BYDAY is only supported for FREQ=WEEKLY.")
+
+    def __repr__(self):
+        return f"RecurrenceRule({self.rule!r})"
+
+    def _period_occurrences(self, dtstart, period):
+        # occurrences in the n-th period (hour, day, week, month) after dtstart
+        if self.freq == "HOURLY":
+            return [dtstart + datetime.timedelta(hours=period * self.interval)]
+        if self.freq == "DAILY":
+            return [dtstart + datetime.timedelta(days=period * self.interval)]
+        if self.freq == "WEEKLY":
+            week_start = dtstart + datetime.timedelta(
+                days=-dtstart.weekday(), weeks=period * self.interval
+            )
+            return [
+                week_start + datetime.timedelta(days=weekday)
+                for weekday in (self.byday or [dtstart.weekday()])
+            ]
+
+        month = dtstart.month - 1 + period * self.interval
+        try:
+            return [
+                dtstart.replace(year=dtstart.year + month // 12, month=month % 12 + 1)
+            ]
+        except ValueError:
+            # e.g. the 31st in a month with 30 days
+            return []
+
+    def _periods_between(self, dtstart, moment):
+        if self.freq == "MONTHLY":
+            months = (moment.year - dtstart.year) * 12 + moment.month - dtstart.month
+            return months // self.interval
+        unit = {
+            "HOURLY": datetime.timedelta(hours=1),
+            "DAILY": datetime.timedelta(days=1),
+            "WEEKLY": datetime.timedelta(weeks=1),
+        }[self.freq]
+        return (moment - dtstart) // (unit * self.interval)
+
+    def iter_occurrences(self, dtstart, after=None):
+        """yields the start times (naive local datetimes) later than after"""
+        period = 0
+        if after is not None and self.count is None:
+            # skip the periods before "after" instead of walking from dtstart,
+            # COUNT rules have to be counted from the start
+            period = max(0, self._periods_between(dtstart, after) - 1)
+
+        count = 0
+        empty_periods = 0
+        while empty_periods < 100:
+            occurrences = self._period_occurrences(dtstart, period)
+            # e.g. "31st of every 12th month" starting in February never matches
+            empty_periods = 0 if occurrences else empty_periods + 1
+            for occurrence in occurrences:
+                if occurrence < dtstart:
+                    continue
+                if self.until is not None and occurrence > self.until:
+                    return
+                count += 1
+                if self.count is not None and count > self.count:
+                    return
+                if after is None or occurrence > after:
+                    yield occurrence
+            period += 1
+
+
+def parse_until(value):
+    # "20241231" or "20241231T235959" (a trailing "Z" is ignored)
+    value = value.removesuffix("Z")
+    if "T" in value:
+        return datetime.datetime.strptime(value, "%Y%m%dT%H%M%S")
+    return datetime.datetime.strptime(value, "%Y%m%d").replace(
+        hour=23, minute=59, second=59
+    )
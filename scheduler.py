@@ -1,73 +1,602 @@
-import datetime
+import heapq
+import subprocess
+import threading
 import time
+from pathlib import Path
 
+import catalog
+import clock
 import database
-from recorder import FFMPEGStreamRecording
+import metrics
+import postprocess
+import segmented_recorder
+import storage
+from async_recorder import AsyncFFMPEGStreamRecording
+from capture_mux import SharedStreamRecording, get_capture_kind, get_running_captures
+from http_recorder import (
+    CONTENT_TYPE_EXTENSIONS,
+    HTTPStreamRecording,
+    is_native_capture,
+)
+from recorder import FFMPEGStreamRecording, ScheduledRecordingException
+from settings import (
+    POST_ROLL_SEC,
+    METRICS_SCHEDULER_ADDRESS,
+    METRICS_SCHEDULER_PORT,
+    NATIVE_CAPTURE_DEFAULT_FILEPATHS,
+    PRE_ROLL_SEC,
+    RECORDER_BACKEND,
+    RECORDING_PATH,
+    SCHEDULER_CHANGE_POLL_SEC,
+    SCHEDULER_HORIZON_SEC,
+    SCHEDULER_PROGRESS_INTERVAL_SEC,
+    SEGMENTED_RECORDING,
+    SHARED_CAPTURE,
+    STREAM_RESOLVER_PREFETCH_SEC,
+)
+from stream_resolver import stream_url_cache
+from time_index import index_path
 
+START_LAG_SECONDS = metrics.histogram(
+    "pywrr_scheduler_start_lag_seconds",
+    "Actual minus planned start (start time minus pre roll) of recordings",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+LOOP_SECONDS = metrics.histogram(
+    "pywrr_scheduler_loop_seconds", "Work per scheduler loop, without the sleep"
+)
+RECORDINGS_FINISHED = metrics.counter(
+    "pywrr_recordings_finished_total", "Finished recordings by state"
+)
+
+# loop whose recordings the gauges below report, set by SchedulingLoop
+_active_loop = None
+
+
+def active_loop_samples(method, *args):
+    # (labels, value) pairs for a gauge, collected on every scrape
+    if _active_loop is None:
+        return []
+    return getattr(_active_loop, method)(*args)
+
+
+metrics.gauge(
+    "pywrr_recording_bytes",
+    "Bytes written by the running recordings",
+    lambda: active_loop_samples("recording_samples", lambda f: f.get_approx_size()),
+)
+metrics.gauge(
+    "pywrr_recording_bitrate_kbps",
+    "Bitrate of the running recordings",
+    lambda: active_loop_samples("recording_samples", lambda f: f.progress.bitrate_kbps),
+)
+metrics.gauge(
+    "pywrr_recording_speed",
+    "ffmpeg speed of the running recordings (1 = real time)",
+    lambda: active_loop_samples("recording_samples", lambda f: f.progress.speed),
+)
+metrics.gauge(
+    "pywrr_active_processes",
+    "Running recordings, capture and post-processing processes",
+    lambda: active_loop_samples("process_samples"),
+)
+
+
+class ScheduleQueue:
+    """in-memory timer heap of upcoming schedule items, ordered by start time"""
 
-class SchedulingLoop:
     def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def load(self, events):
+        heap = [(event["start_epoch"], event["schedule_id"]) for event in events]
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def push(self, starttime, schedule_id):
+        heapq.heappush(self._heap, (starttime, schedule_id))
+
+    def next_starttime(self):
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def upcoming(self, until):
+        """ids of the queued items starting before until, in no particular order"""
+        return [
+            schedule_id for starttime, schedule_id in self._heap if starttime < until
+        ]
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[1])
+        return due
+
+
+class SchedulingLoop:
+    def __init__(
+        self,
+        change_poll_sec=SCHEDULER_CHANGE_POLL_SEC,
+        progress_interval_sec=SCHEDULER_PROGRESS_INTERVAL_SEC,
+    ):
+        self.change_poll_sec = change_poll_sec
+        self.progress_interval_sec = progress_interval_sec
         self._current_treads = []
+        self._queue = ScheduleQueue()
+        self._wakeup = threading.Event()
+        self._change_token = None
+        self._loaded_until = 0
+        self._last_progress_update = 0
+        self._filesizes = database.FilesizeWriteBuffer()
+        self._stations = {}  # schedule_id: (station_id, station_url)
+        self._claimed_batch = []  # schedule details of the items being started now
+        self._storage = storage.StorageManager()
+        self._catalog = catalog.RecordingCatalog()
+        self._postprocessor = postprocess.PostProcessor()
+        self._postprocessor.on_job_done = self.postprocess_job_done
 
-    def main_loop(self):
+        # the gauges report the recordings of the latest loop
+        global _active_loop
+        _active_loop = self
 
-        while True:
-            f: FFMPEGStreamRecording
-            for f in self._current_treads:
+    def wakeup(self):
+        """interrupt the current sleep, e.g. when a recording has finished"""
+        self._wakeup.set()
 
-                if f.is_ready_to_be_discarded:
-                    # todo - thread safe removal from "_current_treads"
-                    pass
-                else:
-                    if f.recording_thread.is_alive():
-                        print(f, f.recording_thread.is_alive())
-                        print(f._recording_path, f._filesize_approx)
-
-                        if size := f.get_approx_size():
-                            database.update_schedule_item_filesize(
-                                f.schedule_id, force_filesize=size
-                            )
-                    else:
-                        if f.is_completed and not f.is_ready_to_be_discarded:
-                            database.complete_schedule_item(f.schedule_id)
-                            database.update_schedule_item_filesize(f.schedule_id)
-                            f.is_ready_to_be_discarded = True
-                        else:
-                            database.abort_schedule_item(f.schedule_id)
-                            database.update_schedule_item_filesize(f.schedule_id)
-                            f.is_ready_to_be_discarded = True
-
-            time.sleep(5)
-            try:
-                next_scheduled_item = database.get_next_schedule_item()
+    def recording_samples(self, value):
+        # (labels, value) of the running recordings, for the /metrics gauges
+        samples = []
+        for f in list(self._current_treads):
+            if f.is_running and (sample := value(f)) is not None:
+                labels = (("schedule_id", f.schedule_id), ("station_id", f.station_id))
+                samples.append((labels, sample))
+        return samples
+
+    def process_samples(self):
+        recordings = [f for f in list(self._current_treads) if f.is_running]
+        return [
+            ((("kind", "recording"),), len(recordings)),
+            (
+                (("kind", "ffmpeg"),),
+                sum(is_process_running(getattr(f, "process", None)) for f in recordings)
+                + sum(
+                    is_process_running(capture.process)
+                    for capture in get_running_captures()
+                ),
+            ),
+            ((("kind", "capture"),), len(get_running_captures())),
+            ((("kind", "postprocess"),), self._postprocessor.running_count()),
+        ]
+
+    def reload_schedule(self):
+        # only the items within the horizon, later ones are loaded as time passes
+        self._change_token = database.get_database_change_token()
+        self._loaded_until = clock.now() + SCHEDULER_HORIZON_SEC
+        events = database.get_upcoming_events(self._loaded_until)
+        self._queue.load(events)
+        self._stations = {
+            event["schedule_id"]: (event["station_id"], event["station_url"])
+            for event in events
+        }
+        self._storage.check_upcoming(events)
+
+    def reload_schedule_if_changed(self):
+        if database.get_database_change_token() != self._change_token:
+            self.reload_schedule()
+        elif clock.now() >= self._loaded_until - SCHEDULER_HORIZON_SEC / 2:
+            self.reload_schedule()
+
+    def get_sleep_time(self, now):
+        # the horizon is extended even if the poll interval is longer
+        timeouts = [
+            self.change_poll_sec,
+            self._loaded_until - SCHEDULER_HORIZON_SEC / 2 - now,
+        ]
+
+        next_starttime = self._queue.next_starttime()
+        if next_starttime is not None:
+            timeouts.append(next_starttime - PRE_ROLL_SEC - now)
+
+        if self._current_treads:
+            timeouts.append(
+                self._last_progress_update + self.progress_interval_sec - now
+            )
+
+        return max(0, min(timeouts))
+
+    def prefetch_stream_urls(self, now):
+        # resolve redirects and playlists before the recordings are due
+        for schedule_id in self._queue.upcoming(
+            now + PRE_ROLL_SEC + STREAM_RESOLVER_PREFETCH_SEC
+        ):
+            station_id, station_url = self._stations.get(schedule_id, (None, None))
+            if station_url:
+                stream_url_cache.prefetch(station_url, station_id)
+
+    def update_recordings(self, now):
+        report_progress = now - self._last_progress_update >= self.progress_interval_sec
+        if report_progress:
+            self._last_progress_update = now
+
+        completed = []
+        aborted = []
+        unjoined = []
+
+        f: FFMPEGStreamRecording
+        for f in self._current_treads:
+            if f.is_running:
+                if report_progress:
+                    print(f, f._recording_path, f.progress)
+                    if (size := f.get_approx_size()) > 0:
+                        self._filesizes.record(f.schedule_id, size)
+                        self._storage.record_filesize(f.schedule_id, size)
+            elif getattr(f, "join_failed", False):
+                # segments not joined, the schedule item stays active
+                unjoined.append(f)
+            elif f.is_completed:
+                completed.append(f)
+            else:
+                aborted.append(f)
+
+        for f in unjoined:
+            print(f"[#{f.schedule_id}] Segments left for the recovery pass")
+            self._catalog.release(f.filename)
+            self._storage.release(f.schedule_id, 0)
+            f.is_ready_to_be_discarded = True
+
+        # write buffered sizes on state changes, otherwise in intervals
+        if completed or aborted or self._filesizes.is_flush_due(now):
+            self._filesizes.flush()
 
-                schedule_id = next_scheduled_item["schedule_id"]
-                schedule_details = database.get_schedule_item(schedule_id=schedule_id)
-                print(schedule_details)
+        if completed or aborted:
+            self.finalize_recordings(completed, aborted, now)
 
-                next_starttime = datetime.datetime.strptime(
-                    next_scheduled_item["starttime"][:19], "%Y-%m-%d %H:%M:%S"
-                )
-                current_time = datetime.datetime.now()
-                if next_starttime < current_time:
+        self._current_treads = [
+            f for f in self._current_treads if not f.is_ready_to_be_discarded
+        ]
 
-                    database.activate_schedule_item(schedule_id)
+    def finalize_recordings(self, completed, aborted, now):
+        """write the final state of finished recordings, one transaction per step"""
+        RECORDINGS_FINISHED.inc(len(completed), state="completed")
+        RECORDINGS_FINISHED.inc(len(aborted), state="aborted")
 
-                    f = FFMPEGStreamRecording(
-                        schedule_id=schedule_id,
-                        duration_min=schedule_details["runtime"],
-                        url=schedule_details["station_url"],
-                        filepath=schedule_details["filepath"],
+        # finalize all finished recordings in one transaction per state
+        if completed:
+            database.complete_schedule_items([f.schedule_id for f in completed])
+        if aborted:
+            database.abort_schedule_items([f.schedule_id for f in aborted])
+        # final sizes with one stat per file, written in one transaction
+        filesizes = {
+            f.schedule_id: self._catalog.refresh_file(f.filename)
+            for f in completed + aborted
+        }
+        database.update_schedule_item_filesizes(filesizes)
+        for f in completed + aborted:
+            self._catalog.release(f.filename)
+            self._storage.release(
+                f.schedule_id,
+                filesizes[f.schedule_id],
+                f.progress.bitrate_kbps if f.is_completed else None,
+            )
+            f.is_ready_to_be_discarded = True
+        # stalls until the end count as well, e.g. a stream that died
+        for f in completed + aborted:
+            f.progress.track_stalls(now, finished=True)
+        database.update_quality_stalls(
+            {
+                f.schedule_id: (f.progress.stall_count, f.progress.longest_stall_sec)
+                for f in completed + aborted
+            }
+        )
+        windows = {
+            f.schedule_id: window_offsets(f.progress)
+            for f in completed + aborted
+            if f.progress.window_start_offset or f.progress.window_end_offset
+        }
+        if windows:
+            database.update_schedule_item_windows(windows)
+
+        if completed:
+            # post-processing jobs were queued with the completion
+            self._postprocessor.notify()
+
+        # keep the next occurrences of recurring recordings scheduled
+        database.roll_recurrences_forward([f.schedule_id for f in completed + aborted])
+
+    def get_recording_class(self, schedule_details, resume=False):
+        if resume or (
+            SEGMENTED_RECORDING and not is_native_capture(schedule_details["filepath"])
+        ):
+            # can be resumed after a restart
+            return segmented_recorder.SegmentedFFMPEGStreamRecording
+        if (
+            SHARED_CAPTURE
+            and get_capture_kind(schedule_details["filepath"])
+            and self.overlaps_station_recording(schedule_details)
+        ):
+            # one connection per station for overlapping recordings
+            return SharedStreamRecording
+        if is_native_capture(schedule_details["filepath"]):
+            # plain stream to disk, ffmpeg is only needed for remuxing
+            return HTTPStreamRecording
+        if RECORDER_BACKEND == "asyncio":
+            return AsyncFFMPEGStreamRecording
+        return FFMPEGStreamRecording
+
+    def overlaps_station_recording(self, schedule_details):
+        """True if another recording of the station runs, starts now or overlaps later"""
+        station_id = schedule_details["station_id"]
+        if any(capture.station_id == station_id for capture in get_running_captures()):
+            return True
+        if any(
+            details["station_id"] == station_id
+            and details["schedule_id"] != schedule_details["schedule_id"]
+            for details in self._claimed_batch
+        ):
+            return True
+        # queued items that start before this one has stopped
+        end = (
+            schedule_details["start_epoch"]
+            + schedule_details["runtime"] * 60
+            + POST_ROLL_SEC
+            + PRE_ROLL_SEC
+        )
+        return any(
+            self._stations.get(schedule_id, (None,))[0] == station_id
+            for schedule_id in self._queue.upcoming(end)
+            if schedule_id != schedule_details["schedule_id"]
+        )
+
+    def create_recording(self, schedule_details, now, resume=False):
+        recording_class = self.get_recording_class(schedule_details, resume)
+
+        # start up to PRE_ROLL_SEC early, stop POST_ROLL_SEC after the end;
+        # late starts still record the full runtime
+        window_start = schedule_details["start_epoch"]
+        window_end = window_start + schedule_details["runtime"] * 60
+        duration_sec = max(
+            window_end + POST_ROLL_SEC - now, schedule_details["runtime"] * 60
+        )
+
+        options = {"resume": True} if resume else {}
+        return recording_class(
+            **options,
+            schedule_id=schedule_details["schedule_id"],
+            duration_min=duration_sec / 60,
+            url=schedule_details["station_url"],
+            filepath=schedule_details["filepath"],
+            window_start=window_start,
+            window_end=window_end,
+            station_id=schedule_details["station_id"],
+        )
+
+    def assign_unique_filepath(self, schedule_details):
+        # never overwrite an existing recording, the name is checked in memory
+        if schedule_details["filepath"] is None:
+            return
+        filepath = self.native_capture_filepath(schedule_details)
+        if self._catalog.exists(filepath):
+            filepath = self._catalog.unique_filename(filepath)
+            print(f"{schedule_details['filepath']} exists, recording to {filepath}")
+        if filepath != schedule_details["filepath"]:
+            database.update_schedule_files(
+                {schedule_details["schedule_id"]: (filepath, 0)}
+            )
+            schedule_details["filepath"] = filepath
+        self._catalog.reserve(filepath)
+
+    def native_capture_filepath(self, schedule_details):
+        """the default filepath with .mp3/.aac for a plain MP3/AAC stream"""
+        filepath = schedule_details["filepath"]
+        default = database.default_filepath(
+            schedule_details["station_id"], schedule_details["start_epoch"]
+        )
+        if not NATIVE_CAPTURE_DEFAULT_FILEPATHS or filepath != default:
+            return filepath
+        # known if the url was prefetched, otherwise ffmpeg records it
+        content_type = stream_url_cache.get_content_type(
+            schedule_details["station_url"], schedule_details["station_id"]
+        )
+        extension = CONTENT_TYPE_EXTENSIONS.get(content_type)
+        if extension is None:
+            return filepath
+        return str(Path(filepath).with_suffix(extension))
+
+    def repair_schedule_files(self):
+        """bring filesize of finished recordings in line with the disk, report orphans"""
+        schedule_files = database.get_schedule_files()
+        finished = [
+            row
+            for row in schedule_files
+            if row["state"] in (database.STATE_COMPLETED, database.STATE_ABORTED)
+        ]
+        repairs = self._catalog.reconcile(finished)
+        if repairs:
+            database.update_schedule_files(repairs)
+
+        known_filepaths = set()
+        for row in schedule_files:
+            known_filepaths.add(row["filepath"])
+            known_filepaths.add(index_path(row["filepath"]).name)
+        for outputs in database.get_postprocess_outputs().values():
+            known_filepaths.update(outputs)
+        orphans = self._catalog.get_orphans(known_filepaths)
+        print(f"{self._catalog}, {len(repairs)} repaired, {len(orphans)} orphaned")
+        return repairs, orphans
+
+    def recover_interrupted_items(self, now):
+        """resume or finalize the recordings a previous scheduler left active"""
+        recordings = []
+        filesizes = {}  # of the finalized items
+        for schedule_details in database.get_interrupted_schedule_items():
+            filepath = schedule_details["filepath"]
+            manifest = segmented_recorder.read_manifest(filepath)
+            if manifest is not None:
+                segmented_recorder.stop_orphaned_process(manifest)
+
+            end_epoch = (
+                schedule_details["start_epoch"]
+                + schedule_details["runtime"] * 60
+                + POST_ROLL_SEC
+            )
+            if (
+                manifest is not None
+                and end_epoch > now
+                and schedule_details["station_url"]
+            ):
+                print(f"Resuming {schedule_details}")
+                try:
+                    f = self.create_recording(schedule_details, now, resume=True)
+                except ScheduledRecordingException as e:
+                    print(e)
+                else:
+                    f.duration_min = (end_epoch - now) / 60
+                    f.on_finished = self.wakeup
+                    self._catalog.reserve(filepath)
+                    self._storage.admit(schedule_details, end_epoch - now, now)
+                    recordings.append(f)
+                    continue
+
+            if manifest is not None:
+                try:
+                    segmented_recorder.join_segments(
+                        segmented_recorder.segment_directory(filepath),
+                        Path(RECORDING_PATH, filepath),
                     )
-                    f.recording_thread.start()
-                    self._current_treads.append(f)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f"[#{schedule_details['schedule_id']}] Joining failed: {e}")
+            filesizes[schedule_details["schedule_id"]] = self._catalog.refresh_file(
+                filepath
+            )
 
-            except database.ScheduledItemNotFound as e:
-                print(e)
-                pass
-            except database.NothingScheduled as e:
+        if filesizes:
+            # partial recordings are kept as completed
+            completed = [schedule_id for schedule_id, size in filesizes.items() if size]
+            aborted = [
+                schedule_id for schedule_id, size in filesizes.items() if not size
+            ]
+            database.update_schedule_item_filesizes(filesizes)
+            if completed:
+                database.complete_schedule_items(completed)
+            if aborted:
+                database.abort_schedule_items(aborted)
+            database.roll_recurrences_forward(list(filesizes))
+            self._postprocessor.notify()
+
+        for f in recordings:
+            f.start()
+        self._current_treads.extend(recordings)
+
+    def postprocess_job_done(self, job, state):
+        # called from the pool, a trimmed recording has a new size
+        if job["job_type"] == "trim" and state == database.JOB_DONE:
+            filesize = self._catalog.refresh_file(job["filepath"])
+            self._storage.update_stored_size(job["schedule_id"], filesize)
+        self.wakeup()
+
+    def start_due_items(self, now):
+        # items are started PRE_ROLL_SEC before their start time
+        if not self._queue.pop_due(now + PRE_ROLL_SEC):
+            return
+
+        # claim every overdue item in one transaction, then launch all
+        # recordings together so simultaneous starts are not delayed
+        recordings = []
+        refused = []
+        self._claimed_batch = database.claim_due_schedule_items(now + PRE_ROLL_SEC)
+        for schedule_details in self._claimed_batch:
+            print(schedule_details)
+            self.assign_unique_filepath(schedule_details)
+            try:
+                f = self.create_recording(schedule_details, now)
+            except ScheduledRecordingException as e:
                 print(e)
-                time.sleep(15)
+                database.abort_schedule_item(schedule_details["schedule_id"])
+                self._catalog.release(schedule_details["filepath"])
+                refused.append(schedule_details["schedule_id"])
+                continue
+            # free space guard, from the cached storage totals
+            if not self._storage.admit(schedule_details, f.duration_min * 60, now):
+                database.abort_schedule_item(schedule_details["schedule_id"])
+                self._catalog.release(schedule_details["filepath"])
+                refused.append(schedule_details["schedule_id"])
+                continue
+            f.on_finished = self.wakeup
+            recordings.append(f)
+        self._claimed_batch = []
+        if refused:
+            # a refused occurrence must not end its recurrence
+            database.roll_recurrences_forward(refused)
+
+        for f in recordings:
+            f.start()
+            # planned to start PRE_ROLL_SEC before the window
+            START_LAG_SECONDS.observe(
+                clock.now() - (f.progress.window_start - PRE_ROLL_SEC)
+            )
+        self._current_treads.extend(recordings)
+
+    def startup(self):
+        """bring the database and the recordings directory in line, then load the queue"""
+        database.materialize_recurrences()
+        self._catalog.start()
+        self.repair_schedule_files()
+        self._storage.load()
+        self._storage.start_pruning()
+        self.recover_interrupted_items(clock.now())
+        self._postprocessor.start()
+        self.reload_schedule()
+
+    def run_once(self):
+        """one pass of the loop, returns the time to sleep until the next one"""
+        loop_start = time.perf_counter()
+        self.update_recordings(clock.now())
+        self.reload_schedule_if_changed()
+        self.prefetch_stream_urls(clock.now())
+        self.start_due_items(clock.now())
+        # workers are paused or throttled while recordings are running
+        self._postprocessor.poll(bool(self._current_treads))
+        LOOP_SECONDS.observe(time.perf_counter() - loop_start)
+        return self.get_sleep_time(clock.now())
+
+    def wait(self, timeout):
+        """sleep until the timeout or a wakeup, on the clock in use"""
+        clock.wait(self._wakeup, timeout)
+        self._wakeup.clear()
+
+    def main_loop(self):
+        if METRICS_SCHEDULER_PORT:
+            metrics.start_metrics_server(
+                METRICS_SCHEDULER_ADDRESS, METRICS_SCHEDULER_PORT
+            )
+        self.startup()
+
+        try:
+            while True:
+                self.wait(self.run_once())
+        finally:
+            # e.g. on Ctrl+C, interrupted jobs are requeued on the next start
+            self._postprocessor.shutdown()
+
+
+def is_process_running(process):
+    # subprocess.Popen or asyncio.subprocess.Process
+    if process is None:
+        return False
+    if hasattr(process, "poll"):
+        return process.poll() is None
+    return process.returncode is None
+
+
+def window_offsets(progress):
+    # (start_byte, start_us, end_byte, end_us), None where not reached
+    start_bytes, start_us = progress.window_start_offset or (None, None)
+    end_bytes, end_us = progress.window_end_offset or (None, None)
+    return start_bytes, start_us, end_bytes, end_us
 
 
 if __name__ == "__main__":
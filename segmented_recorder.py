@@ -0,0 +1,283 @@
+import csv
+import json
+import os
+import shutil
+import signal
+import subprocess
+from pathlib import Path
+
+import clock
+from recorder import FFMPEGStreamRecording, ScheduledRecordingException
+from settings import (
+    FFMPEG_BINARY,
+    RECORDING_PATH,
+    SEGMENT_DURATION_SEC,
+    SEGMENT_JOIN_ATTEMPTS,
+    SEGMENT_JOIN_RETRY_SEC,
+)
+from stream_resolver import stream_url_cache
+
+# segments are always MPEG-TS, they can be cut at any packet and joined
+# by appending them
+TS_PACKET_SIZE = 188
+MANIFEST_NAME = "manifest.json"
+# written by ffmpeg, one line per finished segment
+SEGMENT_LIST_NAME = "segments.csv"
+
+
+def segment_directory(filepath):
+    return Path(RECORDING_PATH, f"{filepath}.segments")
+
+
+def list_segments(segment_dir):
+    """segment files in recording order"""
+    return sorted(Path(segment_dir).glob("[0-9]*.ts"))
+
+
+def read_manifest(filepath):
+    """manifest of an interrupted or running segmented recording, None if there is none"""
+    try:
+        with open(segment_directory(filepath) / MANIFEST_NAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(segment_dir, manifest):
+    # write and rename, so a crash never leaves a half written manifest
+    temporary_path = Path(segment_dir, f"{MANIFEST_NAME}.tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary_path, Path(segment_dir, MANIFEST_NAME))
+
+
+def stop_orphaned_process(manifest):
+    """terminate the ffmpeg of an interrupted run, if it is still writing segments"""
+    if not manifest["runs"] or not manifest["runs"][-1].get("pid"):
+        return
+    pid = manifest["runs"][-1]["pid"]
+    try:
+        # only on Linux, and only if the pid still belongs to that ffmpeg
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+    except OSError:
+        return
+    if os.fsencode(str(segment_directory(manifest["filepath"]))) in cmdline:
+        print(f"Stopping orphaned ffmpeg {pid}")
+        os.kill(pid, signal.SIGTERM)
+
+
+def verify_segments(segment_dir):
+    """check the segments on disk, returns the usable ones in order
+
+    Segments listed by ffmpeg as finished are kept. A segment that was
+    being written when the recording was interrupted is cut back to the
+    last complete MPEG-TS packet, empty segments are removed.
+    """
+    finished = set()
+    try:
+        with open(Path(segment_dir, SEGMENT_LIST_NAME), newline="") as f:
+            finished = {row[0] for row in csv.reader(f) if row}
+    except OSError:
+        pass
+
+    segments = []
+    for segment in list_segments(segment_dir):
+        size = segment.stat().st_size
+        if segment.name not in finished and size % TS_PACKET_SIZE:
+            size -= size % TS_PACKET_SIZE
+            os.truncate(segment, size)
+        if size == 0:
+            segment.unlink()
+            continue
+        segments.append(segment)
+    return segments
+
+
+def join_segments(segment_dir, target_path):
+    """join the segments into the recording without re-encoding, returns its size"""
+    segments = verify_segments(segment_dir)
+    target_path = Path(target_path)
+    temporary_path = target_path.with_name(f"{target_path.name}.joining")
+
+    if target_path.suffix == ".ts":
+        with open(temporary_path, "wb") as target:
+            for segment in segments:
+                with open(segment, "rb") as source:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+    elif segments:
+        # remux into the container of the recording
+        concat_list = Path(segment_dir, "concat.txt")
+        concat_list.write_text(
+            "".join(f"file '{segment.name}'\n" for segment in segments),
+            encoding="utf-8",
+        )
+        command = [
+            FFMPEG_BINARY,
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+        ]
+        command += ["-i", concat_list, "-codec", "copy"]
+        command += ["-f", target_path.suffix.removeprefix("."), temporary_path]
+        subprocess.run(command, check=True, capture_output=True)
+    else:
+        temporary_path.touch()
+
+    os.replace(temporary_path, target_path)
+    shutil.rmtree(segment_dir)
+    return target_path.stat().st_size
+
+
+class SegmentedFFMPEGStreamRecording(FFMPEGStreamRecording):
+    """records into fixed length MPEG-TS segments next to a manifest
+
+    If the scheduler is interrupted, the segments recorded so far stay
+    usable and a new instance with resume=True continues with the next
+    segment number. When the recording ends the segments are joined
+    into the recording file without re-encoding.
+    """
+
+    def __init__(self, *args, resume=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resume = resume
+        self.segment_dir = None
+        self.first_segment = 0
+        self._previous_bytes = 0  # recorded before an interruption
+        # set when every attempt to join failed, for the recovery pass
+        self.join_failed = False
+        self.join_attempts = 0
+
+        if self.filename is None:
+            raise ScheduledRecordingException("Filename for recording not given.")
+        self.segment_dir = segment_directory(self.filename)
+
+    def __repr__(self):
+        return (
+            f"Segmented FFMPEG Recording #{self.schedule_id} - "
+            f"{self.starttime} - {self.url}"
+        )
+
+    def prepare_segments(self):
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        manifest = read_manifest(self.filename) if self.resume else None
+        if manifest is None:
+            manifest = {
+                "schedule_id": self.schedule_id,
+                "filepath": self.filename,
+                "url": self.url,
+                "station_id": self.station_id,
+                "segment_duration_sec": SEGMENT_DURATION_SEC,
+                "runs": [],
+            }
+        else:
+            segments = verify_segments(self.segment_dir)
+            if segments:
+                self.first_segment = int(segments[-1].stem) + 1
+            self._previous_bytes = sum(segment.stat().st_size for segment in segments)
+            # offsets of this run would not match the joined recording
+            self.progress.window_start = None
+            self.progress.window_end = None
+            print(
+                f"[#{self.schedule_id}] Resuming at segment {self.first_segment}, "
+                f"{len(segments)} segments recorded"
+            )
+
+        manifest["runs"].append(
+            {"started": clock.now(), "first_segment": self.first_segment}
+        )
+        write_manifest(self.segment_dir, manifest)
+
+    @property
+    def get_ffmpeg_call(self):
+        self._recording_path = Path(RECORDING_PATH, self.filename)
+
+        return [
+            FFMPEG_BINARY,
+            "-y",
+            "-progress",
+            "pipe:1",
+            "-nostats",
+            "-loglevel",
+            "error",
+            "-i",
+            stream_url_cache.resolve(self.url, self.station_id),
+            "-codec",
+            "copy",
+            "-t",
+            "24:00:00",
+            # fixed length segments, listed in segments.csv when finished
+            "-f",
+            "segment",
+            "-segment_format",
+            "mpegts",
+            "-segment_time",
+            str(SEGMENT_DURATION_SEC),
+            "-segment_start_number",
+            str(self.first_segment),
+            "-segment_list",
+            self.segment_dir / SEGMENT_LIST_NAME,
+            "-segment_list_type",
+            "csv",
+            "-segment_list_flags",
+            "+live",
+            self.segment_dir / "%06d.ts",
+        ]
+
+    def do_recording(self):
+        self.prepare_segments()
+        super().do_recording()
+
+    def start_index(self):
+        # after a resume media time and bytes start again at 0, the index
+        # of the first run is kept as it is
+        if not self.resume:
+            super().start_index()
+
+    def output_handler(self, process, handler_type):
+        if handler_type == "progress":
+            # lets the recovery pass stop the ffmpeg if the scheduler dies
+            manifest = read_manifest(self.filename)
+            if manifest is not None:
+                manifest["runs"][-1]["pid"] = process.pid
+                write_manifest(self.segment_dir, manifest)
+        super().output_handler(process, handler_type)
+
+    def end_recording(self):
+        super().end_recording()
+        if self.process is not None:
+            self.process.wait()
+        # retried on the recording's thread, never in the scheduler loop
+        while not self.join() and self.join_attempts < SEGMENT_JOIN_ATTEMPTS:
+            clock.sleep(SEGMENT_JOIN_RETRY_SEC)
+
+    def join(self):
+        """join the segments into the recording file, True if that worked
+
+        On failure the recording is not completed: the segments stay on
+        disk and the schedule item stays active for the recovery pass
+        after a restart.
+        """
+        self.join_attempts += 1
+        try:
+            filesize = join_segments(
+                self.segment_dir, Path(RECORDING_PATH, self.filename)
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"[#{self.schedule_id}] Joining segments failed: {e}")
+            self.log.append(str(e))
+            self.is_completed = False
+            self.join_failed = True
+            return False
+        print(f"[#{self.schedule_id}] Joined segments, {filesize} bytes")
+        self.is_completed = True
+        self.join_failed = False
+        return True
+
+    def get_approx_size(self):
+        if self.progress.total_size < 0:
+            return self._previous_bytes or -1
+        return self._previous_bytes + self.progress.total_size
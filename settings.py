@@ -2,3 +2,130 @@
 
 RECORDING_PATH = "d:/RECORDINGS"
 DATABASE_NAME = "main.db"
+
+# scheduler: how often to check the database file for changes made by the web app
+SCHEDULER_CHANGE_POLL_SEC = 1
+# scheduler: how often to report the size of running recordings
+SCHEDULER_PROGRESS_INTERVAL_SEC = 5
+
+# sqlite tuning, see https://www.sqlite.org/pragma.html
+DATABASE_BUSY_TIMEOUT_MS = 5000
+DATABASE_CACHE_SIZE_KB = 8192
+# NORMAL is safe in WAL mode and avoids an fsync per commit
+DATABASE_SYNCHRONOUS = "NORMAL"
+# idle connections kept open per mode, shared by all threads (the web server
+# handles every request on a new thread)
+DATABASE_POOL_SIZE = 4
+
+# ffmpeg executable, name on the path or full path (the benchmark uses a fake one)
+FFMPEG_BINARY = "ffmpeg"
+
+# recorder: number of ffmpeg output lines kept per recording
+RECORDER_LOG_LINES = 200
+
+# scheduler: how often the sizes of running recordings are written to the database
+FILESIZE_FLUSH_INTERVAL_SEC = 30
+
+# recorder: "thread" (two threads per recording) or "asyncio" (all recordings on one event loop)
+RECORDER_BACKEND = "thread"
+
+# recordings with these file extensions are captured without ffmpeg (stream written as is)
+NATIVE_CAPTURE_EXTENSIONS = (".mp3", ".aac")
+# scheduler: a default (.ts) filepath gets the .mp3/.aac extension when the stream url,
+# resolved ahead of the start, is a plain MP3/AAC stream, so it is captured natively.
+# Filepaths chosen by the user are kept, give them a .mp3/.aac extension to opt in.
+NATIVE_CAPTURE_DEFAULT_FILEPATHS = True
+# largest single read, a read returns whatever bytes have arrived so far
+HTTP_RECORDER_CHUNK_SIZE = 64 * 1024
+HTTP_RECORDER_TIMEOUT_SEC = 15
+HTTP_RECORDER_RECONNECT_SEC = 2
+
+# web app: browser cache lifetime for completed recordings
+ARCHIVE_MAX_AGE_SEC = 30 * 24 * 3600
+# web app: streaming of running recordings ("/archive/<file>?follow=1")
+ARCHIVE_FOLLOW_CHUNK_SIZE = 64 * 1024
+ARCHIVE_FOLLOW_POLL_SEC = 1
+
+# recurring recordings: number of upcoming schedule items created per repeat rule
+RECURRENCE_MATERIALIZE_COUNT = 3
+# scheduler: only schedule items starting within this time are kept in memory
+SCHEDULER_HORIZON_SEC = 24 * 3600
+
+# scheduler: recordings start this early and end this late, so connecting and
+# probing the stream does not cut off the beginning of the show
+PRE_ROLL_SEC = 15
+POST_ROLL_SEC = 30
+# cut finished recordings to the scheduled window (no re-encoding), runs as the first
+# post-processing job
+TRIM_TO_WINDOW = False
+
+# stream urls: redirects and playlists are resolved in advance and cached per station
+STREAM_RESOLVER_TTL_SEC = 300
+# failed lookups are retried after this time, the original url is used meanwhile
+STREAM_RESOLVER_NEGATIVE_TTL_SEC = 60
+STREAM_RESOLVER_TIMEOUT_SEC = 10
+# scheduler: resolve the stream url this long before a recording is due
+STREAM_RESOLVER_PREFETCH_SEC = 120
+
+# recorder: overlapping recordings of a station share one connection (and one ffmpeg
+# process), for native captures and these formats. MPEG-TS can be joined at any packet.
+# Which recorder is used: resumed items and SEGMENTED_RECORDING first, then the shared
+# capture if another recording of the station overlaps, then the native capture for
+# NATIVE_CAPTURE_EXTENSIONS, otherwise ffmpeg with RECORDER_BACKEND.
+SHARED_CAPTURE = True
+SHARED_CAPTURE_FFMPEG_EXTENSIONS = (".ts",)
+
+# storage: recordings are not started unless their projected size leaves this much free
+STORAGE_MIN_FREE_MB = 500
+# storage: size projection for stations without a measured bitrate
+STORAGE_DEFAULT_BITRATE_KBPS = 128
+STORAGE_FREE_SPACE_CHECK_SEC = 30
+# storage: the oldest finished recordings are deleted when a limit is exceeded (None = no limit)
+RETENTION_MAX_AGE_DAYS = None
+RETENTION_MAX_TOTAL_GB = None
+RETENTION_MAX_COUNT = None
+STORAGE_PRUNE_INTERVAL_SEC = 3600
+
+# catalog of RECORDING_PATH: rescan interval when inotify is not available
+CATALOG_SWEEP_SEC = 60
+
+# recorder: record into fixed length segments (joined at the end), so an interrupted
+# recording can be resumed after a restart of the scheduler
+SEGMENTED_RECORDING = False
+SEGMENT_DURATION_SEC = 300
+# recorder: a failed join of the segments is retried on the recording's thread, the item
+# stays active meanwhile; after the last attempt it is left to the recovery pass of the
+# next scheduler start
+SEGMENT_JOIN_RETRY_SEC = 60
+SEGMENT_JOIN_ATTEMPTS = 3
+
+# recorder: sidecar index with the byte offset of every N seconds, for "?t=" seeks and clips
+TIME_INDEX_INTERVAL_SEC = 10
+
+# post-processing of completed recordings, jobs in order: "trim", "remux_m4a",
+# "remux_mp3" (with station/time tags), "loudness" (EBU R128 report), "peaks" (waveform),
+# "quality" (silence gaps)
+POSTPROCESS_JOBS = ("peaks", "quality")
+POSTPROCESS_WORKERS = 1
+# jobs started while recordings are running (0 = wait until they have finished)
+POSTPROCESS_WORKERS_WHILE_RECORDING = 0
+# workers run with this nice level and idle io priority (Linux)
+POSTPROCESS_NICE = 10
+
+# waveform peaks (".peaks" next to the recording): decoding sample rate and resolution
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_PER_SEC = 20
+
+# quality report: silences below QUALITY_SILENCE_DB (RMS per QUALITY_WINDOW_SEC) of at
+# least QUALITY_MIN_GAP_SEC count as gaps
+QUALITY_SILENCE_DB = -50
+QUALITY_MIN_GAP_SEC = 2
+QUALITY_WINDOW_SEC = 0.1
+QUALITY_SAMPLE_RATE = 8000
+# recorder: no new data for this long counts as a stall of the stream
+QUALITY_STALL_SEC = 10
+
+# metrics in the Prometheus text format: the web app serves them at "/metrics", the
+# scheduler on its own port (None = off)
+METRICS_SCHEDULER_ADDRESS = "127.0.0.1"
+METRICS_SCHEDULER_PORT = 9101
@@ -40,14 +40,11 @@ database.add_schedule_item(
     filepath=None,
 )
 
-# print(database.get_next_schedule_item())
 # try:
 #    database.activate_schedule_item(1)
 # except database.DatabaseException:
 #    pass
 
-print(database.get_next_schedule_item())
-
 print(database.get_all_stations())
 print(
     database.get_scheduled_events(
@@ -0,0 +1,402 @@
+"""replay the schedule on a virtual clock, for capacity planning
+
+The real SchedulingLoop runs against a copy of the database, with
+simulated recordings instead of ffmpeg and the network. Sleeps take no
+time, so a week or a year of recordings is replayed in seconds:
+
+    python simulation.py --days 7
+    python simulation.py --database main.db --days 365 --max-concurrent 8
+    python simulation.py --stations 10 --days 30
+
+Reports missed starts (late, refused or never started), overlapping
+recordings and the peak number of simultaneous recordings.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import settings
+
+# missed starts listed in the report, the earliest first
+REPORT_LIST_LIMIT = 20
+
+
+def configure(workdir):
+    """point PyWRR at a scratch directory, without post-processing and metrics server
+
+    Has to run before the PyWRR modules are imported, they read the
+    settings on import.
+    """
+    recordings = Path(workdir, "recordings")
+    recordings.mkdir()
+    settings.DATABASE_NAME = str(Path(workdir, "simulation.db"))
+    settings.RECORDING_PATH = str(recordings)
+    settings.METRICS_SCHEDULER_PORT = None
+    settings.POSTPROCESS_JOBS = ()
+    settings.TRIM_TO_WINDOW = False
+    settings.RETENTION_MAX_AGE_DAYS = None
+    settings.RETENTION_MAX_TOTAL_GB = None
+    settings.RETENTION_MAX_COUNT = None
+    settings.STORAGE_MIN_FREE_MB = 0
+
+
+def copy_database(source, target):
+    # the backup api includes commits still in the -wal file
+    with contextlib.closing(sqlite3.connect(source)) as source_connection:
+        with contextlib.closing(sqlite3.connect(target)) as target_connection:
+            source_connection.backup(target_connection)
+
+
+def generate_schedule(stations, start):
+    """recurring shows for every station: two back-to-back daily shows, one weekly
+
+    The daily shows of neighbouring stations overlap, they start 20 minutes apart.
+    """
+    import database
+
+    midnight = datetime.datetime.fromtimestamp(start).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    for number in range(stations):
+        station_id = f"SIM{number}"
+        database.add_station(station_id, f"Simulated {number}", f"sim://{number}")
+        morning = midnight + datetime.timedelta(hours=7, minutes=20 * number)
+        database.add_schedule_item(station_id, morning, 60, repeat_rule="FREQ=DAILY")
+        database.add_schedule_item(
+            station_id,
+            morning + datetime.timedelta(hours=1),
+            60,
+            repeat_rule="FREQ=DAILY",
+        )
+        database.add_schedule_item(
+            station_id,
+            midnight + datetime.timedelta(hours=20),
+            180,
+            repeat_rule=f"FREQ=WEEKLY;BYDAY={['MO', 'WE', 'SA'][number % 3]}",
+        )
+
+
+class SimulatedRecording:
+    """stand-in for the recorders: no process, no thread, no file
+
+    The size grows with the bitrate on the virtual clock, the recording
+    finishes by a timer of the clock.
+    """
+
+    def __init__(
+        self,
+        virtual_clock,
+        bitrate_kbps,
+        schedule_id,
+        duration_min,
+        url,
+        filepath,
+        window_start,
+        window_end,
+        station_id,
+        resume=False,
+    ):
+        from recorder import RecordingProgress
+
+        self.clock = virtual_clock
+        self.bitrate_kbps = bitrate_kbps
+        self.schedule_id = schedule_id
+        self.duration_min = duration_min
+        self.url = url
+        self.filename = filepath
+        self._recording_path = Path(settings.RECORDING_PATH, filepath)
+        self.station_id = station_id
+        self.resume = resume
+        self.progress = RecordingProgress()
+        self.progress.window_start = window_start
+        self.progress.window_end = window_end
+        self.starttime = None
+        self.endtime = None
+        self.is_running = False
+        self.is_completed = False
+        self.is_ready_to_be_discarded = False
+        self.on_finished = None
+
+    def __repr__(self):
+        return (
+            f"Simulated Recording #{self.schedule_id} - {self.starttime} - {self.url}"
+        )
+
+    def start(self):
+        self.starttime = self.clock.now()
+        self.is_running = True
+        self.update()
+        # duration_min can still be changed when the recording is resumed
+        self.clock.call_at(self.starttime + self.duration_min * 60, self.finish)
+
+    def update(self):
+        runtime_sec = self.clock.now() - self.starttime
+        self.progress.total_size = int(self.bitrate_kbps * 125 * runtime_sec)
+        self.progress.out_time_us = int(runtime_sec * 1e6)
+        self.progress.bitrate_kbps = self.bitrate_kbps
+        self.progress.speed = 1.0
+        self.progress.updated = self.clock.now()
+        self.progress.sample(self.progress.updated)
+
+    def finish(self):
+        self.update()
+        self.endtime = self.clock.now()
+        self.is_running = False
+        self.is_completed = True
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def get_approx_size(self):
+        if self.is_running:
+            self.update()
+        return self.progress.total_size
+
+
+def create_simulation_loop(
+    virtual_clock, max_concurrent=None, progress_interval_sec=900
+):
+    """SchedulingLoop with simulated recordings, at most max_concurrent at a time"""
+    import scheduler
+    from recorder import ScheduledRecordingException
+    from settings import SCHEDULER_HORIZON_SEC
+
+    class SimulationLoop(scheduler.SchedulingLoop):
+        def __init__(self):
+            # nothing else writes to the database, the horizon is checked anyway
+            super().__init__(SCHEDULER_HORIZON_SEC / 2, progress_interval_sec)
+            self.recordings = []  # every started SimulatedRecording
+            self.claimed = {}  # schedule_id: schedule details
+            self._starting = []  # created in the current batch
+
+        def start_due_items(self, now):
+            self._starting = []
+            super().start_due_items(now)
+            self.recordings.extend(f for f in self._starting if f.starttime is not None)
+
+        def recover_interrupted_items(self, now):
+            self._starting = []
+            super().recover_interrupted_items(now)
+            self.recordings.extend(f for f in self._starting if f.starttime is not None)
+
+        def prefetch_stream_urls(self, now):
+            # no network
+            pass
+
+        def get_recording_class(self, schedule_details, resume=False):
+            self.claimed[schedule_details["schedule_id"]] = schedule_details
+            return self.create_simulated_recording
+
+        def create_simulated_recording(self, **details):
+            running = sum(f.is_running for f in self._current_treads)
+            running += len(self._starting)
+            if max_concurrent is not None and running >= max_concurrent:
+                raise ScheduledRecordingException(
+                    f"[#{details['schedule_id']}] {max_concurrent} recordings running"
+                )
+            # the bitrate storage projects for the station, bytes per second
+            bitrate_kbps = self._storage.projected_size(details["station_id"], 1) / 125
+            f = SimulatedRecording(virtual_clock, bitrate_kbps, **details)
+            self._starting.append(f)
+            return f
+
+    return SimulationLoop()
+
+
+def run_simulation(loop, virtual_clock, end):
+    """drive the loop until end, returns the number of loop passes"""
+    loop.startup()
+    passes = 0
+    while virtual_clock.now() < end:
+        loop.wait(min(loop.run_once(), end - virtual_clock.now()))
+        passes += 1
+    # finish the bookkeeping of recordings that ended at the very end
+    loop.update_recordings(virtual_clock.now())
+    return passes
+
+
+def count_overlaps(intervals):
+    """pairs of overlapping (start, end) intervals"""
+    pairs = 0
+    ends = []
+    for start, end in sorted(intervals):
+        ends = [e for e in ends if e > start]
+        pairs += len(ends)
+        ends.append(end)
+    return pairs
+
+
+def get_peak(intervals):
+    """most intervals at the same time, (count, epoch), ends before starts"""
+    changes = sorted(
+        [(start, 1) for start, end in intervals]
+        + [(end, -1) for start, end in intervals]
+    )
+    peak, peak_time, current = 0, None, 0
+    for moment, change in changes:
+        current += change
+        if current > peak:
+            peak, peak_time = current, moment
+    return peak, peak_time
+
+
+def get_unstarted_items(start, end):
+    """items that were due during the simulation and are still scheduled"""
+    import database
+
+    with database.get_cursor(readonly=True) as cursor:
+        cursor.execute(
+            """SELECT schedule_id, station_id, start_epoch FROM schedule
+                          WHERE state = ? AND start_epoch >= ? AND start_epoch - ? < ?
+                          ORDER BY start_epoch""",
+            (database.STATE_SCHEDULED, start, settings.PRE_ROLL_SEC, end),
+        )
+        return cursor.fetchall()
+
+
+def format_epoch(epoch):
+    if epoch is None:
+        return None
+    return f"{datetime.datetime.fromtimestamp(epoch):%Y-%m-%d %H:%M:%S}"
+
+
+def build_report(loop, start, end, late_sec):
+    missed = []
+    started = {f.schedule_id for f in loop.recordings}
+    for f in loop.recordings:
+        details = loop.claimed[f.schedule_id]
+        lag = f.starttime - (details["start_epoch"] - settings.PRE_ROLL_SEC)
+        if lag > late_sec:
+            missed.append((details["start_epoch"], f.schedule_id, f.station_id, "late"))
+    for schedule_id, details in loop.claimed.items():
+        if schedule_id not in started:
+            missed.append(
+                (details["start_epoch"], schedule_id, details["station_id"], "refused")
+            )
+    for schedule_id, station_id, start_epoch in get_unstarted_items(start, end):
+        missed.append((start_epoch, schedule_id, station_id, "not started"))
+    missed.sort()
+
+    intervals = [(f.starttime, f.endtime or end) for f in loop.recordings]
+    stations = {}
+    for f, interval in zip(loop.recordings, intervals):
+        stations.setdefault(f.station_id, []).append(interval)
+    peak, peak_time = get_peak(intervals)
+
+    # bandwidth and disk, from the simulated bitrates
+    bandwidth_intervals = []
+    for f, (interval_start, interval_end) in zip(loop.recordings, intervals):
+        bandwidth_intervals += [(interval_start, f.bitrate_kbps)]
+        bandwidth_intervals += [(interval_end, -f.bitrate_kbps)]
+    peak_kbps = current_kbps = 0
+    for _, change in sorted(bandwidth_intervals):
+        current_kbps += change
+        peak_kbps = max(peak_kbps, current_kbps)
+
+    reasons = [reason for *_, reason in missed]
+    return {
+        "start": format_epoch(start),
+        "end": format_epoch(end),
+        "recordings": len(loop.recordings),
+        "still_running": sum(f.endtime is None for f in loop.recordings),
+        "recorded_hours": round(sum(e - s for s, e in intervals) / 3600, 1),
+        "recorded_gb": round(
+            sum(f.progress.total_size for f in loop.recordings) / 1e9, 2
+        ),
+        "missed_starts": len(missed),
+        "late": reasons.count("late"),
+        "refused": reasons.count("refused"),
+        "not_started": reasons.count("not started"),
+        "overlaps": count_overlaps(intervals),
+        "station_overlaps": sum(map(count_overlaps, stations.values())),
+        "peak_concurrency": peak,
+        "peak_time": format_epoch(peak_time),
+        "peak_bandwidth_kbps": round(peak_kbps),
+        "missed": [
+            {
+                "schedule_id": schedule_id,
+                "station_id": station_id,
+                "start": format_epoch(start_epoch),
+                "reason": reason,
+            }
+            for start_epoch, schedule_id, station_id, reason in missed[
+                :REPORT_LIST_LIMIT
+            ]
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database",
+        default=settings.DATABASE_NAME,
+        help="schedule to replay, a copy is used",
+    )
+    parser.add_argument(
+        "--stations",
+        type=int,
+        help="replay a generated schedule with this many stations instead",
+    )
+    parser.add_argument("--start", help="ISO date and time, default now")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--max-concurrent", type=int, help="recordings the box can run")
+    parser.add_argument(
+        "--late-sec", type=float, default=5, help="later starts count as missed"
+    )
+    parser.add_argument("--output", type=Path, help="write the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="scheduler output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pywrr-simulation-")
+    try:
+        source_database = Path(args.database).resolve()
+        configure(workdir)
+        if args.stations is None:
+            if not source_database.exists():
+                parser.error(f"{source_database} does not exist, use --stations")
+            copy_database(source_database, settings.DATABASE_NAME)
+
+        # imported after configure(), with the simulation settings
+        import clock
+
+        if args.start:
+            start = datetime.datetime.fromisoformat(args.start).timestamp()
+        else:
+            start = datetime.datetime.now().timestamp()
+        end = start + args.days * 24 * 3600
+        virtual_clock = clock.VirtualClock(start)
+        clock.set_clock(virtual_clock)
+
+        if args.stations is not None:
+            generate_schedule(args.stations, start)
+        loop = create_simulation_loop(virtual_clock, args.max_concurrent)
+
+        print(f"Simulating {args.days} days from {format_epoch(start)}, in {workdir}")
+        real_start = datetime.datetime.now()
+        with open(os.devnull, "w") as devnull:
+            # the scheduler prints every start and progress update
+            quiet = contextlib.redirect_stdout(devnull)
+            with contextlib.nullcontext() if args.verbose else quiet:
+                passes = run_simulation(loop, virtual_clock, end)
+        report = build_report(loop, start, end, args.late_sec)
+        report["loop_passes"] = passes
+        report["real_sec"] = round(
+            (datetime.datetime.now() - real_start).total_seconds(), 1
+        )
+
+        print(json.dumps(report, indent=1))
+        if args.output:
+            args.output.write_text(json.dumps(report, indent=1), encoding="utf-8")
+    finally:
+        # the open database connection keeps the file locked on Windows
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
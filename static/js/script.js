@@ -27,4 +27,61 @@ function replaceURLWithMainPage() {
 window.addEventListener("popstate", replaceURLWithMainPage);
 
 // Call the function to replace the URL with the main page URL initially
-replaceURLWithMainPage();
\ No newline at end of file
+replaceURLWithMainPage();
+
+// Waveforms of completed recordings, drawn from the precomputed peaks file
+// (audiowaveform .dat, 8 bit). Clicking plays the recording from that time.
+function drawWaveform(canvas, buffer) {
+    let view = new DataView(buffer);
+    let sampleRate = view.getInt32(8, true);
+    let samplesPerPeak = view.getInt32(12, true);
+    let length = view.getUint32(16, true);
+    let peaks = new Int8Array(buffer, 20, length * 2);
+    let context = canvas.getContext("2d");
+    let middle = canvas.height / 2;
+
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    context.fillStyle = "#336";
+    for (let x = 0; x < canvas.width; x++) {
+        // min/max of the peaks that fall on this column
+        let first = Math.floor(x * length / canvas.width);
+        let last = Math.max(first + 1, Math.floor((x + 1) * length / canvas.width));
+        let low = 0, high = 0;
+        for (let i = first; i < last && i < length; i++) {
+            low = Math.min(low, peaks[i * 2]);
+            high = Math.max(high, peaks[i * 2 + 1]);
+        }
+        let top = middle - high / 128 * middle;
+        context.fillRect(x, top, 1, Math.max(1, (high - low) / 128 * middle));
+    }
+
+    canvas.onclick = function (event) {
+        let seconds = event.offsetX / canvas.width * length * samplesPerPeak / sampleRate;
+        window.open(canvas.dataset.archive + "?t=" + Math.floor(seconds), "_new");
+    };
+}
+
+function loadWaveforms(element) {
+    element.querySelectorAll("canvas.waveform").forEach(function (canvas) {
+        // cached by the browser, the recording itself is not downloaded
+        fetch(canvas.dataset.peaks)
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.status);
+                }
+                return response.arrayBuffer();
+            })
+            .then(function (buffer) {
+                drawWaveform(canvas, buffer);
+            })
+            .catch(function () {
+                // no peaks (yet)
+                canvas.style.display = "none";
+            });
+    });
+}
+
+// htmx:load fires for every piece of content htmx swaps in
+document.addEventListener("htmx:load", function (event) {
+    loadWaveforms(event.detail.elt);
+});
@@ -0,0 +1,276 @@
+import ctypes
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from threading import Thread
+
+import clock
+import database
+from settings import (
+    RECORDING_PATH,
+    RETENTION_MAX_AGE_DAYS,
+    RETENTION_MAX_COUNT,
+    RETENTION_MAX_TOTAL_GB,
+    STORAGE_DEFAULT_BITRATE_KBPS,
+    STORAGE_FREE_SPACE_CHECK_SEC,
+    STORAGE_MIN_FREE_MB,
+    STORAGE_PRUNE_INTERVAL_SEC,
+)
+from time_index import index_path
+
+
+def get_free_space(folder):
+    if os.name == "posix":  # Linux
+        stat = os.statvfs(folder)
+        return stat.f_bavail * stat.f_frsize
+    elif os.name == "nt":  # Windows
+        free_bytes = ctypes.c_ulonglong(0)
+        if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+            folder, None, None, ctypes.pointer(free_bytes)
+        ):
+            raise ctypes.WinError()
+        return free_bytes.value
+    else:
+        raise OSError("Unsupported operating system")
+
+
+class StorageManager:
+    """bookkeeping of the space used by the recordings in RECORDING_PATH
+
+    The totals are loaded from schedule.filesize once and then kept up to
+    date by the scheduler, admission and retention decisions never walk
+    the directory. Free space is read from the file system at most every
+    STORAGE_FREE_SPACE_CHECK_SEC, the bytes written since are subtracted.
+    """
+
+    def __init__(self, path=RECORDING_PATH):
+        self.path = path
+        self.used_bytes = 0
+        # schedule_id: (start_epoch, filepath, filesize), oldest first
+        self._stored = OrderedDict()
+        # schedule_id: details and projected/current size of running recordings
+        self._running = {}
+        self._bitrates = {}  # station_id: kbps
+        self._free_bytes = None
+        self._free_checked = 0
+        self._written_since_check = 0
+        self._lock = threading.Lock()
+        self._prune_requested = threading.Event()
+
+    def __repr__(self):
+        return (
+            f"Storage {self.path}: {self.used_bytes / 1e9:.2f} GB used by "
+            f"{len(self._stored)} recordings, {len(self._running)} running"
+        )
+
+    def load(self):
+        stored = database.get_stored_recordings()
+        bitrates = {
+            station["station_id"]: station["bitrate_kbps"]
+            for station in database.get_all_stations()
+            if station["bitrate_kbps"]
+        }
+
+        with self._lock:
+            self._stored = OrderedDict(
+                (r["schedule_id"], (r["start_epoch"], r["filepath"], r["filesize"]))
+                for r in stored
+            )
+            self._bitrates = bitrates
+            self.used_bytes = sum(r["filesize"] for r in stored) + sum(
+                running["size"] for running in self._running.values()
+            )
+
+    def get_free_space(self, now=None):
+        """free bytes, None if the file system cannot be read"""
+        if now is None:
+            now = clock.now()
+        if now - self._free_checked >= STORAGE_FREE_SPACE_CHECK_SEC:
+            try:
+                self._free_bytes = get_free_space(self.path)
+            except OSError as e:
+                # e.g. the recording path is missing or not mounted
+                print(f"Free space of {self.path} unknown: {e}")
+                self._free_bytes = None
+            self._free_checked = now
+            self._written_since_check = 0
+        if self._free_bytes is None:
+            return None
+        return self._free_bytes - self._written_since_check
+
+    def projected_size(self, station_id, duration_sec):
+        bitrate_kbps = self._bitrates.get(station_id) or STORAGE_DEFAULT_BITRATE_KBPS
+        return int(bitrate_kbps * 1000 / 8 * duration_sec)
+
+    def reserved_bytes(self):
+        # still to be written by the running recordings
+        return sum(
+            max(0, running["projected"] - running["size"])
+            for running in self._running.values()
+        )
+
+    def available_bytes(self, now=None):
+        """free space left for new recordings, None if unknown"""
+        free_bytes = self.get_free_space(now)
+        if free_bytes is None:
+            return None
+        return free_bytes - self.reserved_bytes() - STORAGE_MIN_FREE_MB * 1024 * 1024
+
+    def admit(self, schedule_details, duration_sec, now=None):
+        """reserve the projected size of a recording, False if it does not fit"""
+        projected = self.projected_size(schedule_details["station_id"], duration_sec)
+
+        with self._lock:
+            available = self.available_bytes(now)
+            # unknown free space does not refuse, the recorder reports its own errors
+            if available is not None and projected > available:
+                print(
+                    f"[#{schedule_details['schedule_id']}] Not enough space: "
+                    f"{projected / 1e6:.0f} MB needed, {available / 1e6:.0f} MB available"
+                )
+                self._prune_requested.set()
+                return False
+
+            self._running[schedule_details["schedule_id"]] = {
+                "station_id": schedule_details["station_id"],
+                "start_epoch": schedule_details["start_epoch"],
+                "filepath": schedule_details["filepath"],
+                "projected": projected,
+                "size": 0,
+            }
+        return True
+
+    def check_upcoming(self, events, now=None):
+        """warn if the upcoming recordings are projected not to fit"""
+        projected = sum(
+            self.projected_size(event["station_id"], event["runtime"] * 60)
+            for event in events
+        )
+        with self._lock:
+            available = self.available_bytes(now)
+        if available is not None and projected > available:
+            print(
+                f"Upcoming recordings need {projected / 1e6:.0f} MB, "
+                f"only {available / 1e6:.0f} MB available"
+            )
+            self._prune_requested.set()
+        return projected
+
+    def record_filesize(self, schedule_id, filesize):
+        with self._lock:
+            self._update_size(self._running.get(schedule_id), filesize)
+
+    def _update_size(self, running, filesize):
+        if running is None:
+            return
+        delta = filesize - running["size"]
+        running["size"] = filesize
+        self.used_bytes += delta
+        self._written_since_check += delta
+
+    def release(self, schedule_id, filesize, bitrate_kbps=None):
+        """a recording has finished, its final size is now stored"""
+        with self._lock:
+            running = self._running.pop(schedule_id, None)
+            if running is None:
+                return
+            self._update_size(running, filesize)
+            if filesize > 0:
+                self._stored[schedule_id] = (
+                    running["start_epoch"],
+                    running["filepath"],
+                    filesize,
+                )
+            # learn the bitrate of the station for the next projections
+            if bitrate_kbps:
+                self._bitrates[running["station_id"]] = bitrate_kbps
+
+        if bitrate_kbps:
+            database.update_station_bitrate(running["station_id"], bitrate_kbps)
+
+    def update_stored_size(self, schedule_id, filesize):
+        # e.g. after trimming a recording
+        with self._lock:
+            if schedule_id not in self._stored:
+                return
+            start_epoch, filepath, old_filesize = self._stored[schedule_id]
+            self._stored[schedule_id] = (start_epoch, filepath, filesize)
+            self.used_bytes += filesize - old_filesize
+
+    def select_for_pruning(self, now=None):
+        """oldest recordings that break one of the retention rules"""
+        if now is None:
+            now = clock.now()
+
+        selected = []
+        with self._lock:
+            count = len(self._stored)
+            used_bytes = self.used_bytes
+            for schedule_id, (start_epoch, _, filesize) in self._stored.items():
+                too_old = (
+                    RETENTION_MAX_AGE_DAYS is not None
+                    and now - start_epoch > RETENTION_MAX_AGE_DAYS * 24 * 3600
+                )
+                too_many = (
+                    RETENTION_MAX_COUNT is not None and count > RETENTION_MAX_COUNT
+                )
+                too_big = (
+                    RETENTION_MAX_TOTAL_GB is not None
+                    and used_bytes > RETENTION_MAX_TOTAL_GB * 1e9
+                )
+                if not (too_old or too_many or too_big):
+                    break
+                selected.append(schedule_id)
+                count -= 1
+                used_bytes -= filesize
+        return selected
+
+    def prune(self, now=None):
+        selected = self.select_for_pruning(now)
+        with self._lock:
+            filepaths = {
+                schedule_id: self._stored[schedule_id][1] for schedule_id in selected
+            }
+
+        # post-processing results go with their recording
+        outputs = database.get_postprocess_outputs(list(filepaths))
+        pruned = []
+        for schedule_id, filepath in filepaths.items():
+            try:
+                Path(self.path, filepath).unlink(missing_ok=True)
+                index_path(Path(self.path, filepath)).unlink(missing_ok=True)
+                for output_filepath in outputs.get(schedule_id, []):
+                    Path(self.path, output_filepath).unlink(missing_ok=True)
+            except OSError as e:
+                print(f"[#{schedule_id}] Pruning failed: {e}")
+                continue
+            pruned.append(schedule_id)
+
+        if pruned:
+            database.prune_schedule_items(pruned)
+        with self._lock:
+            for schedule_id in pruned:
+                _, _, filesize = self._stored.pop(schedule_id)
+                self.used_bytes -= filesize
+
+        if pruned:
+            print(f"Pruned {len(pruned)} recordings - {self}")
+        return pruned
+
+    def run_pruning(self):
+        while True:
+            try:
+                self.prune()
+            except (OSError, sqlite3.Error, database.DatabaseException) as e:
+                print(f"Pruning failed: {e}")
+            self._prune_requested.wait(STORAGE_PRUNE_INTERVAL_SEC)
+            self._prune_requested.clear()
+
+    def start_pruning(self):
+        """enforce the retention rules in a background thread"""
+        pruning_thread = Thread(target=self.run_pruning)
+        pruning_thread.daemon = True
+        pruning_thread.start()
+        return pruning_thread
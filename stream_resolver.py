@@ -0,0 +1,210 @@
+import http.client
+import threading
+import time
+import urllib.parse
+import urllib.request
+from pathlib import PurePosixPath
+
+from settings import (
+    STREAM_RESOLVER_NEGATIVE_TTL_SEC,
+    STREAM_RESOLVER_TIMEOUT_SEC,
+    STREAM_RESOLVER_TTL_SEC,
+)
+
+PLAYLIST_CONTENT_TYPES = {
+    "audio/x-scpls": ".pls",
+    "audio/scpls": ".pls",
+    "audio/x-mpegurl": ".m3u",
+    "audio/mpegurl": ".m3u",
+    "application/x-mpegurl": ".m3u8",
+    "application/vnd.apple.mpegurl": ".m3u8",
+}
+PLAYLIST_EXTENSIONS = (".pls", ".m3u", ".m3u8")
+# playlists are small, never read more of a response than this
+PLAYLIST_MAX_BYTES = 64 * 1024
+# playlists pointing to playlists
+MAX_RESOLVE_DEPTH = 5
+
+
+class StreamResolverException(Exception):
+    pass
+
+
+def resolve_stream(url, depth=0):
+    """follow redirects and playlists (PLS, M3U, HLS master) to the media url
+
+    Returns the url and the content type of the media. HLS media playlists
+    are returned as they are, ffmpeg records those.
+    """
+    if depth > MAX_RESOLVE_DEPTH:
+        raise StreamResolverException(f"Too many nested playlists for {url}")
+
+    request = urllib.request.Request(url, headers={"User-Agent": "PyWRR"})
+    with urllib.request.urlopen(
+        request, timeout=STREAM_RESOLVER_TIMEOUT_SEC
+    ) as response:
+        # urllib has followed the redirects
+        final_url = response.geturl()
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        extension = PurePosixPath(urllib.parse.urlsplit(final_url).path).suffix.lower()
+
+        # only playlists are read, audio streams are closed right away
+        if (
+            content_type not in PLAYLIST_CONTENT_TYPES
+            and extension not in PLAYLIST_EXTENSIONS
+            and not content_type.startswith("text/")
+        ):
+            return final_url, content_type
+        text = response.read(PLAYLIST_MAX_BYTES).decode(errors="replace")
+
+    if text.lstrip().lower().startswith("[playlist]"):
+        entry = parse_pls(text)
+    elif "#EXT-X-STREAM-INF" in text:
+        entry = parse_hls_master(text)
+    elif "#EXTINF" in text and "#EXT-X-TARGETDURATION" in text:
+        # HLS media playlist
+        return final_url, content_type
+    elif text.lstrip().startswith("#EXTM3U") or extension in (".m3u", ".m3u8"):
+        entry = parse_m3u(text)
+    else:
+        return final_url, content_type
+
+    if entry is None:
+        raise StreamResolverException(f"No stream found in playlist {final_url}")
+    return resolve_stream(urllib.parse.urljoin(final_url, entry), depth + 1)
+
+
+def parse_pls(text):
+    # "File1=http://...", the lowest number wins
+    entries = {}
+    for line in text.splitlines():
+        key, separator, value = line.strip().partition("=")
+        if separator and key.lower().startswith("file") and key[4:].isdigit():
+            entries[int(key[4:])] = value.strip()
+    return entries[min(entries)] if entries else None
+
+
+def parse_m3u(text):
+    # first line that is not a comment
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            return line
+    return None
+
+
+def parse_hls_master(text):
+    # variant with the highest bandwidth, each "#EXT-X-STREAM-INF" line is
+    # followed by the uri of the variant playlist
+    best = None
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF"):
+            attributes = line.partition(":")[2]
+            bandwidth = 0
+            for attribute in attributes.split(","):
+                name, _, value = attribute.partition("=")
+                if name.strip() == "BANDWIDTH" and value.strip().isdigit():
+                    bandwidth = int(value)
+        elif line and not line.startswith("#") and bandwidth is not None:
+            if best is None or bandwidth > best[0]:
+                best = (bandwidth, line)
+            bandwidth = None
+    return best[1] if best else None
+
+
+class StreamURLCache:
+    """resolved stream urls per station, with negative caching
+
+    Failed lookups are remembered for a shorter time and return the
+    original url, so ffmpeg can still try it. Entries older than half
+    their lifetime are refreshed in the background when used.
+    """
+
+    def __init__(
+        self,
+        ttl_sec=STREAM_RESOLVER_TTL_SEC,
+        negative_ttl_sec=STREAM_RESOLVER_NEGATIVE_TTL_SEC,
+    ):
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+        # key: (url, resolved_url, resolved at, expires at, content type)
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, url):
+        entry = self._entries.get(key)
+        # a changed station url invalidates the entry
+        if entry is None or entry[0] != url or entry[3] < time.monotonic():
+            return None
+        return entry
+
+    def resolve(self, url, station_id=None):
+        """resolved url, from the cache if possible"""
+        key = station_id or url
+        with self._lock:
+            entry = self._lookup(key, url)
+
+        if entry is None:
+            return self.refresh(url, station_id)
+
+        if time.monotonic() - entry[2] > (entry[3] - entry[2]) / 2:
+            self.prefetch(url, station_id)
+        return entry[1]
+
+    def get_content_type(self, url, station_id=None):
+        """content type of the media from the cache, None if not resolved yet"""
+        key = station_id or url
+        with self._lock:
+            entry = self._lookup(key, url)
+        return entry[4] if entry is not None else None
+
+    def refresh(self, url, station_id=None):
+        key = station_id or url
+        try:
+            resolved_url, content_type = resolve_stream(url)
+            ttl_sec = self.ttl_sec
+        except (
+            OSError,
+            ValueError,
+            http.client.HTTPException,
+            StreamResolverException,
+        ) as e:
+            print(f"Resolving {url} failed: {e}")
+            resolved_url, content_type = url, None
+            ttl_sec = self.negative_ttl_sec
+
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (url, resolved_url, now, now + ttl_sec, content_type)
+            self._refreshing.discard(key)
+        return resolved_url
+
+    def prefetch(self, url, station_id=None):
+        """resolve in a background thread, unless cached or already running"""
+        key = station_id or url
+        with self._lock:
+            entry = self._lookup(key, url)
+            if key in self._refreshing:
+                return
+            if (
+                entry is not None
+                and time.monotonic() - entry[2] <= (entry[3] - entry[2]) / 2
+            ):
+                return
+            self._refreshing.add(key)
+
+        thread = threading.Thread(target=self.refresh, args=(url, station_id))
+        thread.daemon = True
+        thread.start()
+
+    def forget(self, url, station_id=None):
+        """drop the resolved url, e.g. after a connection error"""
+        with self._lock:
+            self._entries.pop(station_id or url, None)
+
+
+# shared by all recordings of the process
+stream_url_cache = StreamURLCache()
@@ -0,0 +1,39 @@
+import tempfile
+
+import pytest
+
+import simulation
+
+# the PyWRR modules read the settings on import, so the scratch directory
+# has to be configured before any test module imports them
+simulation.configure(tempfile.mkdtemp(prefix="pywrr-tests-"))
+
+import clock  # noqa: E402
+import database  # noqa: E402
+
+
+def close_pooled_connections():
+    with database._pool_lock:
+        for connections in database._pool.values():
+            for conn in connections:
+                conn.close()
+        database._pool.clear()
+
+
+@pytest.fixture
+def fresh_database(tmp_path, monkeypatch):
+    """an empty database, migrated from scratch"""
+    close_pooled_connections()
+    monkeypatch.setattr(database, "DATABASE_NAME", str(tmp_path / "test.db"))
+    database.setup_database_tables()
+    yield database
+    close_pooled_connections()
+
+
+@pytest.fixture
+def virtual_clock():
+    """a simulated clock for the duration of the test"""
+    virtual = clock.VirtualClock(1_700_000_000)
+    previous = clock.set_clock(virtual)
+    yield virtual
+    clock.set_clock(previous)
@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+import database
+
+
+def test_fresh_database_is_fully_migrated(fresh_database):
+    with database.get_cursor(readonly=True) as cursor:
+        cursor.execute("PRAGMA user_version")
+        assert cursor.fetchone()[0] == len(database.MIGRATIONS)
+    # a second run has nothing to do
+    database.setup_database_tables()
+
+
+def test_migrations_convert_legacy_schedule():
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    database.MIGRATIONS[0](cursor)
+    cursor.executemany(
+        """INSERT INTO schedule (station_id, starttime, runtime, active, completed, aborted)
+           VALUES ('S', ?, 60, ?, ?, ?)""",
+        [
+            ("2023-06-18 20:00", 0, 0, 0),
+            ("2023-06-18 21:00:00", 1, 0, 0),
+            ("2023-06-18 22:00:00.5", 1, 1, 0),
+            ("2023-06-18 23:00", 0, 0, 1),
+            ("not a time", 0, 0, 0),
+        ],
+    )
+    for migration in database.MIGRATIONS[1:]:
+        migration(cursor)
+
+    cursor.execute("SELECT start_epoch, state FROM schedule ORDER BY schedule_id")
+    rows = cursor.fetchall()
+    assert [state for _, state in rows] == [
+        database.STATE_SCHEDULED,
+        database.STATE_ACTIVE,
+        database.STATE_COMPLETED,
+        database.STATE_ABORTED,
+        database.STATE_ABORTED,
+    ]
+    assert rows[0][0] == database.starttime_to_epoch("2023-06-18 20:00")
+    assert rows[1][0] - rows[0][0] == 3600
+    assert rows[4][0] == 0
+
+
+def test_claim_aborts_items_of_deleted_stations(fresh_database, virtual_clock):
+    database.add_station("A", "Station A", "http://a.example/stream")
+    database.add_station("B", "Station B", "http://b.example/stream")
+    now = virtual_clock.now()
+    database.add_schedule_item("A", now + 60, 30)
+    database.add_schedule_item("B", now + 60, 30)
+    database.add_schedule_item("A", now + 3600, 30)
+    # stations with future recordings can't be deleted
+    virtual_clock.sleep(90)
+    database.delete_station("B")
+
+    claimed = database.claim_due_schedule_items(now + 120)
+
+    assert [item["station_id"] for item in claimed] == ["A"]
+    assert database.claim_due_schedule_items(now + 120) == []
+    with database.get_cursor(readonly=True) as cursor:
+        cursor.execute("SELECT station_id, state FROM schedule ORDER BY start_epoch")
+        assert sorted(cursor.fetchall()) == [
+            ("A", database.STATE_SCHEDULED),
+            ("A", database.STATE_ACTIVE),
+            ("B", database.STATE_ABORTED),
+        ]
+
+
+def test_abort_scheduled_and_active_items(fresh_database, virtual_clock):
+    database.add_station("A", "Station A", "http://a.example/stream")
+    now = virtual_clock.now()
+    database.add_schedule_item("A", now + 60, 30)
+    database.add_schedule_item("A", now + 120, 30)
+    database.add_schedule_item("A", now + 3600, 30)
+    active, completed = [
+        item["schedule_id"] for item in database.claim_due_schedule_items(now + 600)
+    ]
+    database.complete_schedule_item(completed)
+
+    assert database.abort_schedule_items([active, completed]) == [active]
+
+    with database.get_cursor(readonly=True) as cursor:
+        cursor.execute("SELECT MAX(schedule_id) FROM schedule")
+        scheduled = cursor.fetchone()[0]
+    database.abort_schedule_item(scheduled)
+    assert database.get_schedule_item(scheduled)["state"] == database.STATE_ABORTED
+
+    with pytest.raises(database.DatabaseException, match="already finished"):
+        database.abort_schedule_item(completed)
+    with pytest.raises(database.DatabaseException, match="does not exist"):
+        database.abort_schedule_item(10_000)
@@ -0,0 +1,41 @@
+import pytest
+
+from http_recorder import IcyMetadataStripper
+
+
+def icy_stream(audio_blocks, titles, metaint):
+    # audio blocks of metaint bytes, each followed by a metadata block
+    stream = b""
+    for audio, title in zip(audio_blocks, titles):
+        assert len(audio) == metaint
+        metadata = title.encode()
+        metadata += b"\0" * (-len(metadata) % 16)
+        stream += audio + bytes([len(metadata) // 16]) + metadata
+    return stream
+
+
+def strip(stream, metaint, chunk_size):
+    audio = bytearray()
+    titles = []
+    stripper = IcyMetadataStripper(metaint, on_metadata=titles.append)
+    view = memoryview(stream)
+    for position in range(0, len(stream), chunk_size):
+        stripper.feed(view[position : position + chunk_size], audio.extend)
+    return bytes(audio), titles
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 17, 1000])
+def test_metadata_is_removed_at_any_chunk_size(chunk_size):
+    audio_blocks = [bytes([n]) * 16 for n in range(4)]
+    titles = ["StreamTitle='One';", "", "StreamTitle='Three, a longer title';", ""]
+    stream = icy_stream(audio_blocks, titles, 16) + b"tail"
+
+    audio, metadata = strip(stream, 16, chunk_size)
+    assert audio == b"".join(audio_blocks) + b"tail"
+    # empty metadata blocks are not reported
+    assert metadata == ["StreamTitle='One';", "StreamTitle='Three, a longer title';"]
+
+
+def test_without_metaint_everything_is_audio():
+    stream = bytes(range(256))
+    assert strip(stream, 0, 7) == (stream, [])
@@ -0,0 +1,41 @@
+import metrics
+
+
+def test_exposition_format():
+    registry = metrics.Registry()
+    requests = registry.register(metrics.Counter("test_requests_total", "Requests"))
+    requests.inc(path='/a"b\\c')
+    requests.inc(2, path='/a"b\\c')
+    registry.register(metrics.Gauge("test_up", "Up", lambda: [((), 1)]))
+
+    assert registry.render() == (
+        "# HELP test_requests_total Requests\n"
+        "# TYPE test_requests_total counter\n"
+        'test_requests_total{path="/a\\"b\\\\c"} 3\n'
+        "# HELP test_up Up\n"
+        "# TYPE test_up gauge\n"
+        "test_up 1\n"
+    )
+
+
+def test_register_returns_the_existing_metric():
+    registry = metrics.Registry()
+    first = registry.register(metrics.Counter("test_total", "First"))
+    assert registry.register(metrics.Counter("test_total", "Second")) is first
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, call="x")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{call="x",le="0.1"} 2',
+        'test_seconds_bucket{call="x",le="1"} 3',
+        'test_seconds_bucket{call="x",le="+Inf"} 4',
+        'test_seconds_count{call="x"} 4',
+        'test_seconds_sum{call="x"} 3.65',
+    ]
+    assert histogram.totals() == {(("call", "x"),): (4, 3.65)}
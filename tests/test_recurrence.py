@@ -0,0 +1,97 @@
+import datetime
+import itertools
+
+import pytest
+
+from recurrence import RecurrenceRule, RecurrenceRuleException
+
+
+def occurrences(rule, dtstart, after=None, limit=10):
+    return list(
+        itertools.islice(RecurrenceRule(rule).iter_occurrences(dtstart, after), limit)
+    )
+
+
+def test_daily_with_interval():
+    start = datetime.datetime(2024, 3, 1, 20, 0)
+    assert occurrences("FREQ=DAILY;INTERVAL=2", start, limit=3) == [
+        datetime.datetime(2024, 3, 1, 20, 0),
+        datetime.datetime(2024, 3, 3, 20, 0),
+        datetime.datetime(2024, 3, 5, 20, 0),
+    ]
+
+
+def test_weekly_byday():
+    # Friday 2024-03-01, so the Monday of that week is skipped
+    start = datetime.datetime(2024, 3, 1, 8, 0)
+    assert occurrences("RRULE:FREQ=WEEKLY;BYDAY=MO,FR", start, limit=4) == [
+        datetime.datetime(2024, 3, 1, 8, 0),
+        datetime.datetime(2024, 3, 4, 8, 0),
+        datetime.datetime(2024, 3, 8, 8, 0),
+        datetime.datetime(2024, 3, 11, 8, 0),
+    ]
+
+
+def test_count_and_until():
+    start = datetime.datetime(2024, 3, 1, 8, 0)
+    assert len(occurrences("FREQ=HOURLY;COUNT=5", start, limit=100)) == 5
+    assert occurrences("FREQ=DAILY;UNTIL=20240303", start, limit=100) == [
+        datetime.datetime(2024, 3, 1, 8, 0),
+        datetime.datetime(2024, 3, 2, 8, 0),
+        datetime.datetime(2024, 3, 3, 8, 0),
+    ]
+
+
+def test_count_is_counted_from_the_start():
+    start = datetime.datetime(2024, 3, 1, 8, 0)
+    after = datetime.datetime(2024, 3, 3, 12, 0)
+    assert occurrences("FREQ=DAILY;COUNT=4", start, after) == [
+        datetime.datetime(2024, 3, 4, 8, 0),
+    ]
+
+
+def test_monthly_skips_missing_days():
+    start = datetime.datetime(2024, 1, 31, 9, 0)
+    assert occurrences("FREQ=MONTHLY", start, limit=4) == [
+        datetime.datetime(2024, 1, 31, 9, 0),
+        datetime.datetime(2024, 3, 31, 9, 0),
+        datetime.datetime(2024, 5, 31, 9, 0),
+        datetime.datetime(2024, 7, 31, 9, 0),
+    ]
+
+
+def test_yearly_leap_day():
+    start = datetime.datetime(2024, 2, 29, 9, 0)
+    after = datetime.datetime(2024, 3, 1)
+    assert occurrences("FREQ=MONTHLY;INTERVAL=12", start, after, limit=2) == [
+        datetime.datetime(2028, 2, 29, 9, 0),
+        datetime.datetime(2032, 2, 29, 9, 0),
+    ]
+
+
+def test_after_skips_ahead():
+    start = datetime.datetime(2020, 1, 1, 6, 0)
+    after = datetime.datetime(2024, 3, 1, 6, 0)
+    assert occurrences("FREQ=WEEKLY", start, after, limit=2) == [
+        datetime.datetime(2024, 3, 6, 6, 0),
+        datetime.datetime(2024, 3, 13, 6, 0),
+    ]
+
+
+@pytest.mark.parametrize(
+    "rule",
+    [
+        "INTERVAL=2",
+        "FREQ=YEARLY",
+        "FREQ=DAILY;INTERVAL=0",
+        "FREQ=DAILY;COUNT=x",
+        "FREQ=DAILY;BYDAY=MO",
+        "FREQ=WEEKLY;BYDAY=XX",
+        "FREQ=DAILY;BYHOUR=8",
+        "FREQ=DAILY;UNTIL=2024",
+        "FREQ",
+    ],
+)
+def test_invalid_rules(rule):
+    with pytest.raises(RecurrenceRuleException):
+        RecurrenceRule(rule)
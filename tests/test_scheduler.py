@@ -0,0 +1,20 @@
+import contextlib
+import io
+
+import simulation
+
+
+def test_simulated_days_start_every_recording(fresh_database, virtual_clock):
+    start = virtual_clock.now()
+    end = start + 2 * 24 * 3600
+    simulation.generate_schedule(4, start)
+    loop = simulation.create_simulation_loop(virtual_clock)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulation.run_simulation(loop, virtual_clock, end)
+    report = simulation.build_report(loop, start, end, late_sec=5)
+
+    assert report["missed_starts"] == 0, report["missed"]
+    # two daily shows per station and day, one weekly show
+    assert report["recordings"] >= 4 * 2 * 2
+    assert report["still_running"] == 0
@@ -0,0 +1,27 @@
+from segmented_recorder import SEGMENT_LIST_NAME, TS_PACKET_SIZE, verify_segments
+
+
+def test_verify_segments(tmp_path):
+    # finished segments are kept as they are
+    (tmp_path / "000.ts").write_bytes(bytes(TS_PACKET_SIZE * 2 + 5))
+    # the segment being written is cut back to the last complete packet
+    (tmp_path / "001.ts").write_bytes(bytes(TS_PACKET_SIZE * 3 + 100))
+    # less than a packet, nothing usable is left
+    (tmp_path / "002.ts").write_bytes(bytes(100))
+    (tmp_path / "003.ts").write_bytes(b"")
+    (tmp_path / SEGMENT_LIST_NAME).write_text("000.ts,0,10\n")
+
+    segments = verify_segments(tmp_path)
+
+    assert [segment.name for segment in segments] == ["000.ts", "001.ts"]
+    assert segments[0].stat().st_size == TS_PACKET_SIZE * 2 + 5
+    assert segments[1].stat().st_size == TS_PACKET_SIZE * 3
+    assert not (tmp_path / "002.ts").exists()
+    assert not (tmp_path / "003.ts").exists()
+
+
+def test_verify_segments_without_list(tmp_path):
+    (tmp_path / "000.ts").write_bytes(bytes(TS_PACKET_SIZE + 1))
+    assert [segment.stat().st_size for segment in verify_segments(tmp_path)] == [
+        TS_PACKET_SIZE
+    ]
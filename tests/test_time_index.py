@@ -0,0 +1,46 @@
+import pytest
+
+from time_index import TS_PACKET_SIZE, TimeIndexWriter, clip_byte_range, lookup_offset
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """a 60 second recording at 1000 bytes per second, indexed every 10 seconds"""
+
+    def create(name):
+        path = tmp_path / name
+        path.write_bytes(bytes(60_000))
+        writer = TimeIndexWriter(path, interval_sec=10)
+        for second in range(5, 41, 5):
+            writer.add_sample(second * 1_000_000, second * 1000)
+        return path
+
+    return create
+
+
+def test_offsets_are_interpolated(recording):
+    path = recording("show.mp3")
+    assert lookup_offset(path, 0) == 0
+    assert lookup_offset(path, 15) == 10_000
+    assert lookup_offset(path, 40) == 40_000
+    assert lookup_offset(path, 50) is None
+
+
+def test_ts_offsets_start_at_a_packet(recording):
+    path = recording("show.ts")
+    assert lookup_offset(path, 10) == 10_000 - 10_000 % TS_PACKET_SIZE
+
+
+def test_clip_byte_range(recording):
+    path = recording("show.mp3")
+    assert clip_byte_range(path, 10, 30) == (10_000, 30_000)
+    assert clip_byte_range(path, 20) == (20_000, None)
+    # an end past the index is clamped to the file
+    assert clip_byte_range(path, 20, 55) == (20_000, 60_000)
+
+
+def test_clip_byte_range_without_start(recording, tmp_path):
+    path = recording("show.mp3")
+    assert clip_byte_range(path, 50, 55) is None
+    assert clip_byte_range(path, 30, 10) is None
+    assert clip_byte_range(tmp_path / "missing.mp3", 0, 10) is None
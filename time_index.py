@@ -0,0 +1,106 @@
+import os
+import struct
+from pathlib import Path
+
+from settings import RECORDING_PATH, TIME_INDEX_INTERVAL_SEC
+
+INDEX_SUFFIX = ".idx"
+# magic, version, seconds between entries; followed by one little endian
+# uint64 byte offset per interval, entry i is the offset at i * interval
+INDEX_HEADER = struct.Struct("<4sBxxxI")
+INDEX_ENTRY = struct.Struct("<Q")
+INDEX_MAGIC = b"PWRI"
+INDEX_VERSION = 1
+TS_PACKET_SIZE = 188
+
+
+def index_path(recording_path):
+    """sidecar index of a recording, "show.ts" -> "show.ts.idx\" """
+    return Path(f"{recording_path}{INDEX_SUFFIX}")
+
+
+class TimeIndexWriter:
+    """writes the byte offset of every interval_sec of media time while recording
+
+    Fed with the (media time, bytes written) samples of the recording
+    progress, offsets between two samples are interpolated.
+    """
+
+    def __init__(self, recording_path, interval_sec=TIME_INDEX_INTERVAL_SEC):
+        self.path = index_path(recording_path)
+        self.interval_us = interval_sec * 1_000_000
+        self.entries = 1
+        self._last_sample = (0, 0)
+
+        with open(self.path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, interval_sec))
+            f.write(INDEX_ENTRY.pack(0))
+
+    def add_sample(self, out_time_us, total_bytes):
+        if out_time_us is None or total_bytes < 0:
+            return
+
+        offsets = []
+        last_us, last_bytes = self._last_sample
+        while out_time_us >= self.entries * self.interval_us:
+            moment_us = self.entries * self.interval_us
+            share = (moment_us - last_us) / max(1, out_time_us - last_us)
+            offsets.append(int(last_bytes + share * (total_bytes - last_bytes)))
+            self.entries += 1
+        self._last_sample = (out_time_us, total_bytes)
+
+        if offsets:
+            # appended in place, the index is usable while recording
+            with open(self.path, "ab") as f:
+                f.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+
+
+def start_time_index(filepath):
+    """new index for a recording, None if disabled"""
+    if not TIME_INDEX_INTERVAL_SEC or filepath is None:
+        return None
+    return TimeIndexWriter(Path(RECORDING_PATH, filepath))
+
+
+def lookup_offset(recording_path, seconds):
+    """byte offset of the media time, None if there is no index or it ends earlier"""
+    try:
+        with open(index_path(recording_path), "rb") as f:
+            magic, version, interval_sec = INDEX_HEADER.unpack(
+                f.read(INDEX_HEADER.size)
+            )
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+            entry = int(max(0, seconds) // interval_sec)
+            f.seek(INDEX_HEADER.size + entry * INDEX_ENTRY.size)
+            data = f.read(INDEX_ENTRY.size)
+    except (OSError, struct.error):
+        return None
+
+    if len(data) < INDEX_ENTRY.size:
+        return None
+    offset = INDEX_ENTRY.unpack(data)[0]
+
+    # MPEG-TS has to start at a packet, mp3/aac decoders find the next frame
+    if Path(recording_path).suffix == ".ts":
+        offset -= offset % TS_PACKET_SIZE
+    return offset
+
+
+def clip_byte_range(recording_path, start_sec, end_sec=None):
+    """(start, end) bytes of a clip, end None for "until the end of the file"
+
+    None if the start can't be found in the index. An end past the index
+    is clamped to the size of the file.
+    """
+    start = lookup_offset(recording_path, start_sec)
+    if start is None:
+        return None
+    end = None
+    if end_sec is not None:
+        end = lookup_offset(recording_path, end_sec)
+        if end is None:
+            end = os.path.getsize(recording_path)
+    if end is not None and end < start:
+        return None
+    return start, end